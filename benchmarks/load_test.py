@@ -0,0 +1,493 @@
+"""
+Нагрузочный тест бота целиком: синтетические обновления (текстовые вопросы, PDF, аудио, фото) подаются
+в Dispatcher из bot_runner с заданной интенсивностью, как при polling.
+
+Бот работает с локальными заглушками: Bot API (отвечает на sendMessage, editMessageText, getFile и отдает файлы)
+и OpenAI-совместимый сервер chat.completions (потоковые и обычные ответы) с настраиваемой задержкой.
+Фрагменты хранятся во встроенном хранилище (STORAGE_BACKEND=local) во временном каталоге, который
+удаляется после прогона. Модели эмбеддингов и Whisper загружаются по-настоящему. Остальные настройки бота
+берутся из окружения, так что можно сравнивать, например, GPT_CONCURRENCY или WORKER_POOL_KIND.
+
+Результат - JSON с пропускной способностью, задержкой в очереди (от прихода обновления до начала работы
+обработчика), p50/p99 полной задержки и первого ответа по обработчикам, а также с задержками цикла событий.
+
+Запуск из корня репозитория:
+    python -m benchmarks.load_test --rate text=5,pdf=0.1,photo=0.5 --users 50 --duration 60 --output load.json
+"""
+import argparse
+import asyncio
+import glob
+import io
+import itertools
+import json
+import logging
+import math
+import os
+import platform
+import random
+import shutil
+import struct
+import tempfile
+import time
+import wave
+
+from aiohttp import web
+
+TEST_FILES_DIR = 'data/input/files_for_test'
+FAKE_BOT_TOKEN = '1000000:LOADTESTFAKETOKEN'
+KINDS = ('text', 'pdf', 'audio', 'photo')
+IMAGE_QUERY = 'Что изображено на картинке?'
+
+
+class FakeTelegramServer:
+    """
+    Заглушка Bot API. Отвечает на методы, которые вызывает бот, отдает зарегистрированные файлы
+    и сообщает о каждом сообщении бота пользователю через on_reply(chat_id).
+    """
+
+    def __init__(self, latency: float = 0.0):
+        """
+        :param latency: Задержка ответа на каждый метод в секундах.
+        """
+        self.latency = latency
+        self.files = {}
+        self.calls = {}
+        self.on_reply = None
+        self._message_ids = itertools.count(1)
+
+    def add_file(self, file_id: str, path: str, data: bytes):
+        """Регистрирует файл, который бот получит через getFile и скачает по path."""
+        self.files[file_id] = (path, data)
+
+    def _message(self, chat_id, message_id=None, text=None) -> dict:
+        return {'message_id': message_id or next(self._message_ids), 'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'private'},
+                'from': {'id': 1000000, 'is_bot': True, 'first_name': 'LoadTestBot'}, 'text': text or ''}
+
+    async def handle_method(self, request):
+        method = request.match_info['method']
+        params = await request.post()
+        self.calls[method] = self.calls.get(method, 0) + 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        chat_id = int(params['chat_id']) if 'chat_id' in params else None
+        if method in ('sendMessage', 'sendPhoto', 'sendDocument', 'editMessageText'):
+            if self.on_reply is not None and chat_id is not None:
+                self.on_reply(chat_id)
+            message_id = int(params['message_id']) if 'message_id' in params else None
+            result = self._message(chat_id, message_id, params.get('text'))
+        elif method == 'getFile':
+            file_id = params['file_id']
+            path, data = self.files[file_id]
+            result = {'file_id': file_id, 'file_unique_id': file_id, 'file_size': len(data), 'file_path': path}
+        elif method == 'getMe':
+            result = {'id': 1000000, 'is_bot': True, 'first_name': 'LoadTestBot', 'username': 'load_test_bot'}
+        else:
+            result = True
+        return web.json_response({'ok': True, 'result': result})
+
+    async def handle_file(self, request):
+        path = request.match_info['path']
+        for file_path, data in self.files.values():
+            if file_path == path:
+                return web.Response(body=data)
+        raise web.HTTPNotFound()
+
+    def app(self) -> web.Application:
+        app = web.Application(client_max_size=1024 ** 3)
+        app.router.add_post('/bot{token}/{method}', self.handle_method)
+        app.router.add_get('/file/bot{token}/{path:.+}', self.handle_file)
+        return app
+
+
+class FakeLLMServer:
+    """
+    Заглушка OpenAI-совместимого /v1/chat/completions. Первый токен приходит через latency секунд,
+    следующие - через token_delay; считает запросы и максимальное число одновременных запросов.
+    """
+
+    def __init__(self, latency: float, token_delay: float, tokens: int):
+        """
+        :param latency: Задержка до первого токена в секундах.
+        :param token_delay: Задержка между токенами в секундах.
+        :param tokens: Количество токенов в ответе.
+        """
+        self.latency = latency
+        self.token_delay = token_delay
+        self.tokens = tokens
+        self.requests = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def _usage(self) -> dict:
+        return {'prompt_tokens': 0, 'completion_tokens': self.tokens, 'total_tokens': self.tokens}
+
+    async def handle(self, request):
+        body = await request.json()
+        self.requests += 1
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(self.latency)
+            base = {'id': f'chatcmpl-{self.requests}', 'created': int(time.time()), 'model': body.get('model', '')}
+            if not body.get('stream'):
+                await asyncio.sleep(self.token_delay * max(self.tokens - 1, 0))
+                content = ' '.join(['ответ'] * self.tokens)
+                return web.json_response({**base, 'object': 'chat.completion', 'usage': self._usage(), 'choices': [
+                    {'index': 0, 'message': {'role': 'assistant', 'content': content}, 'finish_reason': 'stop'}]})
+
+            response = web.StreamResponse(headers={'Content-Type': 'text/event-stream'})
+            await response.prepare(request)
+            chunk = {**base, 'object': 'chat.completion.chunk'}
+            for i in range(self.tokens):
+                if i:
+                    await asyncio.sleep(self.token_delay)
+                delta = {'index': 0, 'delta': {'content': 'ответ '}, 'finish_reason': None}
+                await response.write(f'data: {json.dumps({**chunk, "choices": [delta]})}\n\n'.encode())
+            last = {'index': 0, 'delta': {}, 'finish_reason': 'stop'}
+            await response.write(f'data: {json.dumps({**chunk, "choices": [last]})}\n\n'.encode())
+            await response.write(f'data: {json.dumps({**chunk, "choices": [], "usage": self._usage()})}\n\n'.encode())
+            await response.write(b'data: [DONE]\n\n')
+            await response.write_eof()
+            return response
+        finally:
+            self.in_flight -= 1
+
+    def app(self) -> web.Application:
+        app = web.Application(client_max_size=64 * 1024 ** 2)
+        app.router.add_post('/v1/chat/completions', self.handle)
+        return app
+
+
+async def start_server(app: web.Application):
+    """Запускает приложение aiohttp на свободном порту localhost; возвращает runner и базовый адрес."""
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, '127.0.0.1', 0).start()
+    host, port = runner.addresses[0][:2]
+    return runner, f'http://{host}:{port}'
+
+
+def generate_wav(seconds: float, sample_rate: int = 16000) -> bytes:
+    """Синусоида 440 Гц в WAV: используется, если в TEST_FILES_DIR нет mp3."""
+    buffer = io.BytesIO()
+    with wave.open(buffer, 'wb') as file:
+        file.setnchannels(1)
+        file.setsampwidth(2)
+        file.setframerate(sample_rate)
+        file.writeframes(b''.join(struct.pack('<h', int(8000 * math.sin(2 * math.pi * 440 * i / sample_rate)))
+                                  for i in range(int(seconds * sample_rate))))
+    return buffer.getvalue()
+
+
+def generate_photo(seed: int, size: tuple = (1280, 960)) -> bytes:
+    """JPEG с детерминированным по seed узором; разные seed дают разные перцептивные хэши."""
+    from PIL import Image, ImageDraw
+
+    rng = random.Random(seed)
+    image = Image.new('RGB', size, tuple(rng.randrange(256) for _ in range(3)))
+    draw = ImageDraw.Draw(image)
+    for _ in range(40):
+        x, y = rng.randrange(size[0]), rng.randrange(size[1])
+        draw.rectangle((x, y, x + rng.randrange(50, 400), y + rng.randrange(50, 300)),
+                       fill=tuple(rng.randrange(256) for _ in range(3)))
+    buffer = io.BytesIO()
+    image.save(buffer, format='JPEG', quality=85)
+    return buffer.getvalue()
+
+
+class UpdateFactory:
+    """Создает обновления Telegram и регистрирует их файлы в заглушке Bot API."""
+
+    def __init__(self, telegram: FakeTelegramServer, args):
+        self.telegram = telegram
+        self.unique_files = args.unique_files
+        self.rng = random.Random(args.seed)
+        self.pdfs = [(os.path.basename(path), open(path, 'rb').read())
+                     for path in sorted(glob.glob(os.path.join(TEST_FILES_DIR, '*.pdf')))]
+        if not self.pdfs:
+            raise FileNotFoundError(f'В {TEST_FILES_DIR} нет PDF для нагрузочного теста')
+        mp3 = sorted(glob.glob(os.path.join(TEST_FILES_DIR, '*.mp3')))
+        self._audio_file = ('mp3', open(mp3[0], 'rb').read()) if mp3 else ('wav', generate_wav(args.audio_seconds))
+        self._photo_data = None if args.unique_files else generate_photo(args.seed)
+        self._ids = itertools.count(1)
+
+    def _message(self, user_id: int, **content) -> dict:
+        update_id = next(self._ids)
+        return {'update_id': update_id, 'message': {
+            'message_id': update_id, 'date': int(time.time()), 'chat': {'id': user_id, 'type': 'private'},
+            'from': {'id': user_id, 'is_bot': False, 'first_name': f'user{user_id}'}, **content}}
+
+    def _file(self, kind: str, extension: str, data: bytes) -> dict:
+        file_id = f'{kind}-{next(self._ids)}'
+        self.telegram.add_file(file_id, f'{kind}/{file_id}.{extension}', data)
+        return {'file_id': file_id, 'file_unique_id': file_id, 'file_size': len(data)}
+
+    def text(self, user_id: int) -> dict:
+        from benchmarks.run_benchmarks import QUERIES
+        return self._message(user_id, text=self.rng.choice(QUERIES))
+
+    def pdf(self, user_id: int, index: int = None) -> dict:
+        name, data = self.pdfs[self.rng.randrange(len(self.pdfs)) if index is None else index % len(self.pdfs)]
+        if self.unique_files:
+            # Комментарий после %%EOF не меняет документ, но меняет хэш, и бот не считает файл повтором
+            data += f'\n% load-test {next(self._ids)}\n'.encode()
+        document = self._file('documents', 'pdf', data)
+        return self._message(user_id, document={**document, 'file_name': name, 'mime_type': 'application/pdf'})
+
+    def audio(self, user_id: int) -> dict:
+        extension, data = self._audio_file
+        audio = self._file('music', extension, data)
+        return self._message(user_id, audio={**audio, 'duration': 1, 'file_name': f'load.{extension}',
+                                             'mime_type': f'audio/{"mpeg" if extension == "mp3" else extension}'})
+
+    def photo(self, user_id: int) -> dict:
+        data = self._photo_data or generate_photo(next(self._ids))
+        photo = self._file('photos', 'jpg', data)
+        return self._message(user_id, photo=[{**photo, 'width': 1280, 'height': 960}], caption=IMAGE_QUERY)
+
+
+class Sample:
+    """Замеры одного обновления; время - time.perf_counter()."""
+    __slots__ = ('kind', 'user_id', 'arrival', 'handler', 'started', 'first_reply', 'finished', 'error')
+
+    def __init__(self, kind: str, user_id: int, arrival: float):
+        self.kind = kind
+        self.user_id = user_id
+        self.arrival = arrival
+        self.handler = self.started = self.first_reply = self.finished = self.error = None
+
+
+class LoadTest:
+    """Подает обновления в Dispatcher бота и собирает замеры."""
+
+    def __init__(self, bot_runner, factory: UpdateFactory, telegram: FakeTelegramServer, args):
+        self.bot_runner = bot_runner
+        self.factory = factory
+        self.args = args
+        self.samples = []
+        self.lags = []
+        self._current = {}
+        self._awaiting_reply = {}
+        self._tasks = set()
+        telegram.on_reply = self._on_reply
+        bot_runner.dp.message.middleware(self._handler_middleware)
+        bot_runner.dp.callback_query.middleware(self._handler_middleware)
+
+    async def _handler_middleware(self, handler, event, data):
+        # Внутренний middleware выполняется после фильтров и ограничения параллелизма, прямо перед обработчиком
+        sample = self._current.get(data['event_update'].update_id)
+        if sample is not None:
+            sample.handler = data['handler'].callback.__name__
+            sample.started = time.perf_counter()
+        return await handler(event, data)
+
+    def _on_reply(self, chat_id: int):
+        pending = self._awaiting_reply.get(chat_id)
+        if pending:
+            pending.pop(0).first_reply = time.perf_counter()
+
+    async def _feed(self, sample: Sample, update: dict):
+        self._current[update['update_id']] = sample
+        self._awaiting_reply.setdefault(sample.user_id, []).append(sample)
+        try:
+            await self.bot_runner.dp.feed_raw_update(self.bot_runner.bot, update)
+        except Exception as ex:
+            sample.error = f'{type(ex).__name__}: {ex}'
+        finally:
+            sample.finished = time.perf_counter()
+            del self._current[update['update_id']]
+            pending = self._awaiting_reply[sample.user_id]
+            if sample in pending:
+                pending.remove(sample)
+
+    def submit(self, kind: str, user_id: int, update: dict = None, record: bool = True) -> asyncio.Task:
+        sample = Sample(kind, user_id, time.perf_counter())
+        if record:
+            self.samples.append(sample)
+        task = asyncio.create_task(self._feed(sample, update or getattr(self.factory, kind)(user_id)))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    async def monitor_loop(self, interval: float):
+        """Замеряет задержку цикла событий: насколько позже заданного просыпается sleep(interval)."""
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(interval)
+            self.lags.append(max(time.perf_counter() - start - interval, 0.0))
+
+    async def generate(self, kind: str, rate: float, duration: float, rng: random.Random):
+        """Подает обновления одного типа с интенсивностью rate в секунду (пуассоновский или равномерный поток)."""
+        deadline = time.perf_counter() + duration
+        next_at = time.perf_counter()
+        while True:
+            next_at += rng.expovariate(rate) if self.args.arrivals == 'poisson' else 1 / rate
+            if next_at >= deadline:
+                return
+            await asyncio.sleep(max(next_at - time.perf_counter(), 0))
+            self.submit(kind, rng.randrange(self.args.users) + 1)
+
+    async def drain(self, timeout: float) -> int:
+        """Ждет завершения поданных обновлений; возвращает количество незавершенных."""
+        if self._tasks:
+            await asyncio.wait(set(self._tasks), timeout=timeout)
+        return len(self._tasks)
+
+
+def parse_rates(text: str) -> dict:
+    rates = {}
+    for item in filter(None, (part.strip() for part in text.split(','))):
+        kind, _, value = item.partition('=')
+        if kind not in KINDS:
+            raise argparse.ArgumentTypeError(f'Неизвестный тип обновления {kind}; допустимы: {", ".join(KINDS)}')
+        rates[kind] = float(value)
+    return rates
+
+
+def summarize(samples: list, lags: list, elapsed: float) -> dict:
+    from benchmarks.run_benchmarks import percentile
+
+    def stats(values: list, prefix: str) -> dict:
+        return {f'{prefix}_p50_ms': percentile(values, 50) * 1000, f'{prefix}_p99_ms': percentile(values, 99) * 1000,
+                f'{prefix}_max_ms': max(values, default=0.0) * 1000}
+
+    handlers, kinds = {}, {}
+    for sample in samples:
+        kind = kinds.setdefault(sample.kind, {'sent': 0, 'completed': 0, 'rejected': 0, 'unfinished': 0,
+                                              'errors': 0, 'e2e': []})
+        kind['sent'] += 1
+        if sample.finished is None:
+            kind['unfinished'] += 1
+            continue
+        kind['completed'] += 1
+        kind['errors'] += sample.error is not None
+        kind['e2e'].append(sample.finished - sample.arrival)
+        if sample.started is None:
+            # Обработчик не вызывался: запрос отклонен ограничением параллелизма пользователя
+            kind['rejected'] += 1
+            continue
+        handler = handlers.setdefault(sample.handler, {'count': 0, 'queue': [], 'e2e': [], 'first_reply': []})
+        handler['count'] += 1
+        handler['queue'].append(sample.started - sample.arrival)
+        handler['e2e'].append(sample.finished - sample.arrival)
+        if sample.first_reply is not None:
+            handler['first_reply'].append(sample.first_reply - sample.arrival)
+
+    return {
+        'handlers': {name: {'count': data['count'], 'throughput_per_s': data['count'] / elapsed,
+                            **stats(data['queue'], 'queue'), **stats(data['e2e'], 'e2e'),
+                            **stats(data['first_reply'], 'first_reply')}
+                     for name, data in sorted(handlers.items())},
+        'kinds': {name: {**{key: value for key, value in data.items() if key != 'e2e'}, **stats(data['e2e'], 'e2e')}
+                  for name, data in sorted(kinds.items())},
+        'event_loop_lag': {'samples': len(lags), **stats(lags, 'lag')},
+    }
+
+
+async def run(args, rates: dict) -> dict:
+    telegram = FakeTelegramServer(args.telegram_latency)
+    llm = FakeLLMServer(args.llm_latency, args.llm_token_delay, args.llm_tokens)
+    telegram_runner, telegram_url = await start_server(telegram.app())
+    llm_runner, llm_url = await start_server(llm.app())
+    store_dir = tempfile.mkdtemp(prefix='llmds_load_')
+    # Настройки бота читаются при импорте, поэтому окружение задается до импорта bot_runner
+    os.environ.update({
+        'BOT_TOKEN': FAKE_BOT_TOKEN, 'GPT_TOKEN': 'load-test', 'OPENAI_BASE_URL': f'{llm_url}/v1',
+        'BOT_MODE': 'polling', 'STORAGE_BACKEND': 'local', 'LOCAL_STORE_PATH': store_dir, 'METRICS_PORT': '0',
+    })
+    os.environ.setdefault('STATE_BACKEND', 'memory')
+
+    from aiogram.client.session.aiohttp import AiohttpSession
+    from aiogram.client.telegram import TelegramAPIServer
+    import bot_runner
+    from benchmarks.run_benchmarks import peak_rss_mb
+    from src.log.tracing import metrics
+
+    bot_runner.bot.session = AiohttpSession(api=TelegramAPIServer.from_base(telegram_url))
+    factory = UpdateFactory(telegram, args)
+    test = LoadTest(bot_runner, factory, telegram, args)
+    monitor = None
+    try:
+        await bot_runner.registry.ensure_index()
+        if bot_runner.settings.warmup_models:
+            await bot_runner.warm_up_models(bot_runner.settings.warmup_models)
+        preload_start = time.perf_counter()
+        if args.preload and bot_runner.ingest_pool is not None:
+            # Каждому пользователю заранее загружается документ, чтобы вопросы доходили до GPT
+            await asyncio.gather(*(test.submit('pdf', user_id, factory.pdf(user_id, user_id), record=False)
+                                   for user_id in range(1, args.users + 1)))
+        preload_s = time.perf_counter() - preload_start
+        metrics.reset()  # в отчет попадают только этапы измеряемого прогона
+
+        monitor = asyncio.create_task(test.monitor_loop(args.lag_interval))
+        rng = random.Random(args.seed)
+        start = time.perf_counter()
+        await asyncio.gather(*(test.generate(kind, rate, args.duration, random.Random(rng.random()))
+                               for kind, rate in rates.items() if rate > 0))
+        unfinished = await test.drain(args.drain_timeout)
+        elapsed = time.perf_counter() - start
+    finally:
+        if monitor is not None:
+            monitor.cancel()
+        for pool in (bot_runner.audio_pool, bot_runner.ingest_pool):
+            if pool is not None:
+                pool.shutdown()
+        await bot_runner.storage.close()
+        await bot_runner.bot.session.close()
+        await telegram_runner.cleanup()
+        await llm_runner.cleanup()
+        shutil.rmtree(store_dir, ignore_errors=True)
+
+    return {
+        'elapsed_s': elapsed,
+        'preload_s': preload_s,
+        'unfinished': unfinished,
+        **summarize(test.samples, test.lags, elapsed),
+        'llm': {'requests': llm.requests, 'max_in_flight': llm.max_in_flight},
+        'telegram_calls': dict(sorted(telegram.calls.items())),
+        'stages': metrics.snapshot(),
+        'peak_rss_mb': peak_rss_mb(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rate', type=parse_rates, default='text=2,pdf=0.05,audio=0.05,photo=0.2',
+                        help='Интенсивность по типам в обновлениях в секунду: ' + ', '.join(f'{k}=N' for k in KINDS))
+    parser.add_argument('--arrivals', choices=('poisson', 'constant'), default='poisson', help='Поток обновлений')
+    parser.add_argument('--duration', type=float, default=60, help='Сколько секунд подавать обновления')
+    parser.add_argument('--drain-timeout', type=float, default=300, help='Сколько ждать завершения после подачи')
+    parser.add_argument('--users', type=int, default=20, help='Количество пользователей')
+    parser.add_argument('--no-preload', dest='preload', action='store_false',
+                        help='Не загружать каждому пользователю документ перед прогоном')
+    parser.add_argument('--no-unique-files', dest='unique_files', action='store_false',
+                        help='Отправлять одинаковые файлы (срабатывают проверка повторов и кэш изображений)')
+    parser.add_argument('--llm-latency', type=float, default=0.5, help='Задержка заглушки GPT до первого токена')
+    parser.add_argument('--llm-token-delay', type=float, default=0.02, help='Задержка заглушки GPT между токенами')
+    parser.add_argument('--llm-tokens', type=int, default=100, help='Длина ответа заглушки GPT в токенах')
+    parser.add_argument('--telegram-latency', type=float, default=0.05, help='Задержка ответа заглушки Bot API')
+    parser.add_argument('--audio-seconds', type=float, default=10, help='Длина аудио, если в тестовых файлах нет mp3')
+    parser.add_argument('--lag-interval', type=float, default=0.05, help='Период замера задержки цикла событий')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='Файл для результатов в JSON')
+    args = parser.parse_args()
+    logging.getLogger('aiohttp.access').setLevel(logging.WARNING)
+
+    results = asyncio.run(run(args, args.rate))
+    report = {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'config': {key: value for key, value in vars(args).items() if key != 'output'},
+        'results': results,
+    }
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as file:
+            file.write(text)
+
+
+if __name__ == '__main__':
+    main()
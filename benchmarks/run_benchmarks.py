@@ -0,0 +1,269 @@
+"""
+Бенчмарк загрузки документов, поиска, ответа на вопросы и распознавания речи
+на файлах из data/input/files_for_test.
+
+Вместо GPT используется локальная заглушка с настраиваемой задержкой, поиск выполняется
+во временном индексе локального Elasticsearch (settings.elk_url), который удаляется после прогона.
+
+Запуск из корня репозитория:
+    python -m benchmarks.run_benchmarks --output bench.json
+    python -m benchmarks.run_benchmarks --output new.json --baseline bench.json --tolerance 0.15
+"""
+import argparse
+import asyncio
+import glob
+import json
+import math
+import os
+import platform
+import sys
+import time
+from types import SimpleNamespace
+
+from src.configs import settings
+
+TEST_FILES_DIR = 'data/input/files_for_test'
+BENCH_INDEX = 'llmds_bench'
+QUERIES = [
+    'олимпиада 1980 бойкот',
+    'почему страны отказались участвовать в олимпийских играх в москве',
+    'дом наркомфина архитектор гинзбург',
+    'сохранение памятников конструктивизма',
+    'какое решение приняли по реконструкции дома наркомфина',
+]
+STAGES = ('ingest', 'retrieval', 'answer', 'transcribe')
+
+
+def percentile(values: list, q: float) -> float:
+    """Перцентиль по методу ближайшего ранга."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, math.ceil(q / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def latency_stats(samples: list) -> dict:
+    """Сводка по задержкам в миллисекундах."""
+    total = sum(samples)
+    return {
+        'count': len(samples),
+        'p50_ms': percentile(samples, 50) * 1000,
+        'p95_ms': percentile(samples, 95) * 1000,
+        'mean_ms': total / len(samples) * 1000 if samples else 0.0,
+        'throughput_per_s': len(samples) / total if total else 0.0,
+    }
+
+
+def peak_rss_mb() -> float:
+    """Пиковое потребление памяти процессом в МБ."""
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / 2 ** 20 if sys.platform == 'darwin' else peak / 1024
+    except ImportError:
+        import psutil
+        return psutil.Process().memory_info().peak_wset / 2 ** 20
+
+
+class FakeCompletions:
+    """Заглушка chat.completions: отвечает через заданную задержку, не обращаясь к сети."""
+
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.calls = 0
+
+    async def create(self, **kwargs):
+        self.calls += 1
+        await asyncio.sleep(self.latency)
+        message = SimpleNamespace(content='Тестовый ответ заглушки.')
+        return SimpleNamespace(choices=[SimpleNamespace(message=message)],
+                               usage=SimpleNamespace(prompt_tokens=0, completion_tokens=0))
+
+
+def bench_ingest(es, args) -> dict:
+    from src.modules.embedding import HuggingFaceE5Embeddings, create_embedding
+    from src.modules.ingestion import DocumentIngestor
+
+    embedding = create_embedding() if args.emb_cache else HuggingFaceE5Embeddings(model_name=settings.emb_model_name)
+    ingestor = DocumentIngestor(es, BENCH_INDEX, embedding=embedding)
+    result = {'documents': {}}
+    pages = chunks = 0
+    start = time.perf_counter()
+    for path in sorted(glob.glob(os.path.join(TEST_FILES_DIR, '*.pdf'))):
+        doc_start = time.perf_counter()
+        report = ingestor.ingest_pdf(path, {'doc_owner': 0, 'doc_id': os.path.basename(path),
+                                            'file_name': os.path.basename(path)})
+        result['documents'][os.path.basename(path)] = {
+            'pages': report.pages, 'chunks': report.chunks, 'total_s': time.perf_counter() - doc_start,
+            **{f'{stage}_s': seconds for stage, seconds in report.timings.items()},
+        }
+        pages += report.pages
+        chunks += report.chunks
+    elapsed = time.perf_counter() - start
+    result.update({'total_s': elapsed, 'pages_per_s': pages / elapsed, 'chunks_per_s': chunks / elapsed,
+                   'peak_rss_mb': peak_rss_mb()})
+    return result
+
+
+async def _bench_retrieval(args) -> dict:
+    from src.modules.elastic import Elastic, BM25Handler, HybridHandler
+
+    elastic = Elastic()
+    try:
+        retrievers = {'bm25': BM25Handler(elastic.es, BENCH_INDEX)}
+        if 'hybrid' in args.modes:
+            retrievers['hybrid'] = HybridHandler(elastic.es, BENCH_INDEX)
+        result = {}
+        for name, retriever in retrievers.items():
+            await retriever.asimilarity_search_with_relevance_scores(query=QUERIES[0])  # прогрев
+            samples = []
+            for _ in range(args.repeat):
+                for query in QUERIES:
+                    start = time.perf_counter()
+                    await retriever.asimilarity_search_with_relevance_scores(query=query, k=settings.retrieval_top_k)
+                    samples.append(time.perf_counter() - start)
+            result[name] = latency_stats(samples)
+    finally:
+        await elastic.close()
+    result['peak_rss_mb'] = peak_rss_mb()
+    return result
+
+
+def bench_retrieval(args) -> dict:
+    return asyncio.run(_bench_retrieval(args))
+
+
+async def _bench_answer(args) -> dict:
+    from src.modules import gpt_handler
+    from src.modules.elastic import Elastic, BM25Handler
+
+    completions = FakeCompletions(args.llm_latency)
+    gpt_handler.async_client = SimpleNamespace(chat=SimpleNamespace(completions=completions))
+    elastic = Elastic()
+    retriever = BM25Handler(elastic.es, BENCH_INDEX)
+    samples = []
+    try:
+        for _ in range(args.repeat):
+            for query in QUERIES:
+                start = time.perf_counter()
+                documents = await retriever.asimilarity_search_with_relevance_scores(query=query,
+                                                                                     k=settings.retrieval_top_k)
+                await gpt_handler.answer_question([doc.page_content for doc, _ in documents], query)
+                samples.append(time.perf_counter() - start)
+    finally:
+        await elastic.close()
+    return {**latency_stats(samples), 'llm_latency_s': args.llm_latency,
+            'llm_calls_per_answer': completions.calls / len(samples), 'peak_rss_mb': peak_rss_mb()}
+
+
+def bench_answer(args) -> dict:
+    return asyncio.run(_bench_answer(args))
+
+
+def bench_transcribe(args) -> dict:
+    import librosa
+    from src.modules.whisper_handler import WhisperHandler, SAMPLE_RATE
+
+    start = time.perf_counter()
+    handler = WhisperHandler()
+    result = {'model_load_s': time.perf_counter() - start, 'files': {}}
+    for path in sorted(glob.glob(os.path.join(TEST_FILES_DIR, '*.mp3'))):
+        duration = librosa.get_duration(path=path, sr=SAMPLE_RATE)
+        start = time.perf_counter()
+        handler.transcribe_audio(path)
+        elapsed = time.perf_counter() - start
+        result['files'][os.path.basename(path)] = {'audio_s': duration, 'total_s': elapsed,
+                                                   'realtime_factor': elapsed / duration if duration else 0.0}
+    result['peak_rss_mb'] = peak_rss_mb()
+    return result
+
+
+def flatten(data: dict, prefix: str = '') -> dict:
+    flat = {}
+    for key, value in data.items():
+        name = f'{prefix}.{key}' if prefix else key
+        if isinstance(value, dict):
+            flat.update(flatten(value, name))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[name] = value
+    return flat
+
+
+def compare(current: dict, baseline: dict, tolerance: float) -> list:
+    """
+    Сравнивает два прогона. Метрики *_per_s считаются тем лучше, чем больше,
+    время и память - тем лучше, чем меньше.
+
+    :return: Список описаний регрессий, превысивших допуск.
+    """
+    regressions = []
+    current_flat, baseline_flat = flatten(current['results']), flatten(baseline['results'])
+    for name, old in baseline_flat.items():
+        new = current_flat.get(name)
+        if new is None or not old or name.endswith(('count', 'pages', 'chunks', 'audio_s', 'llm_latency_s')):
+            continue
+        higher_is_better = name.endswith('_per_s')
+        change = (new - old) / old
+        if (-change if higher_is_better else change) > tolerance:
+            regressions.append(f'{name}: {old:.4g} -> {new:.4g} ({change:+.1%})')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--stages', default=','.join(STAGES), help='Этапы через запятую: ' + ', '.join(STAGES))
+    parser.add_argument('--modes', default='bm25,hybrid', help='Режимы поиска через запятую: bm25, hybrid')
+    parser.add_argument('--repeat', type=int, default=5, help='Сколько раз повторить набор запросов')
+    parser.add_argument('--llm-latency', type=float, default=0.2, help='Задержка заглушки GPT в секундах')
+    parser.add_argument('--emb-cache', action='store_true', help='Использовать кэш эмбеддингов при загрузке')
+    parser.add_argument('--output', help='Файл для результатов в JSON')
+    parser.add_argument('--baseline', help='JSON предыдущего прогона для сравнения')
+    parser.add_argument('--tolerance', type=float, default=0.15, help='Допустимое ухудшение метрики (доля)')
+    args = parser.parse_args()
+    stages = [stage.strip() for stage in args.stages.split(',') if stage.strip()]
+
+    results = {}
+    es = None
+    if set(stages) & {'ingest', 'retrieval', 'answer'}:
+        from src.modules.elastic import Elastic, create_sync_client
+        es = create_sync_client()
+        es.indices.delete(index=BENCH_INDEX, ignore_unavailable=True)
+        es.indices.create(index=BENCH_INDEX, **Elastic.build_index_body())
+    try:
+        if 'ingest' in stages:
+            results['ingest'] = bench_ingest(es, args)
+        if 'retrieval' in stages:
+            results['retrieval'] = bench_retrieval(args)
+        if 'answer' in stages:
+            results['answer'] = bench_answer(args)
+        if 'transcribe' in stages:
+            results['transcribe'] = bench_transcribe(args)
+    finally:
+        if es is not None:
+            es.indices.delete(index=BENCH_INDEX, ignore_unavailable=True)
+            es.close()
+
+    report = {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'results': results,
+    }
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as file:
+            file.write(text)
+
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as file:
+            regressions = compare(report, json.load(file), args.tolerance)
+        if regressions:
+            print('Регрессии относительно базового прогона:', *regressions, sep='\n  ', file=sys.stderr)
+            sys.exit(1)
+        print('Регрессий относительно базового прогона не найдено', file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
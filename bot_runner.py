@@ -1,73 +1,158 @@
+import time
 import uuid
 import asyncio
+import multiprocessing
+from functools import partial
 
+from aiohttp import web
 from aiogram import Bot, Dispatcher, types, F
 from aiogram.types import InlineKeyboardButton
 from aiogram.filters import CommandStart, Command
 from aiogram.utils.keyboard import InlineKeyboardBuilder
-from langchain_community.document_loaders import PyPDFLoader
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
 
 from src.configs import settings
-from src.modules.elastic import Elastic, BM25Handler, EsHandler
-from src.modules.gpt_handler import ask_gpt_about_fragment, summarize_answers, ask_gpt_about_image
-from src.modules.whisper_handler import WhisperHandler
-from src.modules.transformer import TextRefactor
+from src.modules.answer_cache import AnswerCache, chunk_ids
+from src.modules.embedding import get_embedding
+from src.modules.model_registry import models
+from src.modules.storage import create_storage
+from src.modules.image_pipeline import ImageAnswerCache, prepare_image
+from src.modules.gpt_handler import (answer_question, ask_gpt_about_image, astream_answer, astream_image_answer,
+                                     FRAGMENT_ERROR_ANSWER, SUMMARY_ERROR_ANSWER, IMAGE_ERROR_ANSWER)
+from src.modules.shared_state import SharedFSMStorage, UserConcurrencyMiddleware, create_state_store
+from src.modules.uploads import Upload, download_upload
+from src.modules.telegram_stream import TELEGRAM_MESSAGE_LIMIT, _edit, split_message, stream_reply
+from src.modules.workers import WorkerPool, QueueFullError, transcribe_job, ingest_pdf_job, warm_up_job
 from src.log.logger_base import selector_logger
+from src.log.tracing import TraceMiddleware, span, record, serve_metrics, dump_metrics_periodically
 
 bot = Bot(token=settings.bot_token)
-dp = Dispatcher()
+state_store = create_state_store()
+dp = Dispatcher(storage=SharedFSMStorage(state_store))
+dp.update.outer_middleware(TraceMiddleware())
+dp.message.middleware(UserConcurrencyMiddleware(state_store))
+dp.callback_query.middleware(UserConcurrencyMiddleware(state_store))
 
 logger = selector_logger('bot_runner', settings.LOG_LEVEL_INFO)
 
-temp_storage = {}
-elastic = Elastic()
-transformers_obj = TextRefactor()
-whisper_handler = WhisperHandler()
-es_handler = EsHandler(elastic.es, settings.elk_index)
+CAPABILITY_DISABLED_ANSWER = 'Этот тип сообщений не поддерживается, отправьте текстовый вопрос.'
 
+storage = create_storage()
+audio_pool = WorkerPool('audio', settings.audio_workers, settings.worker_queue_size) if settings.enable_audio else None
+registry = storage.registry
+answer_cache = AnswerCache() if settings.answer_cache_enabled else None
+image_cache = ImageAnswerCache() if settings.image_cache_enabled and settings.enable_image else None
+# Встроенное хранилище общее на процесс, поэтому загрузка в него идет в пуле потоков
+ingest_kind = 'thread' if settings.storage_backend == 'local' else settings.worker_pool_kind
+ingest_pool = (WorkerPool('ingest', settings.ingest_workers, settings.worker_queue_size, kind=ingest_kind)
+               if settings.enable_ingest else None)
+retriever = storage.retriever
 
-def shrink_doc_id(doc_file_id: str):
+
+def _doc_token_key(owner, token: str) -> str:
+    return f'doc_token:{owner}:{token}'
+
+
+async def shrink_doc_id(owner, doc_file_id: str):
     """
     Уменьшает длину идентификатора документа для использования в callback_data.
+    Соответствие хранится в общем хранилище состояния CALLBACK_TOKEN_TTL секунд отдельно для каждого пользователя,
+    поэтому кнопки одного пользователя не устаревают из-за действий другого и работают в любом процессе бота.
 
+    :param owner: Идентификатор пользователя.
     :param doc_file_id: Идентификатор документа.
     :return: Сокращенный уникальный идентификатор.
     """
-    data_id = str(uuid.uuid4())
-    temp_storage[data_id] = doc_file_id
+    data_id = uuid.uuid4().hex
+    await state_store.set(_doc_token_key(owner, data_id), doc_file_id, settings.callback_token_ttl)
     logger.info(f"Файл: {doc_file_id}, записан как: {data_id}")
     return data_id
 
 
-async def download_file(file_id, user_id):
+async def notify_queued(message: types.Message, position: int):
+    """
+    Сообщает пользователю, что его задача ожидает в очереди.
+
+    :param message: Сообщение пользователя, на которое нужно ответить.
+    :param position: Позиция задачи в очереди.
+    """
+    await message.answer(f"Задача поставлена в очередь, позиция {position}")
+
+
+def partial_transcription_callback(placeholder: types.Message):
+    """
+    Создает callback для воркера распознавания, который показывает уже распознанный текст
+    в сообщении-заглушке. Вызывается из потока воркера, поэтому редактирование передается в цикл событий.
+
+    :param placeholder: Сообщение, которое будет редактироваться.
+    :return: Функция, принимающая распознанный на данный момент текст.
+    """
+    loop = asyncio.get_running_loop()
+
+    def on_partial(text: str):
+        tail = text[-(TELEGRAM_MESSAGE_LIMIT - 100):]
+        future = asyncio.run_coroutine_threadsafe(
+            placeholder.edit_text(f"Распознаю... {'…' if len(tail) < len(text) else ''}{tail}"), loop)
+        future.add_done_callback(lambda f: f.exception())  # ошибки редактирования не важны
+    return on_partial
+
+
+def ingest_progress_callback(placeholder: types.Message):
+    """
+    Создает callback для воркера загрузки, который показывает в сообщении-заглушке номер обработанной страницы.
+    Правки выполняются не чаще ingest_progress_interval секунд; вызывается из потока воркера.
+
+    :param placeholder: Сообщение, которое будет редактироваться.
+    :return: Функция, принимающая количество обработанных и всех страниц.
+    """
+    loop = asyncio.get_running_loop()
+    last_edit = 0.0
+
+    def on_progress(page: int, total: int):
+        nonlocal last_edit
+        now = time.monotonic()
+        if now - last_edit < settings.ingest_progress_interval or page == total:
+            return
+        last_edit = now
+        future = asyncio.run_coroutine_threadsafe(
+            placeholder.edit_text(f"Обрабатываю страницу {page}/{total or '?'}"), loop)
+        future.add_done_callback(lambda f: f.exception())  # ошибки редактирования не важны
+    return on_progress
+
+
+async def download_file(file_id, user_id, force_file: bool = False) -> Upload:
+    """
+    Загружает файл пользователя в память (или во временный файл, если он больше UPLOAD_MEMORY_LIMIT).
+
+    :param file_id: Идентификатор файла в Telegram.
+    :param user_id: Идентификатор пользователя.
+    :param force_file: Всегда сохранять во временный файл.
+    :return: Загруженный файл; после обработки его нужно закрыть.
+    """
     file = await bot.get_file(file_id)
     file_type = file.file_path.split(".")[-1]
-    file_name = f'{user_id}@{file_id}.{file_type}'
-    local_file_path = f'data/input/{file_name}'
-    await bot.download_file(file_path=file.file_path, destination=local_file_path)
-    return file_name, local_file_path
+    return await download_upload(bot, file.file_path, f'{user_id}@{file_id}.{file_type}', force_file)
 
 
 @dp.message(CommandStart())
 async def command_start_handler(message: types.Message):
     """
     Обработка команды /start.
-    Проверяет статус индекса в Elasticsearch, очищает или создает его, если необходимо.
-    Отправляет пользователю сообщение о статусе подготовки базы данных.
+    Очищает хранилище фрагментов (индекс Elasticsearch или встроенное хранилище) и реестр документов,
+    создавая их, если необходимо. Отправляет пользователю сообщение о статусе подготовки базы данных.
 
     :param message: Объект сообщения от пользователя. Default
     """
-    logger.info("Проверка статуса Elastic")
-    await message.answer("Проверка статуса Elastic")
-    if elastic.delete_index(settings.elk_index):
-        logger.info(f"Индекс {settings.elk_index} очищен")
+    logger.info("Проверка статуса хранилища")
+    await message.answer("Проверка статуса хранилища")
+    if await storage.reset():
+        logger.info("Хранилище очищено")
         await message.answer("Индекс очищен")
     else:
-        logger.info(f"Индекс {settings.elk_index} не обнаружен, запущен процесс создания")
-        await message.answer("Индекс не обнаружен, запущен процесс создания")
-    elastic.create_index(settings.elk_index)
-    logger.info("Elastic готов к работе")
-    await message.answer("Elastic готов к работе")
+        logger.info("Хранилище не обнаружено, создано заново")
+        await message.answer("Индекс не обнаружен, создан заново")
+    logger.info("Хранилище готово к работе")
+    await message.answer("База знаний готова к работе")
 
 
 @dp.message(F.audio)
@@ -78,13 +163,30 @@ async def handle_audio_message(message: types.Message):
     :param message: Объект сообщения с аудиофайлом от пользователя.
     """
     user = message.from_user
+    if audio_pool is None:
+        await message.answer(CAPABILITY_DISABLED_ANSWER)
+        return
     try:
         logger.info(f"Пользователь {user.id} отправил аудиофайл для распознавания")
         file_id = message.audio.file_id
-        file_name, local_file_path = await download_file(file_id, user.id)
-        transcription = whisper_handler.transcribe_audio(local_file_path)
-        await message.answer(f"Распознанный текст: {transcription}")
+        # Аудио всегда сохраняется в файл: форматы, которые не читает libsndfile, librosa декодирует только по пути
+        with await download_file(file_id, user.id, force_file=True) as upload:
+            file_name = upload.file_name
+            placeholder, on_partial = None, None
+            if settings.whisper_stream_partial and settings.worker_pool_kind == 'thread':
+                placeholder = await message.answer("Распознаю...")
+                on_partial = partial_transcription_callback(placeholder)
+            with span('transcribe_audio'):
+                transcription = await audio_pool.run(transcribe_job, upload.source, on_partial,
+                                                     on_queued=partial(notify_queued, message))
+        if placeholder is not None:
+            await placeholder.delete()
+        for part in split_message(f"Распознанный текст: {transcription}"):
+            await message.answer(part)
         logger.info(f"Транскрипция аудиофайла {file_name} завершена")
+    except QueueFullError as ex:
+        logger.warning(f"Аудиофайл от пользователя {user.id} отклонен: {ex}")
+        await message.answer("Сейчас слишком много задач в обработке, попробуйте снова чуть позже.")
     except Exception as ex:
         logger.error(f"Ошибка при обработке аудиофайла от пользователя {user.id}: {ex}")
         await message.answer("Произошла ошибка во время обработки вашего аудиофайла, попробуйте снова чуть позже.")
@@ -94,47 +196,56 @@ async def handle_audio_message(message: types.Message):
 async def doc_handler(message: types.Message):
     """
     Обработка команды /delete_doc.
-    Находит все документы, принадлежащие пользователю, и предлагает удалить один из них.
+    Берет документы пользователя из реестра и предлагает удалить один из них.
     Отправляет пользователю клавиатуру с возможностью выбрать документ для удаления.
 
     :param message: Объект сообщения от пользователя.
     """
-    query = {"bool": {"must": [{"term": {"metadata.doc_owner": message.from_user.id}}]}}
-    all_users_docs = elastic.es.search(index=settings.elk_index, query=query, size=1000, scroll='3m')
-    scroll_id = all_users_docs['_scroll_id']
-    hits = all_users_docs['hits']['hits']
-
-    while len(all_users_docs['hits']['hits']) > 0:
-        all_users_docs = elastic.es.scroll(scroll_id=scroll_id, scroll='3m')
-        scroll_id = all_users_docs['_scroll_id']
-        hits.extend(all_users_docs['hits']['hits'])
-    temp_storage.clear()  # Очистим временное хранилище во избежание переполнения
-    all_unic_docs = set([(hit['_source']['metadata']['file_name'],
-                          hit['_source']['metadata']['doc_id']) for hit in hits])
-    logger.info(f"{len(hits)} - записей у пользователя: {message.from_user.id}, на {all_unic_docs} документов")
+    owner = message.from_user.id
+    documents = await registry.list(owner)
+    logger.info(f"У пользователя {owner} в реестре {len(documents)} документов")
+    if not documents:
+        await message.answer("В базе знаний нет ваших документов")
+        return
     keyboard = InlineKeyboardBuilder()
-    for doc in all_unic_docs:
-        token = shrink_doc_id(doc[1])
-        keyboard.add(InlineKeyboardButton(text=doc[0], callback_data=f"@@_{token}"))
+    for doc in documents:
+        token = await shrink_doc_id(owner, doc['doc_id'])
+        keyboard.add(InlineKeyboardButton(text=doc['file_name'], callback_data=f"@@_{token}"))
     await message.answer("Выберете документ для удаления:", reply_markup=keyboard.as_markup())
 
 
 @dp.callback_query(F.data.startswith('@@_'))
 async def delete_document(call: types.CallbackQuery):
     """
-    Удаляет выбранный документ из базы данных Elasticsearch.
+    Удаляет выбранный документ из базы данных Elasticsearch фоновой задачей, показывая прогресс.
 
     :param call: Объект callback-запроса от пользователя.
     """
     uid = call.data.replace('@@_', '')
-    doc_id = temp_storage.get(uid)
+    doc_id = await state_store.get(_doc_token_key(call.from_user.id, uid))
+    if doc_id is None:
+        await bot.send_message(call.from_user.id, 'Список документов устарел, вызовите /delete_doc еще раз')
+        return
     try:
-        query = {"query": {"bool": {"must": [{"match": {"metadata.doc_id": doc_id}},
-                                             {"match": {"metadata.doc_owner": str(call.from_user.id)}}]}}}
-        elastic.es.delete_by_query(index=settings.elk_index, body=query)
-        await bot.send_message(call.from_user.id, f'Документ успешно удален из базы знаний')
+        owner = call.from_user.id
+        status_message = await bot.send_message(owner, 'Удаление документа запущено')
+
+        shown = None
+
+        async def report_progress(deleted: int, total: int):
+            nonlocal shown
+            # Правку с тем же текстом Telegram отклоняет; ограничение частоты правок обрабатывает _edit
+            if (deleted, total) == shown:
+                return
+            if not await _edit(status_message, f'Удалено фрагментов: {deleted} из {total}'):
+                shown = deleted, total
+
+        deleted = await registry.delete(owner, doc_id, on_progress=report_progress)
+        if answer_cache is not None:
+            answer_cache.invalidate_owner(owner)
+        await status_message.edit_text(f'Документ успешно удален из базы знаний, фрагментов: {deleted}')
         logger.info(f"У пользователя {call.from_user.id} успешно удален документ: {doc_id}")
-        del temp_storage[uid]
+        await state_store.delete(_doc_token_key(owner, uid))
     except Exception as ex:
         await bot.send_message(call.from_user.id, f'Документ удалить не удалось, ошибка: {ex}')
         logger.error(f"Не удалось удалить документ {doc_id} у пользователя {call.from_user.id}: {ex}")
@@ -144,86 +255,283 @@ async def delete_document(call: types.CallbackQuery):
 async def handle_image_message(message: types.Message):
     """
     Обработка изображений, отправленных пользователем.
-    Сохраняет изображение, отправляет его в GPT для анализа и возвращает ответ пользователю.
+    Сохраняет изображение, уменьшает и пережимает его, отправляет в GPT для анализа и возвращает ответ пользователю.
+    Ответы на одинаковые изображения с одинаковым вопросом берутся из кэша.
 
     :param message: Объект сообщения с изображением от пользователя.
     """
     user = message.from_user
-    query = message.caption or "Внимательно изучи и скажи что тут изображено, подмечай все"
-    logger.info(f"Пользователь {user.id} отправил изображение для распознавания вместе с запросом: {query}")
-    file_id = message.photo[-1].file_id
-    file_name, local_file_path = await download_file(file_id, user.id)
-    response = ask_gpt_about_image(local_file_path, query)
-    await message.answer(response, parse_mode='Markdown')
-    logger.info(f"Файл {file_name} распознан и ответ сформирован")
+    if not settings.enable_image:
+        await message.answer(CAPABILITY_DISABLED_ANSWER)
+        return
+    try:
+        query = message.caption or "Внимательно изучи и скажи что тут изображено, подмечай все"
+        logger.info(f"Пользователь {user.id} отправил изображение для распознавания вместе с запросом: {query}")
+        file_id = message.photo[-1].file_id
+        with await download_file(file_id, user.id) as upload, span('prepare_image'):
+            file_name = upload.file_name
+            image = await asyncio.to_thread(prepare_image, upload.source)
+        response = await asyncio.to_thread(image_cache.get, user.id, image, query) if image_cache is not None else None
+        if response is not None:
+            record('image_cache_hit', 0.0)
+            logger.info(f"Ответ по изображению {file_name} взят из кэша")
+            await message.answer(response, parse_mode='Markdown')
+            return
+        if settings.gpt_streaming:
+            response = await stream_reply(message, astream_image_answer(image, query))
+        else:
+            with span('gpt_image'):
+                response = await asyncio.to_thread(ask_gpt_about_image, image, query)
+            await message.answer(response, parse_mode='Markdown')
+        if image_cache is not None and not response.endswith(IMAGE_ERROR_ANSWER):
+            await asyncio.to_thread(image_cache.put, user.id, image, query, response)
+        logger.info(f"Файл {file_name} распознан и ответ сформирован")
+    except Exception as ex:
+        logger.error(f"Ошибка при обработке изображения от пользователя {user.id}: {ex}")
+        await message.answer("Произошла ошибка во время обработки вашего изображения, попробуйте снова чуть позже.")
 
 
 @dp.message(F.document)
 async def handle_document_message(message: types.Message):
     """
     Обработка документов, отправленных пользователем.
-    Загружает документ, обрабатывает его с помощью PyPDFLoader и сохраняет в базу данных Elasticsearch.
+    Загружает документ, разбивает его на фрагменты и пакетно сохраняет в базу данных Elasticsearch.
+    Документ, который пользователь уже загружал (то же содержимое), повторно не обрабатывается.
 
     :param message: Объект сообщения с документом от пользователя.
     """
     user = message.from_user
+    if ingest_pool is None:
+        await message.answer(CAPABILITY_DISABLED_ANSWER)
+        return
+    writing = False
     try:
         logger.info(f"Пользователь {user.id} загружает документ в базу знаний")
-        await message.reply('Принял в обработку, подождите минуту')
+        placeholder = await message.reply('Принял в обработку, подождите минуту')
         file_id = message.document.file_id
-        file_name, local_file_path = await download_file(file_id, user.id)
-        pdf_loader = PyPDFLoader(local_file_path)
-        pdf_pages = pdf_loader.load_and_split()
-
-        for page in pdf_pages:
-            page_metadata = {'doc_owner': user.id, 'doc_id': file_id, 'file_name': message.document.file_name,
-                             'page_number': page.metadata['page']}
-            splitted_page = transformers_obj.text_splitter(page.page_content, page_metadata)
-            await es_handler.vectorstore.aadd_documents(splitted_page)
-
+        with await download_file(file_id, user.id) as upload:
+            file_name = upload.file_name
+            existing = await registry.find_by_hash(user.id, upload.sha256)
+            if existing is not None:
+                logger.info(f"Документ {file_name} уже загружен пользователем {user.id} как {existing['doc_id']}")
+                await placeholder.edit_text(f"Этот документ уже загружен: {existing['file_name']}")
+                return
+            doc_metadata = {'doc_owner': user.id, 'doc_id': file_id, 'file_name': message.document.file_name}
+            on_progress = ingest_progress_callback(placeholder) if ingest_pool.kind == 'thread' else None
+            with span('ingest_document') as ingest_span:
+                writing = True
+                report = await ingest_pool.run(ingest_pdf_job, upload.source, doc_metadata, on_progress, upload.sha256,
+                                               on_queued=partial(notify_queued, message))
+                ingest_span.set(pages=report.pages, chunks=report.chunks)
+        for stage, seconds in report.timings.items():
+            record(f'ingest_{stage}', seconds)
+        await registry.add(user.id, file_id, message.document.file_name, report.pages, report.chunks,
+                           report.content_hash)
+
+        if answer_cache is not None:
+            answer_cache.invalidate_owner(user.id)
         await message.reply('Файл загружен и готов к использованию')
-        logger.info(f"Файл {file_name} обработан и сохранен в Elasticsearch")
+        logger.info(f"Файл {file_name} обработан и сохранен в Elasticsearch: {report}")
+    except QueueFullError as ex:
+        logger.warning(f"Документ от пользователя {user.id} отклонен: {ex}")
+        await message.answer("Сейчас слишком много задач в обработке, попробуйте снова чуть позже.")
     except Exception as ex:
         logger.error(f"Пользователь {user.id} получил ошибку при загрузке документа: {ex}")
+        # Фрагменты, записанные до ошибки, без записи в реестре нельзя было бы найти и удалить.
+        # Если запись есть, под этим file_id уже загружен документ, и его фрагменты трогать нельзя
+        try:
+            if writing and await registry.get(user.id, message.document.file_id) is None:
+                await registry.delete(user.id, message.document.file_id)
+        except Exception as cleanup_ex:
+            logger.error(f"Не удалось удалить фрагменты документа {message.document.file_id}: {cleanup_ex}")
         await message.answer("Произошла ошибка во время обработки вашего запроса, попробуйте снова чуть позже.")
 
 
+def rerank(query: str, documents: list) -> list:
+    """Переранжирует фрагменты в потоке; модель загружается при первом вызове и не выгружается во время работы."""
+    with models.use('reranker') as reranker:
+        return reranker.rerank(query, documents)
+
+
 @dp.message(F.text)
 async def echo_handler(message: types.Message):
     """
     Обработка текстовых сообщений.
-    Выполняет поиск по базе данных Elasticsearch, отправляет найденные фрагменты в GPT,
-    а затем возвращает суммарный ответ пользователю.
+    Выполняет поиск по базе данных Elasticsearch, при включенном переранжировании отбирает из более широкой выдачи
+    лучшие фрагменты, отправляет их в GPT и возвращает ответ пользователю.
 
     :param message: Объект текстового сообщения от пользователя.
     """
     user = message.from_user
     try:
         logger.info(f"Пользователь {user.id} спросил базу знаний: {message.text}")
-        bm25_handler = BM25Handler(elastic.es, settings.elk_index)
-        documents = bm25_handler.vectorstore.similarity_search_with_relevance_scores(query=message.text.lower())
-
+        with span('retrieval', mode=settings.retrieval_mode) as retrieval_span:
+            k = settings.rerank_candidates if settings.rerank_enabled else settings.retrieval_top_k
+            documents = await retriever.asimilarity_search_with_relevance_scores(query=message.text.lower(), k=k,
+                                                                                 owner=user.id)
+            retrieval_span.set(chunks=len(documents))
         if not documents:
             await message.answer("Не удалось найти информации в базе знаний")
             return
 
-        answers = [ask_gpt_about_fragment(doc.page_content, message.text) for doc, _ in documents]
-        summary = summarize_answers(answers, message.text)
-
-        await message.reply(summary, parse_mode='Markdown')
+        # Ключ кэша - кандидаты до переранжирования: при попадании в кэш модель переранжирования не нужна
+        ids = chunk_ids(documents)
+        query_vector = None
+        if answer_cache is not None:
+            if settings.answer_cache_semantic:
+                query_vector = await asyncio.to_thread(get_embedding().embed_query, message.text.lower())
+            summary = answer_cache.get(user.id, message.text, ids, query_vector)
+            if summary is not None:
+                record('answer_cache_hit', 0.0)
+                logger.info(f"Пользователь {user.id} получил ответ из кэша")
+                await message.reply(summary, parse_mode='Markdown')
+                return
+
+        if settings.rerank_enabled:
+            with span('rerank', candidates=len(documents)) as rerank_span:
+                documents = await asyncio.to_thread(rerank, message.text, documents)
+                rerank_span.set(chunks=len(documents))
+        fragments = [doc.page_content for doc, _ in documents]
+        with span('answer', chunks=len(documents)):
+            if settings.gpt_streaming:
+                summary = await stream_reply(message, astream_answer(fragments, message.text))
+            else:
+                summary = await answer_question(fragments, message.text)
+                await message.reply(summary, parse_mode='Markdown')
+        if answer_cache is not None and not summary.endswith((FRAGMENT_ERROR_ANSWER, SUMMARY_ERROR_ANSWER)):
+            answer_cache.put(user.id, message.text, ids, summary, query_vector)
     except Exception as ex:
         logger.error(f"Пользователь {user.id} получил ошибку при работе с ботом: {ex}")
         await message.answer("Произошла ошибка во время обработки вашего запроса, попробуйте снова чуть позже.")
 
 
-async def main():
+async def warm_up_models(names: list):
+    """
+    Фоновая загрузка моделей после запуска polling, чтобы первый запрос не ждал загрузки.
+    Модели воркеров загружаются задачами пула, общие модели (эмбеддинги, переранжирование) - в отдельном потоке.
+
+    :param names: Имена моделей: embedding, reranker, whisper, ingestor.
+    """
+    pools = {'whisper': audio_pool, 'ingestor': ingest_pool}
+    for name in names:
+        try:
+            if name in ('embedding', 'reranker'):
+                await asyncio.to_thread(models.get, name)
+            elif pools.get(name) is not None:
+                pool = pools[name]
+                await asyncio.gather(*(pool.run(warm_up_job, name) for _ in range(pool.workers)))
+            else:
+                continue
+            logger.info(f'Модель {name} прогрета')
+        except Exception as ex:
+            logger.error(f'Не удалось прогреть модель {name}: {ex}')
+
+
+async def run_webhook(index: int):
+    """
+    Принимает обновления через webhook на WEBHOOK_HOST:WEBHOOK_PORT.
+    Обновление обрабатывается в фоне, Telegram сразу получает ответ 200 и не повторяет запрос из-за долгой генерации.
+    Воркеры с разными index слушают один порт (SO_REUSEPORT), входящие соединения распределяет ядро.
+
+    :param index: Номер воркера.
+    """
+    app = web.Application()
+    SimpleRequestHandler(dp, bot, handle_in_background=True,
+                         secret_token=settings.webhook_secret or None).register(app, path=settings.webhook_path)
+    setup_application(app, dp, bot=bot)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, settings.webhook_host, settings.webhook_port,
+                          reuse_port=settings.web_workers > 1).start()
+        logger.info(f"Воркер {index} принимает webhook на {settings.webhook_host}:{settings.webhook_port}"
+                    f"{settings.webhook_path}")
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+
+async def main(index: int = 0):
     """
     Основная функция для запуска Telegram-бота.
-    Настраивает логгирование и запускает polling для обработки сообщений.
+    Запускает выдачу метрик, если она включена, и polling или webhook (BOT_MODE) для обработки сообщений.
+
+    :param index: Номер воркера в режиме webhook; порт метрик воркера - METRICS_PORT + index.
     """
     logger.info('Запуск бота')
-    await dp.start_polling(bot)
+    await registry.ensure_index()
+    metrics_runner = await serve_metrics(settings.metrics_port + index) if settings.metrics_port else None
+    dump_task = (asyncio.create_task(dump_metrics_periodically(settings.metrics_dump_interval))
+                 if settings.metrics_dump_interval else None)
+    warm_up_task = asyncio.create_task(warm_up_models(settings.warmup_models)) if settings.warmup_models else None
+    try:
+        if settings.bot_mode == 'webhook':
+            await run_webhook(index)
+        else:
+            # getUpdates не работает, пока у бота установлен webhook
+            await bot.delete_webhook()
+            await dp.start_polling(bot)
+    finally:
+        # Хранилище состояния закрывает диспетчер при остановке (BaseStorage.close)
+        if warm_up_task is not None:
+            warm_up_task.cancel()
+        if dump_task is not None:
+            dump_task.cancel()
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+        for pool in (audio_pool, ingest_pool):
+            if pool is not None:
+                pool.shutdown()
+        await storage.close()
+
+
+async def set_webhook():
+    """Регистрирует адрес webhook в Telegram; вызывается один раз, до запуска воркеров."""
+    if not settings.webhook_url:
+        raise ValueError('Для BOT_MODE=webhook нужно задать WEBHOOK_URL')
+    try:
+        await bot.set_webhook(settings.webhook_url.rstrip('/') + settings.webhook_path,
+                              secret_token=settings.webhook_secret or None,
+                              allowed_updates=dp.resolve_used_update_types())
+        logger.info(f"Webhook установлен: {settings.webhook_url}{settings.webhook_path}")
+    finally:
+        await bot.session.close()
+
+
+def run_worker(index: int):
+    asyncio.run(main(index))
+
+
+def run_webhook_workers():
+    """
+    Запускает WEB_WORKERS процессов, принимающих webhook на одном порту.
+    Процессы разделяют только хранилище состояния, поэтому оно и хранилище документов должны быть общими.
+    """
+    if settings.web_workers > 1 and settings.state_backend == 'memory':
+        raise ValueError('Для WEB_WORKERS > 1 нужно общее хранилище состояния: STATE_BACKEND=sqlite')
+    if settings.web_workers > 1 and settings.storage_backend == 'local':
+        raise ValueError('Встроенное хранилище (STORAGE_BACKEND=local) нельзя использовать при WEB_WORKERS > 1')
+    asyncio.run(set_webhook())
+    if settings.web_workers <= 1:
+        run_worker(0)
+        return
+    context = multiprocessing.get_context('spawn')
+    workers = [context.Process(target=run_worker, args=(index,), name=f'web-worker-{index}')
+               for index in range(settings.web_workers)]
+    for worker in workers:
+        worker.start()
+    logger.info(f"Запущено воркеров webhook: {len(workers)}")
+    try:
+        for worker in workers:
+            worker.join()
+    except KeyboardInterrupt:
+        for worker in workers:
+            worker.terminate()
+            worker.join()
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    if settings.bot_mode == 'webhook':
+        run_webhook_workers()
+    else:
+        asyncio.run(main())
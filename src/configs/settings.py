@@ -11,7 +11,7 @@ LOG_LEVEL_CRITICAL = 50
 
 log_lvl = LOG_LEVEL_INFO
 
-emd_count_docs = 4
+emd_count_docs: int = env.int('EMD_COUNT_DOCS', default=32)
 bot_token: str = env.str('BOT_TOKEN', default='')
 gpt_model: str = env.str('GPT_MODEL', default='gpt-4o-mini')
 gpt_token: str = env.str('GPT_TOKEN', default='')
@@ -19,3 +19,173 @@ elastic_password: str = env.str('ELASTIC_PASSWORD', default='')
 elk_url: str = env.str('ELK_URL', default='http://localhost:9200')
 elk_index: str = env.str('ELK_INDEX', default='llmds_storage')
 ca_certs: str = env.str('ELK_CERTS', default='src/configs/ca/http_ca.crt')
+
+# Параметры асинхронного конвейера ответов GPT
+gpt_concurrency: int = env.int('GPT_CONCURRENCY', default=8)
+gpt_timeout: float = env.float('GPT_TIMEOUT', default=60.0)
+gpt_retries: int = env.int('GPT_RETRIES', default=3)
+gpt_backoff_base: float = env.float('GPT_BACKOFF_BASE', default=1.0)
+gpt_backoff_max: float = env.float('GPT_BACKOFF_MAX', default=20.0)
+
+# Параметры поиска по базе знаний
+retrieval_mode: str = env.str('RETRIEVAL_MODE', default='bm25')  # bm25 | hybrid
+retrieval_top_k: int = env.int('RETRIEVAL_TOP_K', default=4)
+hybrid_candidates: int = env.int('HYBRID_CANDIDATES', default=20)
+hybrid_num_candidates: int = env.int('HYBRID_NUM_CANDIDATES', default=100)
+hybrid_bm25_weight: float = env.float('HYBRID_BM25_WEIGHT', default=1.0)
+hybrid_knn_weight: float = env.float('HYBRID_KNN_WEIGHT', default=1.0)
+rrf_k: int = env.int('RRF_K', default=60)
+rerank_enabled: bool = env.bool('RERANK_ENABLED', default=False)
+rerank_model: str = env.str('RERANK_MODEL', default='cross-encoder/mmarco-mMiniLMv2-L12-H384-v1')
+rerank_candidates: int = env.int('RERANK_CANDIDATES', default=20)
+rerank_top_n: int = env.int('RERANK_TOP_N', default=4)
+rerank_min_score: float = env.float('RERANK_MIN_SCORE', default=0.1)
+rerank_batch_size: int = env.int('RERANK_BATCH_SIZE', default=16)
+rerank_max_length: int = env.int('RERANK_MAX_LENGTH', default=512)
+rerank_quantize: bool = env.bool('RERANK_QUANTIZE', default=True)
+
+# Хранилище фрагментов: elastic - Elasticsearch, local - встроенное хранилище в каталоге LOCAL_STORE_PATH
+storage_backend: str = env.str('STORAGE_BACKEND', default='elastic')  # elastic | local
+local_store_path: str = env.str('LOCAL_STORE_PATH', default='data/local_store')
+local_search_batch: int = env.int('LOCAL_SEARCH_BATCH', default=65536)
+
+# Параметры маппинга и настроек индекса
+elk_vector_dims: int = env.int('ELK_VECTOR_DIMS', default=1024)
+elk_hnsw_m: int = env.int('ELK_HNSW_M', default=16)
+elk_hnsw_ef_construction: int = env.int('ELK_HNSW_EF_CONSTRUCTION', default=100)
+elk_vector_int8: bool = env.bool('ELK_VECTOR_INT8', default=False)
+elk_shards: int = env.int('ELK_SHARDS', default=1)
+elk_replicas: int = env.int('ELK_REPLICAS', default=0)
+elk_refresh_interval: str = env.str('ELK_REFRESH_INTERVAL', default='1s')
+
+# Параметры загрузки документов
+ingest_window_chunks: int = env.int('INGEST_WINDOW_CHUNKS', default=256)
+ingest_bulk_size: int = env.int('INGEST_BULK_SIZE', default=500)
+ingest_request_timeout: int = env.int('INGEST_REQUEST_TIMEOUT', default=120)
+chunk_tokenizer: str = env.str('CHUNK_TOKENIZER', default='model')  # model - токенизатор EMB_MODEL_NAME | regex
+chunk_tokens: int = env.int('CHUNK_TOKENS', default=480)
+chunk_overlap_tokens: int = env.int('CHUNK_OVERLAP_TOKENS', default=48)
+chunk_cross_pages: bool = env.bool('CHUNK_CROSS_PAGES', default=False)
+chunk_batch_pages: int = env.int('CHUNK_BATCH_PAGES', default=16)
+text_remove_phrases: list = env.list('TEXT_REMOVE_PHRASES', default=[
+    'полная версия обзора доступна на нашем портале',
+    'подробнее см. в нашем обзоре на портале',
+    'полная версия обзора доступна на английском языке',
+])
+ingest_page_queue: int = env.int('INGEST_PAGE_QUEUE', default=32)
+ingest_progress_interval: float = env.float('INGEST_PROGRESS_INTERVAL', default=3.0)
+pdf_extract_processes: int = env.int('PDF_EXTRACT_PROCESSES', default=2)
+pdf_parallel_min_pages: int = env.int('PDF_PARALLEL_MIN_PAGES', default=100)
+pdf_range_pages: int = env.int('PDF_RANGE_PAGES', default=25)
+
+# Параметры пулов для тяжелых задач (распознавание аудио, загрузка документов)
+worker_pool_kind: str = env.str('WORKER_POOL_KIND', default='thread')  # thread | process
+audio_workers: int = env.int('AUDIO_WORKERS', default=1)
+ingest_workers: int = env.int('INGEST_WORKERS', default=1)
+worker_queue_size: int = env.int('WORKER_QUEUE_SIZE', default=10)
+
+# Параметры распознавания речи
+whisper_model: str = env.str('WHISPER_MODEL', default='openai/whisper-large-v3')
+whisper_fp16: bool = env.bool('WHISPER_FP16', default=True)  # только при наличии CUDA
+whisper_int8: bool = env.bool('WHISPER_INT8', default=False)  # динамическая квантизация на CPU
+whisper_chunk_mode: str = env.str('WHISPER_CHUNK_MODE', default='overlap')  # overlap | silence
+whisper_chunk_seconds: float = env.float('WHISPER_CHUNK_SECONDS', default=30.0)
+whisper_overlap_seconds: float = env.float('WHISPER_OVERLAP_SECONDS', default=5.0)
+whisper_vad_top_db: float = env.float('WHISPER_VAD_TOP_DB', default=35.0)
+whisper_batch_size: int = env.int('WHISPER_BATCH_SIZE', default=8)
+whisper_timestamps: bool = env.bool('WHISPER_TIMESTAMPS', default=True)
+whisper_stream_partial: bool = env.bool('WHISPER_STREAM_PARTIAL', default=True)
+
+# Кэш эмбеддингов
+emb_model_name: str = env.str('EMB_MODEL_NAME', default='intfloat/multilingual-e5-large')
+emb_cache_enabled: bool = env.bool('EMB_CACHE_ENABLED', default=True)
+emb_cache_path: str = env.str('EMB_CACHE_PATH', default='data/cache/embeddings.sqlite3')
+emb_cache_dtype: str = env.str('EMB_CACHE_DTYPE', default='float16')  # float16 | float32
+emb_cache_memory_items: int = env.int('EMB_CACHE_MEMORY_ITEMS', default=10000)
+emb_cache_max_items: int = env.int('EMB_CACHE_MAX_ITEMS', default=500000)
+
+# Кэш ответов
+answer_cache_enabled: bool = env.bool('ANSWER_CACHE_ENABLED', default=True)
+answer_cache_ttl: int = env.int('ANSWER_CACHE_TTL', default=3600)
+answer_cache_max_items: int = env.int('ANSWER_CACHE_MAX_ITEMS', default=2000)
+answer_cache_semantic: bool = env.bool('ANSWER_CACHE_SEMANTIC', default=False)
+answer_cache_similarity: float = env.float('ANSWER_CACHE_SIMILARITY', default=0.95)
+
+# Трассировка и метрики
+tracing_enabled: bool = env.bool('TRACING_ENABLED', default=True)
+metrics_port: int = env.int('METRICS_PORT', default=0)  # 0 - HTTP-эндпоинт выключен
+metrics_dump_interval: int = env.int('METRICS_DUMP_INTERVAL', default=0)  # 0 - периодический вывод в лог выключен
+
+# Стратегия ответа: stuff - один запрос со всеми фрагментами в пределах бюджета токенов,
+# map_reduce - запрос по каждому фрагменту и суммаризация
+answer_strategy: str = env.str('ANSWER_STRATEGY', default='stuff')
+stuff_token_budget: int = env.int('STUFF_TOKEN_BUDGET', default=6000)
+stuff_min_overlap: int = env.int('STUFF_MIN_OVERLAP', default=30)
+
+# Потоковые ответы
+gpt_streaming: bool = env.bool('GPT_STREAMING', default=True)
+stream_edit_interval: float = env.float('STREAM_EDIT_INTERVAL', default=1.5)
+stream_min_chars: int = env.int('STREAM_MIN_CHARS', default=40)
+
+# Параметры клиента Elasticsearch
+elk_connections_per_node: int = env.int('ELK_CONNECTIONS_PER_NODE', default=16)
+elk_request_timeout: float = env.float('ELK_REQUEST_TIMEOUT', default=30.0)
+elk_max_retries: int = env.int('ELK_MAX_RETRIES', default=3)
+
+# Разделение данных пользователей: shared - общий индекс с фильтром по владельцу,
+# alias - общий индекс и фильтрующий алиас на каждого владельца, index - отдельный индекс на владельца
+tenant_mode: str = env.str('TENANT_MODE', default='shared')
+elk_owner_routing: bool = env.bool('ELK_OWNER_ROUTING', default=True)
+
+# Реестр документов
+elk_registry_index: str = env.str('ELK_REGISTRY_INDEX', default='llmds_documents')
+registry_max_docs: int = env.int('REGISTRY_MAX_DOCS', default=1000)
+registry_backfill_batch: int = env.int('REGISTRY_BACKFILL_BATCH', default=500)
+delete_poll_interval: float = env.float('DELETE_POLL_INTERVAL', default=1.0)
+
+# Загрузка моделей и возможности экземпляра бота
+enable_audio: bool = env.bool('ENABLE_AUDIO', default=True)
+enable_image: bool = env.bool('ENABLE_IMAGE', default=True)
+enable_ingest: bool = env.bool('ENABLE_INGEST', default=True)
+warmup_models: list = env.list('WARMUP_MODELS', default=[])  # embedding, whisper, ingestor
+model_idle_ttl: int = env.int('MODEL_IDLE_TTL', default=0)  # 0 - модели не выгружаются
+model_idle_check_interval: int = env.int('MODEL_IDLE_CHECK_INTERVAL', default=60)
+
+# Обработка изображений
+image_model: str = env.str('IMAGE_MODEL', default='gpt-4o')
+image_max_side: int = env.int('IMAGE_MAX_SIDE', default=1536)
+image_jpeg_quality: int = env.int('IMAGE_JPEG_QUALITY', default=85)
+image_detail: str = env.str('IMAGE_DETAIL', default='auto')  # auto | low | high
+image_low_detail_side: int = env.int('IMAGE_LOW_DETAIL_SIDE', default=512)
+image_cache_enabled: bool = env.bool('IMAGE_CACHE_ENABLED', default=True)
+image_cache_path: str = env.str('IMAGE_CACHE_PATH', default='data/cache/image_answers.sqlite3')
+image_cache_memory_items: int = env.int('IMAGE_CACHE_MEMORY_ITEMS', default=500)
+image_cache_max_items: int = env.int('IMAGE_CACHE_MAX_ITEMS', default=20000)
+image_cache_ttl: int = env.int('IMAGE_CACHE_TTL', default=7 * 24 * 3600)
+image_cache_similar: bool = env.bool('IMAGE_CACHE_SIMILAR', default=False)
+image_cache_max_distance: int = env.int('IMAGE_CACHE_MAX_DISTANCE', default=12)
+image_phash_size: int = env.int('IMAGE_PHASH_SIZE', default=16)
+
+# Загрузка файлов из Telegram
+upload_memory_limit: int = env.int('UPLOAD_MEMORY_LIMIT', default=20 * 1024 * 1024)
+upload_tmp_dir: str = env.str('UPLOAD_TMP_DIR', default=None)
+upload_timeout: int = env.int('UPLOAD_TIMEOUT', default=120)
+
+# Режим работы бота и общее состояние процессов
+bot_mode: str = env.str('BOT_MODE', default='polling')  # polling | webhook
+webhook_url: str = env.str('WEBHOOK_URL', default='')  # публичный адрес, например https://bot.example.com
+webhook_path: str = env.str('WEBHOOK_PATH', default='/webhook')
+webhook_host: str = env.str('WEBHOOK_HOST', default='0.0.0.0')
+webhook_port: int = env.int('WEBHOOK_PORT', default=8080)
+webhook_secret: str = env.str('WEBHOOK_SECRET', default='')
+web_workers: int = env.int('WEB_WORKERS', default=1)
+state_backend: str = env.str('STATE_BACKEND', default='memory')  # memory | sqlite
+state_store_path: str = env.str('STATE_STORE_PATH', default='data/cache/state.sqlite3')
+state_purge_interval: int = env.int('STATE_PURGE_INTERVAL', default=300)
+callback_token_ttl: int = env.int('CALLBACK_TOKEN_TTL', default=3600)
+fsm_ttl: int = env.int('FSM_TTL', default=24 * 3600)
+user_concurrency: int = env.int('USER_CONCURRENCY', default=2)  # 0 - без ограничения
+user_slot_ttl: int = env.int('USER_SLOT_TTL', default=900)
+# Параллельные загрузки в один индекс учитываются в памяти процесса, поэтому обновление индекса на время загрузки
+# отключается, только если все загрузки идут в одном процессе: пул потоков и один процесс бота
+ingest_suspend_refresh: bool = worker_pool_kind == 'thread' and (bot_mode != 'webhook' or web_workers <= 1)
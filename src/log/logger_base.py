@@ -3,8 +3,9 @@ import logging
 from logging.handlers import RotatingFileHandler
 
 from src.configs.settings import log_lvl
+from src.log.tracing import TraceIdFilter
 
-LOG_FORMAT = '%(asctime)s,%(msecs)d %(levelname)-8s [%(module)s:%(lineno)d in %(funcName)s] %(message)s'
+LOG_FORMAT = '%(asctime)s,%(msecs)d %(levelname)-8s [%(trace_id)s] [%(module)s:%(lineno)d in %(funcName)s] %(message)s'
 MAX_BYTES = 10 * 1024 * 1024
 
 
@@ -24,6 +25,7 @@ class Logger:
         self.log_format = LOG_FORMAT
         self.log_datefmt = '%d-%m-%Y %H:%M:%S'
         self.handler = RotatingFileHandler(self.log_dir, maxBytes=MAX_BYTES, encoding='utf-8', delay=False, backupCount=1)
+        self.handler.addFilter(TraceIdFilter())
 
         logging.basicConfig(format=self.log_format, datefmt=self.log_datefmt, level=level, handlers=[self.handler])
 
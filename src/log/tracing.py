@@ -0,0 +1,193 @@
+import asyncio
+import json
+import logging
+import threading
+import time
+import uuid
+from contextvars import ContextVar
+
+from aiogram import BaseMiddleware
+
+from src.configs import settings
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, float('inf'))
+
+trace_id_var: ContextVar[str] = ContextVar('trace_id', default='-')
+
+
+def new_trace_id() -> str:
+    return uuid.uuid4().hex[:16]
+
+
+class MetricsRegistry:
+    """Агрегаты по этапам: гистограмма длительностей и суммы числовых атрибутов (токены, фрагменты)."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._durations = {}
+        self._totals = {}
+
+    def observe(self, name: str, seconds: float, attrs: dict = None):
+        """
+        Учитывает одно выполнение этапа.
+
+        :param name: Имя этапа.
+        :param seconds: Длительность в секундах.
+        :param attrs: Атрибуты этапа; числовые суммируются.
+        """
+        with self._lock:
+            stat = self._durations.get(name)
+            if stat is None:
+                stat = self._durations[name] = {'count': 0, 'sum': 0.0, 'max': 0.0, 'buckets': [0] * len(BUCKETS)}
+            stat['count'] += 1
+            stat['sum'] += seconds
+            stat['max'] = max(stat['max'], seconds)
+            for i, bound in enumerate(BUCKETS):
+                if seconds <= bound:
+                    stat['buckets'][i] += 1
+                    break
+            for attr, value in (attrs or {}).items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    self._totals[(name, attr)] = self._totals.get((name, attr), 0) + value
+
+    def reset(self):
+        """Сбрасывает накопленные агрегаты."""
+        with self._lock:
+            self._durations.clear()
+            self._totals.clear()
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                name: {'count': stat['count'], 'sum_s': round(stat['sum'], 4), 'max_s': round(stat['max'], 4),
+                       **{attr: total for (span_name, attr), total in self._totals.items() if span_name == name}}
+                for name, stat in self._durations.items()
+            }
+
+    def render_prometheus(self) -> str:
+        """Возвращает метрики в текстовом формате Prometheus."""
+        lines = ['# TYPE llmds_stage_duration_seconds histogram']
+        with self._lock:
+            for name, stat in sorted(self._durations.items()):
+                cumulative = 0
+                for bound, count in zip(BUCKETS, stat['buckets']):
+                    cumulative += count
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append(f'llmds_stage_duration_seconds_bucket{{stage="{name}",le="{le}"}} {cumulative}')
+                lines.append(f'llmds_stage_duration_seconds_sum{{stage="{name}"}} {stat["sum"]}')
+                lines.append(f'llmds_stage_duration_seconds_count{{stage="{name}"}} {stat["count"]}')
+            lines.append('# TYPE llmds_stage_attribute_total counter')
+            for (name, attr), total in sorted(self._totals.items()):
+                lines.append(f'llmds_stage_attribute_total{{stage="{name}",attr="{attr}"}} {total}')
+        return '\n'.join(lines) + '\n'
+
+
+metrics = MetricsRegistry()
+
+
+class Span:
+    """Замер длительности этапа. Атрибуты можно дополнять внутри блока через set()."""
+    __slots__ = ('name', 'attrs', 'start')
+
+    def __init__(self, name: str, attrs: dict):
+        self.name = name
+        self.attrs = attrs
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        seconds = time.perf_counter() - self.start
+        if exc_type is not None:
+            self.attrs['errors'] = 1
+        metrics.observe(self.name, seconds, self.attrs)
+        logging.debug(f'span {self.name} {seconds * 1000:.1f} ms {self.attrs}')
+        return False
+
+
+class _NoopSpan:
+    """Пустой замер, который используется при выключенной трассировке."""
+    __slots__ = ()
+
+    def set(self, **attrs):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+def span(name: str, **attrs):
+    """
+    Создает замер этапа для использования в блоке with.
+
+    :param name: Имя этапа.
+    :param attrs: Начальные атрибуты.
+    :return: Span или пустой замер, если трассировка выключена.
+    """
+    if not settings.tracing_enabled:
+        return NOOP_SPAN
+    return Span(name, attrs)
+
+
+def record(name: str, seconds: float, **attrs):
+    """Учитывает этап, длительность которого измерена в другом месте (например, в воркере)."""
+    if settings.tracing_enabled:
+        metrics.observe(name, seconds, attrs)
+
+
+class TraceIdFilter(logging.Filter):
+    """Добавляет в записи лога идентификатор текущего запроса."""
+
+    def filter(self, record):
+        record.trace_id = trace_id_var.get()
+        return True
+
+
+class TraceMiddleware(BaseMiddleware):
+    """Присваивает каждому обновлению от Telegram свой идентификатор трассировки и замеряет обработку."""
+
+    async def __call__(self, handler, event, data):
+        token = trace_id_var.set(new_trace_id())
+        try:
+            with span('update', update_type=event.event_type):
+                return await handler(event, data)
+        finally:
+            trace_id_var.reset(token)
+
+
+async def serve_metrics(port: int):
+    """
+    Запускает HTTP-эндпоинт /metrics в формате Prometheus.
+
+    :param port: Порт.
+    :return: AppRunner, который нужно остановить через cleanup().
+    """
+    from aiohttp import web
+
+    async def handle(request):
+        return web.Response(text=metrics.render_prometheus(), content_type='text/plain')
+
+    app = web.Application()
+    app.router.add_get('/metrics', handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, port=port).start()
+    logging.info(f'Метрики доступны на порту {port}')
+    return runner
+
+
+async def dump_metrics_periodically(interval: int):
+    """Периодически пишет агрегаты метрик в лог."""
+    while True:
+        await asyncio.sleep(interval)
+        logging.info(f'Метрики: {json.dumps(metrics.snapshot(), ensure_ascii=False)}')
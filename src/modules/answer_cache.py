@@ -0,0 +1,141 @@
+import hashlib
+import string
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import List, Optional
+
+import numpy as np
+
+from src.configs import settings
+
+
+@dataclass
+class CachedAnswer:
+    owner: str
+    query: str
+    chunk_ids: frozenset
+    answer: str
+    created: float
+    vector: Optional[np.ndarray] = None
+
+
+def normalize_query(query: str) -> str:
+    """Приводит вопрос к нижнему регистру, схлопывает пробелы и убирает знаки препинания по краям."""
+    return ' '.join(query.lower().split()).strip(string.punctuation + ' ')
+
+
+def chunk_ids(documents: list) -> frozenset:
+    """
+    Возвращает идентификаторы найденных фрагментов. Если поиск не вернул идентификатор,
+    он строится из документа, страницы и хэша текста фрагмента.
+
+    :param documents: Список пар (Document, score) из поиска.
+    :return: Множество идентификаторов.
+    """
+    ids = set()
+    for doc, _ in documents:
+        if doc.id:
+            ids.add(doc.id)
+        else:
+            text_hash = hashlib.sha1(doc.page_content.encode('utf-8')).hexdigest()
+            ids.add(f"{doc.metadata.get('doc_id')}:{doc.metadata.get('page_number')}:{text_hash}")
+    return frozenset(ids)
+
+
+class AnswerCache:
+    """
+    Кэш готовых ответов. Ключ - владелец, нормализованный вопрос и набор найденных фрагментов,
+    поэтому ответ автоматически перестает совпадать, если поиск вернул другие фрагменты.
+    Дополнительно можно находить близкие по смыслу вопросы по косинусной близости эмбеддингов.
+    Записи живут не дольше ttl секунд, при переполнении вытесняются самые давние по использованию.
+    """
+
+    def __init__(self, ttl: int = settings.answer_cache_ttl, max_items: int = settings.answer_cache_max_items,
+                 similarity: float = settings.answer_cache_similarity):
+        """
+        :param ttl: Время жизни записи в секундах.
+        :param max_items: Максимальное количество записей.
+        :param similarity: Порог косинусной близости для поиска похожих вопросов.
+        """
+        self.ttl = ttl
+        self.max_items = max_items
+        self.similarity = similarity
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(owner: str, query: str, ids: frozenset) -> tuple:
+        return str(owner), normalize_query(query), ids
+
+    def _expired(self, entry: CachedAnswer) -> bool:
+        return time.monotonic() - entry.created > self.ttl
+
+    def get(self, owner: str, query: str, ids: frozenset, vector: Optional[List[float]] = None) -> Optional[str]:
+        """
+        Ищет ответ в кэше: сначала точное совпадение, затем, если передан вектор вопроса,
+        похожий вопрос того же владельца с тем же набором фрагментов.
+
+        :param owner: Идентификатор пользователя.
+        :param query: Вопрос пользователя.
+        :param ids: Идентификаторы найденных фрагментов (см. chunk_ids).
+        :param vector: Эмбеддинг вопроса.
+        :return: Ответ или None.
+        """
+        key = self._key(owner, query, ids)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and not self._expired(entry):
+                self._entries.move_to_end(key)
+                return entry.answer
+            if vector is None:
+                return None
+
+            query_vector = np.asarray(vector, dtype=np.float32)
+            query_vector /= np.linalg.norm(query_vector) or 1.0
+            best_key, best_score = None, self.similarity
+            for entry_key, entry in self._entries.items():
+                if entry.vector is None or entry_key[0] != key[0] or entry.chunk_ids != ids or self._expired(entry):
+                    continue
+                score = float(entry.vector @ query_vector)
+                if score >= best_score:
+                    best_key, best_score = entry_key, score
+            if best_key is None:
+                return None
+            self._entries.move_to_end(best_key)
+            return self._entries[best_key].answer
+
+    def put(self, owner: str, query: str, ids: frozenset, answer: str, vector: Optional[List[float]] = None):
+        """
+        Сохраняет ответ в кэш.
+
+        :param owner: Идентификатор пользователя.
+        :param query: Вопрос пользователя.
+        :param ids: Идентификаторы найденных фрагментов.
+        :param answer: Ответ.
+        :param vector: Эмбеддинг вопроса для поиска похожих вопросов.
+        """
+        key = self._key(owner, query, ids)
+        if vector is not None:
+            vector = np.asarray(vector, dtype=np.float32)
+            vector /= np.linalg.norm(vector) or 1.0
+        with self._lock:
+            self._entries[key] = CachedAnswer(key[0], key[1], ids, answer, time.monotonic(), vector)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_items:
+                self._entries.popitem(last=False)
+
+    def invalidate_owner(self, owner: str) -> int:
+        """
+        Удаляет все ответы пользователя (вызывается при загрузке и удалении его документов).
+
+        :param owner: Идентификатор пользователя.
+        :return: Количество удаленных записей.
+        """
+        owner = str(owner)
+        with self._lock:
+            keys = [key for key in self._entries if key[0] == owner]
+            for key in keys:
+                del self._entries[key]
+        return len(keys)
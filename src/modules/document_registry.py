@@ -0,0 +1,184 @@
+import asyncio
+import logging
+import time
+from typing import Awaitable, Callable, Optional
+
+from elasticsearch import AsyncElasticsearch
+
+from src.configs import settings
+from src.modules.elastic import index_for_owner, owner_filter, routing_for_owner
+
+
+class DocumentRegistry:
+    """
+    Реестр загруженных документов: по одной небольшой записи на документ (владелец, doc_id, имя файла,
+    количество страниц и фрагментов, хэш содержимого, время загрузки). Список документов пользователя -
+    один запрос к реестру вместо прокрутки всех его фрагментов.
+    """
+
+    def __init__(self, es: AsyncElasticsearch, index_name: str = settings.elk_registry_index,
+                 chunks_index: str = settings.elk_index):
+        """
+        :param es: Асинхронный клиент Elasticsearch.
+        :param index_name: Индекс реестра.
+        :param chunks_index: Общий индекс с фрагментами документов.
+        """
+        self.es = es
+        self.index_name = index_name
+        self.chunks_index = chunks_index
+
+    @staticmethod
+    def build_index_body() -> dict:
+        return {
+            "settings": {"number_of_shards": 1, "number_of_replicas": settings.elk_replicas},
+            "mappings": {
+                "dynamic": False,
+                "properties": {
+                    "doc_owner": {"type": "keyword"},
+                    "doc_id": {"type": "keyword"},
+                    "file_name": {"type": "keyword"},
+                    "pages": {"type": "integer"},
+                    "chunks": {"type": "integer"},
+                    "content_hash": {"type": "keyword"},
+                    "ingested_at": {"type": "date", "format": "epoch_second"},
+                },
+            },
+        }
+
+    @staticmethod
+    def _record_id(owner, doc_id: str) -> str:
+        return f'{owner}:{doc_id}'
+
+    async def ensure_index(self):
+        """Создает реестр, если его нет, и заполняет его документами, фрагменты которых уже есть в индексе."""
+        if not await self.es.indices.exists(index=self.index_name):
+            logging.info(f'Создание реестра документов {self.index_name}')
+            response = await self.es.options(ignore_status=400).indices.create(index=self.index_name,
+                                                                               **self.build_index_body())
+            # Реестр заполняет только процесс, который его создал
+            if response.get('acknowledged'):
+                await self.backfill()
+
+    async def backfill(self) -> int:
+        """
+        Восстанавливает записи реестра по фрагментам: документы, загруженные до появления реестра
+        (или фрагменты которых остались без записи), иначе нельзя найти и удалить через /delete_doc.
+        Документы собираются постраничной агрегацией по владельцу и metadata.doc_id во всех индексах
+        фрагментов, включая индексы владельцев; хэш содержимого для них неизвестен.
+
+        :return: Количество восстановленных записей.
+        """
+        sources = [{"owner": {"terms": {"field": "metadata.doc_owner"}}},
+                   {"doc_id": {"terms": {"field": "metadata.doc_id"}}}]
+        sub_aggs = {"pages": {"max": {"field": "metadata.page_number"}},
+                    "file_name": {"terms": {"field": "metadata.file_name", "size": 1}}}
+        after, restored = None, 0
+        while True:
+            composite = {"size": settings.registry_backfill_batch, "sources": sources}
+            if after is not None:
+                composite["after"] = after
+            response = await self.es.search(index=f'{self.chunks_index},{self.chunks_index}-owner-*', size=0,
+                                            aggs={"documents": {"composite": composite, "aggs": sub_aggs}},
+                                            ignore_unavailable=True, allow_no_indices=True)
+            aggregation = response.get('aggregations', {}).get('documents', {})
+            buckets = aggregation.get('buckets', [])
+            if not buckets:
+                break
+            now = int(time.time())
+            operations = []
+            for bucket in buckets:
+                owner, doc_id = bucket['key']['owner'], bucket['key']['doc_id']
+                names = bucket['file_name']['buckets']
+                pages = bucket['pages']['value']
+                operations.append({"create": {"_id": self._record_id(owner, doc_id)}})
+                operations.append({"doc_owner": owner, "doc_id": doc_id,
+                                   "file_name": names[0]['key'] if names else doc_id,
+                                   "pages": int(pages) + 1 if pages is not None else 0,
+                                   "chunks": bucket['doc_count'], "content_hash": "", "ingested_at": now})
+            # create не перезаписывает записи, которые успели появиться после загрузки
+            result = await self.es.bulk(index=self.index_name, operations=operations, refresh='wait_for')
+            restored += sum(1 for item in result['items'] if item['create'].get('status') == 201)
+            after = aggregation.get('after_key')
+            if after is None:
+                break
+        if restored:
+            logging.info(f'В реестр {self.index_name} восстановлено документов: {restored}')
+        return restored
+
+    async def recreate_index(self):
+        await self.es.options(ignore_status=404).indices.delete(index=self.index_name)
+        await self.ensure_index()
+
+    async def add(self, owner, doc_id: str, file_name: str, pages: int, chunks: int, content_hash: str):
+        """Записывает документ в реестр после успешной загрузки."""
+        record = {"doc_owner": str(owner), "doc_id": doc_id, "file_name": file_name, "pages": pages,
+                  "chunks": chunks, "content_hash": content_hash, "ingested_at": int(time.time())}
+        await self.es.index(index=self.index_name, id=self._record_id(owner, doc_id), document=record,
+                            refresh='wait_for')
+
+    async def list(self, owner) -> list:
+        """
+        Возвращает документы пользователя, начиная с последних загруженных.
+
+        :param owner: Идентификатор пользователя.
+        :return: Список записей реестра.
+        """
+        response = await self.es.search(index=self.index_name, query={"bool": {"filter": [
+            {"term": {"doc_owner": str(owner)}}]}}, sort=[{"ingested_at": "desc"}],
+            size=settings.registry_max_docs, ignore_unavailable=True)
+        return [hit['_source'] for hit in response['hits']['hits']]
+
+    async def get(self, owner, doc_id: str) -> Optional[dict]:
+        """Возвращает запись реестра о документе пользователя или None."""
+        response = await self.es.options(ignore_status=404).get(index=self.index_name,
+                                                                id=self._record_id(owner, doc_id))
+        return response['_source'] if response.get('found') else None
+
+    async def find_by_hash(self, owner, content_hash: str) -> Optional[dict]:
+        """Ищет у пользователя документ с тем же содержимым."""
+        response = await self.es.search(index=self.index_name, query={"bool": {"filter": [
+            {"term": {"doc_owner": str(owner)}}, {"term": {"content_hash": content_hash}}]}},
+            size=1, ignore_unavailable=True)
+        hits = response['hits']['hits']
+        return hits[0]['_source'] if hits else None
+
+    async def delete(self, owner, doc_id: str,
+                     on_progress: Optional[Callable[[int, int], Awaitable]] = None) -> int:
+        """
+        Удаляет фрагменты документа фоновой задачей delete-by-query, периодически сообщая о прогрессе,
+        затем удаляет запись из реестра.
+
+        :param owner: Идентификатор пользователя.
+        :param doc_id: Идентификатор документа.
+        :param on_progress: Вызывается с количеством удаленных фрагментов и общим количеством.
+        :return: Количество удаленных фрагментов.
+        """
+        query = {"bool": {"filter": [{"term": {"metadata.doc_id": doc_id}}, owner_filter(owner)]}}
+        response = await self.es.delete_by_query(index=index_for_owner(owner, self.chunks_index),
+                                                 routing=routing_for_owner(owner), query=query,
+                                                 wait_for_completion=False, conflicts='proceed', refresh=True,
+                                                 ignore_unavailable=True)
+        task_id = response['task']
+        while True:
+            await asyncio.sleep(settings.delete_poll_interval)
+            task = await self.es.tasks.get(task_id=task_id)
+            status = task['task']['status']
+            if task['completed']:
+                break
+            if on_progress is not None:
+                try:
+                    await on_progress(status['deleted'], status['total'])
+                except Exception as ex:
+                    # Задача удаления продолжает работать на сервере, поэтому ошибка показа прогресса ее не прерывает
+                    logging.warning(f'Не удалось показать прогресс удаления документа {doc_id}: {ex}')
+        if task.get('error'):
+            raise RuntimeError(f"Удаление документа {doc_id} завершилось ошибкой: {task['error']}")
+        failures = task['response'].get('failures')
+        if failures:
+            # Часть фрагментов осталась в индексе: запись реестра сохраняется, чтобы удаление можно было повторить
+            raise RuntimeError(f"Удаление документа {doc_id} завершилось с ошибками "
+                               f"({len(failures)}): {failures[0]}")
+
+        await self.es.options(ignore_status=404).delete(index=self.index_name, id=self._record_id(owner, doc_id),
+                                                        refresh='wait_for')
+        return task['response']['deleted']
@@ -1,33 +1,153 @@
+import asyncio
 import logging
-from elasticsearch import Elasticsearch
-from langchain_elasticsearch.vectorstores import BM25Strategy, ElasticsearchStore
+from elasticsearch import AsyncElasticsearch, Elasticsearch
+from langchain_core.documents import Document
 
 from src.configs import settings
 from src.modules.embedding import get_embedding
 
 
+def _client_options() -> dict:
+    """Общие параметры подключения для синхронного и асинхронного клиентов."""
+    return dict(
+        connections_per_node=settings.elk_connections_per_node,
+        request_timeout=settings.elk_request_timeout,
+        max_retries=settings.elk_max_retries,
+        retry_on_timeout=True,
+        http_compress=True,
+        # ca_certs=settings.ca_certs,
+        # basic_auth=("elastic", settings.elastic_password)
+    )
+
+
+def create_sync_client() -> Elasticsearch:
+    """
+    Создает синхронный клиент для кода, который выполняется вне цикла событий (воркеры загрузки, бенчмарк).
+    """
+    return Elasticsearch(settings.elk_url, **_client_options())
+
+
+def index_for_owner(owner, base: str = settings.elk_index) -> str:
+    """
+    Возвращает имя индекса или алиаса, в котором хранятся фрагменты владельца.
+
+    :param owner: Идентификатор пользователя.
+    :param base: Имя общего индекса.
+    :return: Имя индекса (алиаса).
+    """
+    if settings.tenant_mode in ('alias', 'index'):
+        return f'{base}-owner-{owner}'
+    return base
+
+
+def routing_for_owner(owner):
+    """
+    Значение routing для запросов владельца в общем индексе: все его фрагменты лежат в одном шарде.
+    В режиме alias routing задается в самом алиасе, в режиме index не нужен.
+    """
+    if settings.elk_owner_routing and settings.tenant_mode == 'shared':
+        return str(owner)
+    return None
+
+
+def owner_filter(owner) -> dict:
+    """Фильтр по владельцу, который не участвует в расчете релевантности."""
+    return {"term": {"metadata.doc_owner": str(owner)}}
+
+
+def ensure_owner_index(es: Elasticsearch, owner, base: str = settings.elk_index) -> str:
+    """
+    Создает индекс или алиас владельца, если их еще нет (синхронный клиент, вызывается при загрузке).
+
+    :param es: Синхронный клиент Elasticsearch.
+    :param owner: Идентификатор пользователя.
+    :param base: Имя общего индекса.
+    :return: Имя индекса (алиаса) владельца.
+    """
+    name = index_for_owner(owner, base)
+    if settings.tenant_mode == 'index':
+        if not es.indices.exists(index=name):
+            es.options(ignore_status=400).indices.create(index=name, **Elastic.build_index_body())
+    elif settings.tenant_mode == 'alias':
+        if not es.indices.exists(index=base):
+            es.options(ignore_status=400).indices.create(index=base, **Elastic.build_index_body())
+        if not es.indices.exists_alias(name=name):
+            routing = str(owner) if settings.elk_owner_routing else None
+            es.indices.put_alias(index=base, name=name, filter=owner_filter(owner), routing=routing)
+    return name
+
+
 class Elastic:
+    """
+    Единый на процесс асинхронный клиент Elasticsearch с пулом соединений (keep-alive),
+    таймаутами и повторами запросов.
+    """
+
     def __init__(self):
         logging.info('Подключение к Elasticsearch')
-        self.es = Elasticsearch(
-            settings.elk_url,
-            # ca_certs=settings.ca_certs,
-            # basic_auth=("elastic", settings.elastic_password)
-        )
+        self.es = AsyncElasticsearch(settings.elk_url, **_client_options())
+
+    async def close(self):
+        await self.es.close()
+
+    @staticmethod
+    def build_index_body() -> dict:
+        """
+        Формирует настройки и маппинг индекса с фрагментами документов.
 
-    def create_index(self, index_name: str):
+        Метаданные объявлены как keyword, чтобы фильтры по владельцу и удаление были term-запросами,
+        текст анализируется русским анализатором без лишних keyword-подполей, а для векторов
+        задаются параметры HNSW и, при необходимости, int8-квантизация.
+
+        :return: Словарь с ключами settings и mappings для indices.create.
+        """
+        index_options = {
+            "type": "int8_hnsw" if settings.elk_vector_int8 else "hnsw",
+            "m": settings.elk_hnsw_m,
+            "ef_construction": settings.elk_hnsw_ef_construction,
+        }
+        return {
+            "settings": {
+                "number_of_shards": settings.elk_shards,
+                "number_of_replicas": settings.elk_replicas,
+                "refresh_interval": settings.elk_refresh_interval,
+            },
+            "mappings": {
+                "dynamic": False,
+                "properties": {
+                    "text": {"type": "text", "analyzer": "russian"},
+                    "vector": {
+                        "type": "dense_vector",
+                        "dims": settings.elk_vector_dims,
+                        "index": True,
+                        "similarity": "cosine",
+                        "index_options": index_options,
+                    },
+                    "metadata": {
+                        "properties": {
+                            "doc_owner": {"type": "keyword"},
+                            "doc_id": {"type": "keyword"},
+                            "file_name": {"type": "keyword"},
+                            "page_number": {"type": "integer"},
+                        }
+                    },
+                },
+            },
+        }
+
+    async def create_index(self, index_name: str):
         logging.info(f'Создание индекса {index_name}')
-        if not self.es.indices.exists(index=index_name):
-            self.es.indices.create(index=index_name)
+        if not await self.es.indices.exists(index=index_name):
+            await self.es.indices.create(index=index_name, **self.build_index_body())
             return True
         else:
             logging.info(f'Индекс {index_name} уже существует')
             return False
 
-    def delete_index(self, index_name: str):
+    async def delete_index(self, index_name: str):
         logging.info(f'Очистка индекса {index_name}')
         try:
-            self.es.indices.delete(index=index_name)
+            await self.es.indices.delete(index=index_name)
             logging.info(f'Индекс {index_name} очищен')
             return True
         except Exception as ex:
@@ -35,11 +155,107 @@ class Elastic:
             return False
 
 
-class EsHandler:
-    def __init__(self, es: Elasticsearch, index_name: str):
-        self.vectorstore = ElasticsearchStore(es_connection=es, embedding=get_embedding(), index_name=index_name)
+def _hits_to_documents(hits: list, text_field: str = 'text') -> list:
+    """Преобразует ответ Elasticsearch в список пар (Document, score)."""
+    return [(Document(id=hit['_id'], page_content=hit['_source'].get(text_field, ''),
+                      metadata=hit['_source'].get('metadata', {})), hit['_score']) for hit in hits]
 
 
 class BM25Handler:
-    def __init__(self, es: Elasticsearch, index_name: str):
-        self.vectorstore = ElasticsearchStore(es_connection=es, index_name=index_name, strategy=BM25Strategy())
+    """Полнотекстовый поиск BM25 по фрагментам. Создается один раз и переиспользуется всеми запросами."""
+    text_field = 'text'
+    vector_field = 'vector'
+
+    def __init__(self, es: AsyncElasticsearch, index_name: str):
+        self.es = es
+        self.index_name = index_name
+
+    def _search_params(self, owner) -> dict:
+        """Индекс и routing запроса: без владельца поиск идет по всему общему индексу."""
+        if owner is None:
+            return {"index": self.index_name}
+        return {"index": index_for_owner(owner, self.index_name), "routing": routing_for_owner(owner),
+                "ignore_unavailable": True}
+
+    async def search_hits(self, query: str, size: int, owner=None) -> list:
+        bool_query = {"must": [{"match": {self.text_field: query}}]}
+        if owner is not None:
+            bool_query["filter"] = [owner_filter(owner)]
+        response = await self.es.search(query={"bool": bool_query}, size=size, source_excludes=[self.vector_field],
+                                        **self._search_params(owner))
+        return response['hits']['hits']
+
+    async def asimilarity_search_with_relevance_scores(self, query: str, k: int = settings.retrieval_top_k,
+                                                       owner=None) -> list:
+        """
+        Ищет фрагменты, релевантные запросу.
+
+        :param query: Текст запроса.
+        :param k: Количество фрагментов.
+        :param owner: Если задан, поиск идет только по документам этого пользователя.
+        :return: Список пар (Document, балл BM25), отсортированный по убыванию балла.
+        """
+        return _hits_to_documents(await self.search_hits(query, k, owner), self.text_field)
+
+
+def reciprocal_rank_fusion(rankings: list, weights: list, rrf_k: int = settings.rrf_k) -> list:
+    """
+    Объединяет несколько ранжированных списков методом Reciprocal Rank Fusion.
+
+    :param rankings: Списки идентификаторов документов, каждый отсортирован по убыванию релевантности.
+    :param weights: Веса списков, в том же порядке.
+    :param rrf_k: Сглаживающая константа RRF.
+    :return: Список пар (идентификатор, итоговый балл), отсортированный по убыванию балла.
+    """
+    scores = {}
+    for ranking, weight in zip(rankings, weights):
+        for rank, doc_id in enumerate(ranking, start=1):
+            scores[doc_id] = scores.get(doc_id, 0.0) + weight / (rrf_k + rank)
+    return sorted(scores.items(), key=lambda item: item[1], reverse=True)
+
+
+class HybridHandler(BM25Handler):
+    """
+    Гибридный поиск: BM25 и kNN по векторам, которые уже сохраняются при загрузке документов,
+    с объединением результатов через Reciprocal Rank Fusion.
+    """
+
+    @property
+    def embedding(self):
+        """Модель эмбеддингов загружается при первом запросе, а не при создании обработчика."""
+        return get_embedding()
+
+    async def knn_hits(self, query: str, size: int, owner=None) -> list:
+        knn = {
+            "field": self.vector_field,
+            "query_vector": await asyncio.to_thread(self.embedding.embed_query, query),
+            "k": size,
+            "num_candidates": max(settings.hybrid_num_candidates, size),
+        }
+        if owner is not None:
+            knn["filter"] = owner_filter(owner)
+        response = await self.es.search(knn=knn, size=size, source_excludes=[self.vector_field],
+                                        **self._search_params(owner))
+        return response['hits']['hits']
+
+    async def asimilarity_search_with_relevance_scores(self, query: str, k: int = settings.retrieval_top_k,
+                                                       owner=None) -> list:
+        """
+        Ищет фрагменты, релевантные запросу, сразу двумя способами и объединяет выдачу.
+
+        :param query: Текст запроса.
+        :param k: Количество фрагментов в итоговой выдаче.
+        :param owner: Если задан, поиск идет только по документам этого пользователя.
+        :return: Список пар (Document, балл RRF), отсортированный по убыванию балла.
+        """
+        size = max(settings.hybrid_candidates, k)
+        bm25_hits, knn_hits = await asyncio.gather(self.search_hits(query, size, owner),
+                                                   self.knn_hits(query, size, owner))
+
+        hits_by_id = {hit['_id']: hit for hit in bm25_hits + knn_hits}
+        fused = reciprocal_rank_fusion(
+            [[hit['_id'] for hit in bm25_hits], [hit['_id'] for hit in knn_hits]],
+            [settings.hybrid_bm25_weight, settings.hybrid_knn_weight]
+        )
+        return [(_hits_to_documents([hits_by_id[doc_id]], self.text_field)[0][0], score)
+                for doc_id, score in fused[:k]]
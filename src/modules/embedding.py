@@ -1,8 +1,20 @@
-from typing import Any, Coroutine, List
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Coroutine, Dict, List
 
+import numpy as np
 from langchain_community.embeddings import HuggingFaceEmbeddings
+from langchain_core.embeddings import Embeddings
 
-from src.configs.settings import emd_count_docs
+from src.configs.settings import (emd_count_docs, emb_model_name, emb_cache_enabled, emb_cache_path, emb_cache_dtype,
+                                  emb_cache_memory_items, emb_cache_max_items)
+
+QUERY_PREFIX = 'query: '
+PASSAGE_PREFIX = 'passage: '
 
 
 class HuggingFaceE5Embeddings(HuggingFaceEmbeddings):
@@ -13,7 +25,7 @@ class HuggingFaceE5Embeddings(HuggingFaceEmbeddings):
         :param text: текст
         :return: вектор
         """
-        text = f'query: {text}'
+        text = f'{QUERY_PREFIX}{text}'
         return super().embed_query(text)
 
     def embed_documents(self, texts: List[str]) -> List[List[float]]:
@@ -23,7 +35,7 @@ class HuggingFaceE5Embeddings(HuggingFaceEmbeddings):
         :param texts: список из текстов.
         :return: список векторов.
         """
-        texts = [f'passage: {text}' for text in texts]
+        texts = [f'{PASSAGE_PREFIX}{text}' for text in texts]
         embed_texts = []
         for i_text in range(0, len(texts), emd_count_docs):
             embed_texts.extend(super().embed_documents(texts[i_text:i_text + emd_count_docs]))
@@ -37,7 +49,7 @@ class HuggingFaceE5Embeddings(HuggingFaceEmbeddings):
         :param text: текст.
         :return: вектор.
         """
-        text = f'query: {text}'
+        text = f'{QUERY_PREFIX}{text}'
         return await super().aembed_query(text)
 
     async def aembed_documents(
@@ -49,11 +61,167 @@ class HuggingFaceE5Embeddings(HuggingFaceEmbeddings):
         :param texts: список из текстов.
         :return: список векторов.
         """
-        texts = [f'passage: {text}' for text in texts]
+        texts = [f'{PASSAGE_PREFIX}{text}' for text in texts]
         return await super().aembed_documents(texts)
 
 
-def get_embedding():
-    """Возвращает модель по созданию эмбедингов."""
-    e5_embedding = HuggingFaceE5Embeddings(model_name='intfloat/multilingual-e5-large')  # -> large
+class EmbeddingCache:
+    """
+    Кэш эмбеддингов с адресацией по содержимому: в памяти хранятся последние использованные векторы (LRU),
+    на диске - SQLite-файл, из которого при превышении max_items вытесняются давно не использованные записи.
+    Количество записей не пересчитывается на каждой вставке: ведется верхняя оценка (число вставленных ключей),
+    и только когда она превышает max_items, записи считаются заново.
+    """
+
+    def __init__(self, path: str = emb_cache_path, memory_items: int = emb_cache_memory_items,
+                 max_items: int = emb_cache_max_items, dtype: str = emb_cache_dtype):
+        """
+        :param path: Путь к файлу SQLite.
+        :param memory_items: Размер LRU-кэша в памяти.
+        :param max_items: Максимальное количество записей на диске.
+        :param dtype: Тип хранения векторов на диске: float16 или float32.
+        """
+        self.memory_items = memory_items
+        self.max_items = max_items
+        self.dtype = np.dtype(dtype)
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS embeddings '
+                         '(key TEXT PRIMARY KEY, vector BLOB NOT NULL, last_used REAL NOT NULL)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)')
+        self._db.commit()
+        self._count = self._db.execute('SELECT COUNT(*) FROM embeddings').fetchone()[0]
+
+    @staticmethod
+    def make_key(model_name: str, prefix: str, text: str) -> str:
+        """
+        Формирует ключ кэша по модели, префиксу и нормализованному тексту.
+
+        :param model_name: Имя модели эмбеддингов.
+        :param prefix: Префикс e5 (query: или passage: ).
+        :param text: Текст без префикса.
+        :return: sha256 в шестнадцатеричном виде.
+        """
+        normalized = ' '.join(text.split())
+        return hashlib.sha256(f'{model_name}\n{prefix}\n{normalized}'.encode('utf-8')).hexdigest()
+
+    def _remember(self, key: str, vector: List[float]):
+        self._memory[key] = vector
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_items:
+            self._memory.popitem(last=False)
+
+    def get_many(self, keys: List[str]) -> Dict[str, List[float]]:
+        """
+        Возвращает найденные в кэше векторы.
+
+        :param keys: Ключи кэша.
+        :return: Словарь ключ -> вектор только для найденных ключей.
+        """
+        found = {}
+        with self._lock:
+            for key in keys:
+                if key in self._memory:
+                    self._memory.move_to_end(key)
+                    found[key] = self._memory[key]
+            missing = [key for key in set(keys) if key not in found]
+            for i in range(0, len(missing), 500):
+                part = missing[i:i + 500]
+                rows = self._db.execute(f'SELECT key, vector FROM embeddings WHERE key IN ({",".join("?" * len(part))})',
+                                        part).fetchall()
+                for key, blob in rows:
+                    vector = np.frombuffer(blob, dtype=self.dtype).astype(np.float32).tolist()
+                    found[key] = vector
+                    self._remember(key, vector)
+            if missing:
+                now = time.time()
+                self._db.executemany('UPDATE embeddings SET last_used = ? WHERE key = ?',
+                                     [(now, key) for key in missing if key in found])
+                self._db.commit()
+        return found
+
+    def put_many(self, items: Dict[str, List[float]]):
+        """
+        Сохраняет векторы в кэш и при необходимости вытесняет давно не использованные записи.
+
+        :param items: Словарь ключ -> вектор.
+        """
+        now = time.time()
+        with self._lock:
+            for key, vector in items.items():
+                self._remember(key, vector)
+            self._db.executemany('INSERT OR REPLACE INTO embeddings (key, vector, last_used) VALUES (?, ?, ?)',
+                                 [(key, np.asarray(vector, dtype=self.dtype).tobytes(), now)
+                                  for key, vector in items.items()])
+            # Замена существующего ключа тоже увеличивает оценку, поэтому при превышении она уточняется
+            self._count += len(items)
+            if self._count > self.max_items:
+                self._count = self._db.execute('SELECT COUNT(*) FROM embeddings').fetchone()[0]
+            if self._count > self.max_items:
+                # Вытесняем с запасом в 10%, чтобы не чистить кэш на каждой вставке
+                excess = self._count - int(self.max_items * 0.9)
+                self._db.execute('DELETE FROM embeddings WHERE key IN '
+                                 '(SELECT key FROM embeddings ORDER BY last_used LIMIT ?)', (excess,))
+                self._count -= excess
+            self._db.commit()
+
+
+class CachedEmbeddings(Embeddings):
+    """Обертка над моделью эмбеддингов, которая отправляет в модель только тексты, которых нет в кэше."""
+
+    def __init__(self, embedding: HuggingFaceE5Embeddings, cache: EmbeddingCache, model_name: str = emb_model_name):
+        self.embedding = embedding
+        self.cache = cache
+        self.model_name = model_name
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        """
+        Преобразование списка текстов в эмбеддинги с использованием кэша.
+
+        :param texts: список из текстов.
+        :return: список векторов.
+        """
+        keys = [self.cache.make_key(self.model_name, PASSAGE_PREFIX, text) for text in texts]
+        vectors = self.cache.get_many(keys)
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in vectors:
+                missing.setdefault(key, text)
+        if missing:
+            embedded = self.embedding.embed_documents(list(missing.values()))
+            new_vectors = dict(zip(missing.keys(), embedded))
+            self.cache.put_many(new_vectors)
+            vectors.update(new_vectors)
+        return [vectors[key] for key in keys]
+
+    def embed_query(self, text: str) -> List[float]:
+        """
+        Преобразование текста запроса в эмбеддинг с использованием кэша.
+
+        :param text: текст
+        :return: вектор
+        """
+        key = self.cache.make_key(self.model_name, QUERY_PREFIX, text)
+        vector = self.cache.get_many([key]).get(key)
+        if vector is None:
+            vector = self.embedding.embed_query(text)
+            self.cache.put_many({key: vector})
+        return vector
+
+
+def create_embedding():
+    """Создает новый экземпляр модели по созданию эмбедингов (с кэшем, если он включен)."""
+    e5_embedding = HuggingFaceE5Embeddings(model_name=emb_model_name)  # -> large
+    if emb_cache_enabled:
+        return CachedEmbeddings(e5_embedding, EmbeddingCache())
     return e5_embedding
+
+
+def get_embedding():
+    """Возвращает общую на процесс модель по созданию эмбедингов, загружая ее при первом обращении."""
+    from src.modules.model_registry import models
+    return models.get('embedding')
@@ -1,48 +1,79 @@
-import base64
+import asyncio
 import logging
+import random
+import weakref
+from functools import lru_cache
 
-from openai import OpenAI
+import tiktoken
+from openai import AsyncOpenAI, OpenAI, APIConnectionError, APITimeoutError, InternalServerError, RateLimitError
 
-from src.configs.settings import gpt_token, gpt_model
+from src.configs.settings import (gpt_token, gpt_model, gpt_concurrency, gpt_timeout, gpt_retries, gpt_backoff_base,
+                                  gpt_backoff_max, answer_strategy, stuff_token_budget, stuff_min_overlap,
+                                  image_model)
+from src.modules.image_pipeline import PreparedImage
+from src.log.tracing import span
+
+FRAGMENT_SYSTEM_PROMPT = "Ты - помощник, который отвечает на вопросы на основе фрагментов текста."
+SUMMARY_SYSTEM_PROMPT = ("Ты - помощник, который суммирует ответы по запросу пользователя и предоставляет "
+                         "максимально развернутый и детализированный ответ.")
+STUFF_SYSTEM_PROMPT = ("Ты - помощник, который отвечает на вопросы на основе фрагментов текста и предоставляет "
+                       "максимально развернутый и детализированный ответ.")
+FRAGMENT_ERROR_ANSWER = "Не удалось получить ответ от GPT."
+SUMMARY_ERROR_ANSWER = "Не удалось создать суммарный ответ."
+FRAGMENT_MAX_TOKENS = 300
+SUMMARY_MAX_TOKENS = 1500
+IMAGE_ERROR_ANSWER = "Не удалось получить ответ на основе изображения."
+IMAGE_MODEL = image_model
+IMAGE_MAX_TOKENS = 1000
+
+# Ошибки, после которых имеет смысл повторить запрос
+RETRYABLE_ERRORS = (APIConnectionError, APITimeoutError, InternalServerError, RateLimitError, asyncio.TimeoutError)
 
 client = OpenAI(
     api_key=gpt_token
 )
+# Повторы выполняются в _acomplete с собственным backoff, поэтому встроенные повторы клиента отключены
+async_client = AsyncOpenAI(
+    api_key=gpt_token,
+    timeout=gpt_timeout,
+    max_retries=0
+)
+# Семафор привязывается к циклу событий при первом использовании, поэтому создается отдельно для каждого цикла
+# (бот, воркеры webhook и бенчмарки запускают свои циклы через asyncio.run)
+_gpt_semaphores = weakref.WeakKeyDictionary()
+
 
+def _gpt_semaphore() -> asyncio.Semaphore:
+    """Возвращает семафор, ограничивающий одновременные запросы к GPT в текущем цикле событий."""
+    loop = asyncio.get_running_loop()
+    semaphore = _gpt_semaphores.get(loop)
+    if semaphore is None:
+        semaphore = _gpt_semaphores[loop] = asyncio.Semaphore(gpt_concurrency)
+    return semaphore
 
-def ask_gpt_about_fragment(fragment: str, query: str) -> str:
+
+def _fragment_messages(fragment: str, query: str) -> list:
     """
-    Отправляет фрагмент с запросом в GPT, и возвращает ответ.
+    Формирует сообщения для вопроса по одному фрагменту текста.
 
     :param fragment: Фрагмент текста, на основе которого необходимо ответить на вопрос.
-    :param query: Вопрос, который необходимо задать GPT.
-    :return: Ответ GPT на заданный вопрос, основанный на предоставленном фрагменте текста.
+    :param query: Вопрос пользователя.
+    :return: Список сообщений для chat.completions.
     """
     prompt = f"На основе следующего фрагмента: '{fragment}', ответь на вопрос: '{query}'"
-    try:
-        response = client.chat.completions.create(
-            model=gpt_model,
-            messages=[
-                {"role": "system",
-                 "content": "Ты - помощник, который отвечает на вопросы на основе фрагментов текста."},
-                {"role": "user", "content": prompt}
-            ],
-            temperature=0.0,
-            max_tokens=300
-        )
-        return response.choices[0].message.content.strip()
-    except Exception as e:
-        logging.error(f"Ошибка при запросе к GPT: {e}")
-        return "Не удалось получить ответ от GPT."
+    return [
+        {"role": "system", "content": FRAGMENT_SYSTEM_PROMPT},
+        {"role": "user", "content": prompt}
+    ]
 
 
-def summarize_answers(answers: list, query: str) -> str:
+def _summary_messages(answers: list, query: str) -> list:
     """
-    Суммирует ответы GPT на основе всех фрагментов.
+    Формирует сообщения для суммаризации ответов по фрагментам.
 
     :param answers: Список ответов от GPT по отдельным фрагментам текста.
-    :param query: Вопрос, на который нужно дать суммарный ответ.
-    :return: Суммарный ответ на основе всех предоставленных фрагментов.
+    :param query: Вопрос пользователя.
+    :return: Список сообщений для chat.completions.
     """
     prompt = (
             f"На основе следующих ответов, дай развернутый и детализированный суммарный ответ на запрос: '{query}'. "
@@ -50,62 +81,394 @@ def summarize_answers(answers: list, query: str) -> str:
             "символов:\n\n "
             + "\n\n".join(answers)
     )
+    return [
+        {"role": "system", "content": SUMMARY_SYSTEM_PROMPT},
+        {"role": "user", "content": prompt}
+    ]
 
+
+def _stuff_messages(fragments: list, query: str) -> list:
+    """
+    Формирует сообщения для ответа на вопрос сразу по всем фрагментам.
+
+    :param fragments: Фрагменты текста в порядке убывания релевантности.
+    :param query: Вопрос пользователя.
+    :return: Список сообщений для chat.completions.
+    """
+    prompt = (
+            f"На основе следующих фрагментов, дай развернутый и детализированный ответ на запрос: '{query}'. "
+            "Ответ должен быть максимально информативным и охватывать все важные детали:\n\n"
+            + "\n\n".join(f"Фрагмент {i}: '{fragment}'" for i, fragment in enumerate(fragments, start=1))
+    )
+    return [
+        {"role": "system", "content": STUFF_SYSTEM_PROMPT},
+        {"role": "user", "content": prompt}
+    ]
+
+
+@lru_cache(maxsize=1)
+def _encoding() -> tiktoken.Encoding:
     try:
-        response = client.chat.completions.create(
-            model=gpt_model,
-            messages=[
-                {"role": "system",
-                 "content": "Ты - помощник, который суммирует ответы по запросу пользователя и предоставляет "
-                            "максимально развернутый и детализированный ответ."},
-                {"role": "user", "content": prompt}
-            ],
-            temperature=0.0,
-            max_tokens=1500
-        )
-        return response.choices[0].message.content.strip()
+        return tiktoken.encoding_for_model(gpt_model)
+    except KeyError:
+        return tiktoken.get_encoding('o200k_base')
+
+
+def count_tokens(text: str) -> int:
+    """Считает количество токенов текста токенизатором модели GPT."""
+    return len(_encoding().encode(text))
+
+
+def _merge_overlap(first: str, second: str, min_overlap: int):
+    """
+    Склеивает два фрагмента, если конец первого совпадает с началом второго.
+
+    :return: Склеенный текст или None, если перекрытия нет.
+    """
+    if len(second) < min_overlap:
+        return None
+    position = first.find(second[:min_overlap])
+    while position != -1:
+        size = len(first) - position
+        if size < len(second) and second.startswith(first[position:]):
+            return first + second[size:]
+        position = first.find(second[:min_overlap], position + 1)
+    return None
+
+
+def dedupe_fragments(fragments: list, min_overlap: int = stuff_min_overlap) -> list:
+    """
+    Убирает повторы из фрагментов: вложенные фрагменты отбрасываются, а фрагменты, перекрывающиеся
+    краями (сплиттер делает перекрытие между соседними частями), склеиваются. Порядок сохраняется
+    по первому вхождению, то есть по самой высокой релевантности.
+
+    :param fragments: Фрагменты текста в порядке убывания релевантности.
+    :param min_overlap: Минимальная длина совпадения краев в символах.
+    :return: Список фрагментов без повторов.
+    """
+    result = []
+    for fragment in fragments:
+        for i, kept in enumerate(result):
+            if fragment in kept:
+                break
+            if kept in fragment:
+                result[i] = fragment
+                break
+            merged = _merge_overlap(kept, fragment, min_overlap) or _merge_overlap(fragment, kept, min_overlap)
+            if merged is not None:
+                result[i] = merged
+                break
+        else:
+            result.append(fragment)
+    return result
+
+
+def pack_fragments(fragments: list, query: str, budget: int = stuff_token_budget) -> tuple:
+    """
+    Укладывает фрагменты в бюджет токенов одного запроса.
+
+    :param fragments: Фрагменты текста в порядке убывания релевантности.
+    :param query: Вопрос пользователя.
+    :param budget: Бюджет токенов на весь запрос (без учета ответа).
+    :return: Пара (фрагменты без повторов, True - если все поместились в бюджет).
+    """
+    fragments = dedupe_fragments(fragments)
+    tokens = sum(count_tokens(message['content']) for message in _stuff_messages([], query))
+    for fragment in fragments:
+        tokens += count_tokens(fragment) + 8  # разметка "Фрагмент N" и разделители
+        if tokens > budget:
+            return fragments, False
+    return fragments, True
+
+
+def _backoff_delay(attempt: int) -> float:
+    """
+    Вычисляет паузу перед повторным запросом (экспоненциальный рост со случайным разбросом).
+
+    :param attempt: Номер неудачной попытки, начиная с 0.
+    :return: Пауза в секундах.
+    """
+    delay = min(gpt_backoff_max, gpt_backoff_base * 2 ** attempt)
+    return delay * random.uniform(0.5, 1.0)
+
+
+async def _acomplete(messages: list, max_tokens: int, stage: str = 'gpt') -> str:
+    """
+    Асинхронно выполняет запрос к GPT с ограничением параллелизма, таймаутом и повторами.
+
+    :param messages: Сообщения для chat.completions.
+    :param max_tokens: Максимальное количество токенов в ответе.
+    :param stage: Имя этапа для метрик.
+    :return: Текст ответа GPT.
+    :raises: Последнюю ошибку, если все попытки исчерпаны.
+    """
+    with span(stage) as stage_span:
+        for attempt in range(gpt_retries + 1):
+            try:
+                async with _gpt_semaphore():
+                    response = await asyncio.wait_for(
+                        async_client.chat.completions.create(
+                            model=gpt_model,
+                            messages=messages,
+                            temperature=0.0,
+                            max_tokens=max_tokens
+                        ),
+                        timeout=gpt_timeout
+                    )
+                if response.usage is not None:
+                    stage_span.set(prompt_tokens=response.usage.prompt_tokens,
+                                   completion_tokens=response.usage.completion_tokens)
+                stage_span.set(retries=attempt)
+                return response.choices[0].message.content.strip()
+            except RETRYABLE_ERRORS as e:
+                if attempt == gpt_retries:
+                    raise
+                delay = _backoff_delay(attempt)
+                logging.warning(f"Запрос к GPT не удался ({type(e).__name__}), повтор через {delay:.1f} c")
+                await asyncio.sleep(delay)
+
+
+async def asummarize_answers(answers: list, query: str) -> str:
+    """
+    Суммирует ответы GPT по отдельным фрагментам.
+
+    :param answers: Список ответов от GPT по отдельным фрагментам текста.
+    :param query: Вопрос, на который нужно дать суммарный ответ.
+    :return: Суммарный ответ на основе всех предоставленных фрагментов.
+    """
+    try:
+        return await _acomplete(_summary_messages(answers, query), SUMMARY_MAX_TOKENS, 'gpt_summary')
     except Exception as e:
         logging.error(f"Ошибка при суммаризации ответа с GPT: {e}")
-        return "Не удалось создать суммарный ответ."
+        return SUMMARY_ERROR_ANSWER
+
+
+async def _map_fragments(fragments: list, query: str) -> list:
+    """
+    Параллельно опрашивает GPT по каждому фрагменту.
+
+    :param fragments: Список фрагментов текста, найденных в базе знаний.
+    :param query: Вопрос пользователя.
+    :return: Список успешных ответов.
+    """
+    results = await asyncio.gather(
+        *[_acomplete(_fragment_messages(fragment, query), FRAGMENT_MAX_TOKENS, 'gpt_fragment')
+          for fragment in fragments],
+        return_exceptions=True
+    )
+    answers = []
+    for result in results:
+        if isinstance(result, BaseException):
+            logging.error(f"Ошибка при запросе к GPT: {result}")
+        else:
+            answers.append(result)
+    return answers
+
+
+async def answer_question_map_reduce(fragments: list, query: str) -> str:
+    """
+    Отвечает на вопрос по схеме map-reduce: параллельно опрашивает GPT по каждому фрагменту,
+    затем суммирует полученные ответы одним запросом.
+
+    :param fragments: Список фрагментов текста, найденных в базе знаний.
+    :param query: Вопрос пользователя.
+    :return: Суммарный ответ на вопрос.
+    """
+    answers = await _map_fragments(fragments, query)
+    if not answers:
+        return FRAGMENT_ERROR_ANSWER
+    return await asummarize_answers(answers, query)
 
 
-def encode_image(image_path):
+def _image_messages(image: PreparedImage, query: str) -> list:
     """
-    Кодирует изображение в формат base64.
+    Формирует сообщения для вопроса по изображению.
 
-    :param image_path: Путь к изображению, которое необходимо закодировать.
-    :return: Изображение, закодированное в формате base64.
+    :param image: Изображение, подготовленное prepare_image.
+    :param query: Вопрос пользователя.
+    :return: Список сообщений для chat.completions.
     """
-    with open(image_path, "rb") as image_file:
-        return base64.b64encode(image_file.read()).decode('utf-8')
+    return [
+        {"role": "system", "content": SUMMARY_SYSTEM_PROMPT},
+        {"role": "user", "content":
+            [{"type": "text", "text": query, },
+             {"type": "image_url", "image_url": {"url": image.data_url, "detail": image.detail}}]
+         }
+    ]
 
 
-def ask_gpt_about_image(image_path: str, query: str) -> str:
+def ask_gpt_about_image(image: PreparedImage, query: str) -> str:
     """
     Отправляет изображение в GPT и задает вопрос, возвращая ответ.
 
-    :param image_path: Путь к изображению, которое необходимо отправить.
+    :param image: Изображение, подготовленное prepare_image.
     :param query: Вопрос, который нужно задать GPT в контексте данного изображения.
 
     :return: Ответ GPT на вопрос, основанный на анализе изображения.
     """
     try:
-        base64_image = encode_image(image_path)
         response = client.chat.completions.create(
-            model="gpt-4o",
-            messages=[
-                {"role": "system",
-                 "content": "Ты - помощник, который суммирует ответы по запросу пользователя и предоставляет "
-                            "максимально развернутый и детализированный ответ."},
-                {"role": "user", "content":
-                    [{"type": "text", "text": query, },
-                     {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{base64_image}"}}]
-                 }
-            ],
+            model=IMAGE_MODEL,
+            messages=_image_messages(image, query),
             temperature=0.0,
-            max_tokens=1000
+            max_tokens=IMAGE_MAX_TOKENS
         )
         return response.choices[0].message.content.strip()
     except Exception as e:
         logging.error(f"Ошибка при обработке изображения с GPT: {e}")
-        return "Не удалось получить ответ на основе изображения."
+        return IMAGE_ERROR_ANSWER
+
+
+async def answer_question_stuffed(fragments: list, query: str) -> str:
+    """
+    Отвечает на вопрос одним запросом, в который уложены все фрагменты без повторов.
+    Если фрагменты не помещаются в бюджет токенов, используется map-reduce.
+
+    :param fragments: Фрагменты текста в порядке убывания релевантности.
+    :param query: Вопрос пользователя.
+    :return: Ответ на вопрос.
+    """
+    try:
+        packed, fits = pack_fragments(fragments, query)
+    except Exception as e:
+        # Например, словарь токенизатора не удалось загрузить
+        logging.error(f"Не удалось посчитать токены фрагментов: {e}")
+        return await answer_question_map_reduce(fragments, query)
+    if not fits:
+        logging.info(f"Фрагменты не помещаются в {stuff_token_budget} токенов, ответ будет собран через map-reduce")
+        return await answer_question_map_reduce(packed, query)
+    try:
+        return await _acomplete(_stuff_messages(packed, query), SUMMARY_MAX_TOKENS, 'gpt_stuff')
+    except Exception as e:
+        logging.error(f"Ошибка при запросе к GPT: {e}")
+        return FRAGMENT_ERROR_ANSWER
+
+
+async def answer_question(fragments: list, query: str, strategy: str = answer_strategy) -> str:
+    """
+    Отвечает на вопрос по найденным фрагментам выбранной стратегией.
+
+    :param fragments: Фрагменты текста в порядке убывания релевантности.
+    :param query: Вопрос пользователя.
+    :param strategy: stuff или map_reduce.
+    :return: Ответ на вопрос.
+    """
+    if strategy == 'stuff':
+        return await answer_question_stuffed(fragments, query)
+    return await answer_question_map_reduce(fragments, query)
+
+
+async def _astream(messages: list, max_tokens: int, stage: str = 'gpt', model: str = gpt_model):
+    """
+    Асинхронно запрашивает у GPT потоковый ответ. Повторы с backoff выполняются только до получения
+    потока; таймаут gpt_timeout действует на ожидание каждой следующей части ответа.
+    Слот gpt_concurrency занят только до открытия потока: чтение ответа идет со скоростью потребителя
+    (правок в Telegram), и удерживать слот все это время значило бы простаивать.
+
+    :param messages: Сообщения для chat.completions.
+    :param max_tokens: Максимальное количество токенов в ответе.
+    :param stage: Имя этапа для метрик.
+    :param model: Модель GPT.
+    :return: Асинхронный итератор по частям текста ответа.
+    """
+    with span(stage) as stage_span:
+        for attempt in range(gpt_retries + 1):
+            try:
+                async with _gpt_semaphore():
+                    stream = await asyncio.wait_for(
+                        async_client.chat.completions.create(
+                            model=model,
+                            messages=messages,
+                            temperature=0.0,
+                            max_tokens=max_tokens,
+                            stream=True,
+                            stream_options={"include_usage": True}
+                        ),
+                        timeout=gpt_timeout
+                    )
+                break
+            except RETRYABLE_ERRORS as e:
+                if attempt == gpt_retries:
+                    raise
+                delay = _backoff_delay(attempt)
+                logging.warning(f"Запрос к GPT не удался ({type(e).__name__}), повтор через {delay:.1f} c")
+                await asyncio.sleep(delay)
+        stage_span.set(retries=attempt)
+
+        # Поток закрывается и при таймауте, и если потребитель перестал читать ответ,
+        # иначе HTTP-соединение остается занятым в пуле клиента до сборки мусора
+        try:
+            chunks = stream.__aiter__()
+            while True:
+                try:
+                    chunk = await asyncio.wait_for(chunks.__anext__(), timeout=gpt_timeout)
+                except StopAsyncIteration:
+                    break
+                if chunk.usage is not None:
+                    stage_span.set(prompt_tokens=chunk.usage.prompt_tokens,
+                                   completion_tokens=chunk.usage.completion_tokens)
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+        finally:
+            await stream.close()
+
+
+async def astream_answer(fragments: list, query: str, strategy: str = answer_strategy):
+    """
+    Потоковый вариант answer_question: части ответа отдаются по мере генерации.
+    В режиме map_reduce потоково отдается только итоговая суммаризация.
+
+    :param fragments: Фрагменты текста в порядке убывания релевантности.
+    :param query: Вопрос пользователя.
+    :param strategy: stuff или map_reduce.
+    :return: Асинхронный итератор по частям текста ответа.
+    """
+    messages, stage, error_answer = None, 'gpt_summary', SUMMARY_ERROR_ANSWER
+    if strategy == 'stuff':
+        try:
+            packed, fits = pack_fragments(fragments, query)
+            if fits:
+                messages, stage, error_answer = _stuff_messages(packed, query), 'gpt_stuff', FRAGMENT_ERROR_ANSWER
+            else:
+                fragments = packed
+        except Exception as e:
+            logging.error(f"Не удалось посчитать токены фрагментов: {e}")
+    if messages is None:
+        answers = await _map_fragments(fragments, query)
+        if not answers:
+            yield FRAGMENT_ERROR_ANSWER
+            return
+        messages = _summary_messages(answers, query)
+
+    received = False
+    parts = _astream(messages, SUMMARY_MAX_TOKENS, stage)
+    try:
+        async for part in parts:
+            received = True
+            yield part
+    except Exception as e:
+        logging.error(f"Ошибка при потоковом запросе к GPT: {e}")
+        yield f"\n\n{error_answer}" if received else error_answer
+    finally:
+        await parts.aclose()
+
+
+async def astream_image_answer(image: PreparedImage, query: str):
+    """
+    Потоковый вариант ask_gpt_about_image.
+
+    :param image: Изображение, подготовленное prepare_image.
+    :param query: Вопрос, который нужно задать GPT в контексте данного изображения.
+    :return: Асинхронный итератор по частям текста ответа.
+    """
+    received = False
+    parts = _astream(_image_messages(image, query), IMAGE_MAX_TOKENS, 'gpt_image', IMAGE_MODEL)
+    try:
+        async for part in parts:
+            received = True
+            yield part
+    except Exception as e:
+        logging.error(f"Ошибка при обработке изображения с GPT: {e}")
+        yield f"\n\n{IMAGE_ERROR_ANSWER}" if received else IMAGE_ERROR_ANSWER
+    finally:
+        await parts.aclose()
@@ -0,0 +1,231 @@
+import base64
+import hashlib
+import io
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Optional
+
+from PIL import Image, ImageOps
+
+from src.configs import settings
+from src.modules.answer_cache import normalize_query
+from src.modules.uploads import Source, open_source
+
+
+@dataclass
+class PreparedImage:
+    """Изображение, подготовленное к отправке в GPT."""
+    base64: str
+    detail: str
+    content_hash: str
+    phash: str
+    width: int
+    height: int
+
+    @property
+    def data_url(self) -> str:
+        return f'data:image/jpeg;base64,{self.base64}'
+
+
+def perceptual_hash(image: Image.Image, size: int = settings.image_phash_size) -> str:
+    """
+    Считает разностный перцептивный хэш (dHash): изображение сжимается до (size + 1) x size в оттенках серого,
+    каждый бит - сравнение яркости соседних пикселей. Хэш не меняется при пересжатии, изменении размера
+    и небольших правках. Мелкие детали (текст на скриншотах) в хэш почти не попадают, поэтому по нему
+    сравниваются изображения только при включенном IMAGE_CACHE_SIMILAR.
+
+    :param image: Изображение.
+    :param size: Размер стороны хэша в битах (size * size бит).
+    :return: Хэш в шестнадцатеричном виде.
+    """
+    pixels = image.convert('L').resize((size + 1, size), Image.BOX).tobytes()
+    bits = 0
+    for row in range(size):
+        for col in range(size):
+            bits = (bits << 1) | (pixels[row * (size + 1) + col] > pixels[row * (size + 1) + col + 1])
+    return f'{bits:0{size * size // 4}x}'
+
+
+def choose_detail(width: int, height: int, detail: str = settings.image_detail) -> str:
+    """
+    Выбирает уровень детализации для GPT: low стоит фиксированное небольшое количество токенов,
+    поэтому для маленьких изображений в режиме auto выбирается он.
+
+    :param width: Ширина подготовленного изображения.
+    :param height: Высота подготовленного изображения.
+    :param detail: auto, low или high.
+    :return: low или high.
+    """
+    if detail != 'auto':
+        return detail
+    return 'low' if max(width, height) <= settings.image_low_detail_side else 'high'
+
+
+def prepare_image(source: Source, max_side: int = settings.image_max_side,
+                  quality: int = settings.image_jpeg_quality) -> PreparedImage:
+    """
+    Поворачивает изображение по EXIF, уменьшает до max_side по большей стороне и пережимает в JPEG.
+
+    :param source: Содержимое изображения (bytes) или путь к нему.
+    :param max_side: Максимальный размер большей стороны в пикселях.
+    :param quality: Качество JPEG.
+    :return: Подготовленное изображение.
+    """
+    with Image.open(open_source(source)) as original:
+        image = ImageOps.exif_transpose(original)
+        if image.mode != 'RGB':
+            background = Image.new('RGB', image.size, 'white')
+            background.paste(image.convert('RGBA'), mask=image.convert('RGBA').getchannel('A'))
+            image = background
+        phash = perceptual_hash(image)
+        image.thumbnail((max_side, max_side), Image.LANCZOS)
+        buffer = io.BytesIO()
+        image.save(buffer, format='JPEG', quality=quality, optimize=True)
+    data = buffer.getvalue()
+    return PreparedImage(base64=base64.b64encode(data).decode('ascii'), detail=choose_detail(*image.size),
+                         content_hash=hashlib.sha256(data).hexdigest(), phash=phash,
+                         width=image.width, height=image.height)
+
+
+def hamming_distance(first: str, second: str) -> int:
+    """Количество различающихся бит двух хэшей в шестнадцатеричном виде."""
+    return bin(int(first, 16) ^ int(second, 16)).count('1')
+
+
+class ImageAnswerCache:
+    """
+    Кэш ответов по изображениям. Ключ - пользователь, нормализованный вопрос, модель и уровень детализации,
+    а внутри него - sha256 пережатого JPEG, поэтому повторно присланное или пересланное изображение с тем же
+    вопросом не отправляется в GPT, а ответы разных пользователей не смешиваются.
+    При similar=True ищется и изображение того же пользователя, перцептивный хэш которого отличается
+    не больше чем на max_distance бит (пересжатые и повторно снятые изображения); для скриншотов
+    с текстом это небезопасно, поэтому по умолчанию выключено.
+    В памяти хранятся последние ответы (LRU), на диске - SQLite-файл с вытеснением давно не использованных записей;
+    количество записей, как в EmbeddingCache, пересчитывается только когда его верхняя оценка превышает max_items.
+    """
+
+    def __init__(self, path: str = settings.image_cache_path, memory_items: int = settings.image_cache_memory_items,
+                 max_items: int = settings.image_cache_max_items, ttl: int = settings.image_cache_ttl,
+                 similar: bool = settings.image_cache_similar, max_distance: int = settings.image_cache_max_distance):
+        """
+        :param path: Путь к файлу SQLite.
+        :param memory_items: Размер LRU-кэша в памяти.
+        :param max_items: Максимальное количество записей на диске.
+        :param ttl: Время жизни ответа в секундах.
+        :param similar: Искать похожие изображения по перцептивному хэшу.
+        :param max_distance: Максимальное расстояние Хэмминга между хэшами похожих изображений.
+        """
+        self.memory_items = memory_items
+        self.max_items = max_items
+        self.ttl = ttl
+        self.similar = similar
+        self.max_distance = max_distance
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS image_answers (query_key TEXT NOT NULL, '
+                         'content_hash TEXT NOT NULL, phash TEXT NOT NULL, answer TEXT NOT NULL, '
+                         'created REAL NOT NULL, last_used REAL NOT NULL, PRIMARY KEY (query_key, content_hash))')
+        self._db.execute('CREATE INDEX IF NOT EXISTS image_answers_last_used ON image_answers (last_used)')
+        self._db.commit()
+        self._count = self._db.execute('SELECT COUNT(*) FROM image_answers').fetchone()[0]
+
+    @staticmethod
+    def query_key(owner, image: PreparedImage, query: str, model: str = settings.image_model) -> str:
+        """
+        Формирует ключ вопроса.
+
+        :param owner: Идентификатор пользователя.
+        :param image: Подготовленное изображение (важен уровень детализации).
+        :param query: Вопрос (подпись к изображению).
+        :param model: Модель GPT.
+        :return: sha256 в шестнадцатеричном виде.
+        """
+        key = f'{owner}\n{model}\n{image.detail}\n{normalize_query(query)}'
+        return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+    def _remember(self, key: tuple, answer: str, created: float):
+        self._memory[key] = (answer, created)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_items:
+            self._memory.popitem(last=False)
+
+    def _find(self, query_key: str, image: PreparedImage, now: float) -> Optional[tuple]:
+        """
+        Ищет на диске запись того же вопроса: сначала то же изображение, затем, если включено similar,
+        изображение с ближайшим перцептивным хэшем не дальше max_distance.
+        """
+        row = self._db.execute('SELECT content_hash, answer, created FROM image_answers '
+                               'WHERE query_key = ? AND content_hash = ? AND created >= ?',
+                               (query_key, image.content_hash, now - self.ttl)).fetchone()
+        if row is not None or not self.similar:
+            return row
+        rows = self._db.execute('SELECT content_hash, phash FROM image_answers '
+                                'WHERE query_key = ? AND created >= ?', (query_key, now - self.ttl)).fetchall()
+        best = min(((hamming_distance(image.phash, phash), content_hash) for content_hash, phash in rows
+                    if len(phash) == len(image.phash)), default=None)
+        if best is None or best[0] > self.max_distance:
+            return None
+        return self._db.execute('SELECT content_hash, answer, created FROM image_answers '
+                                'WHERE query_key = ? AND content_hash = ?', (query_key, best[1])).fetchone()
+
+    def get(self, owner, image: PreparedImage, query: str) -> Optional[str]:
+        """
+        Возвращает ответ из кэша или None.
+
+        :param owner: Идентификатор пользователя.
+        :param image: Подготовленное изображение.
+        :param query: Вопрос (подпись к изображению).
+        :return: Ответ или None, если его нет или он устарел.
+        """
+        query_key = self.query_key(owner, image, query)
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get((query_key, image.content_hash))
+            if entry is not None and now - entry[1] <= self.ttl:
+                self._memory.move_to_end((query_key, image.content_hash))
+                content_hash, (answer, created) = image.content_hash, entry
+            else:
+                row = self._find(query_key, image, now)
+                if row is None:
+                    return None
+                content_hash, answer, created = row
+                self._remember((query_key, image.content_hash), answer, created)
+            self._db.execute('UPDATE image_answers SET last_used = ? WHERE query_key = ? AND content_hash = ?',
+                             (now, query_key, content_hash))
+            self._db.commit()
+            return answer
+
+    def put(self, owner, image: PreparedImage, query: str, answer: str):
+        """
+        Сохраняет ответ и при необходимости вытесняет давно не использованные записи.
+
+        :param owner: Идентификатор пользователя.
+        :param image: Подготовленное изображение.
+        :param query: Вопрос (подпись к изображению).
+        :param answer: Ответ GPT.
+        """
+        query_key = self.query_key(owner, image, query)
+        now = time.time()
+        with self._lock:
+            self._remember((query_key, image.content_hash), answer, now)
+            self._db.execute('INSERT OR REPLACE INTO image_answers '
+                             '(query_key, content_hash, phash, answer, created, last_used) VALUES (?, ?, ?, ?, ?, ?)',
+                             (query_key, image.content_hash, image.phash, answer, now, now))
+            self._count += 1
+            if self._count > self.max_items:
+                self._count = self._db.execute('SELECT COUNT(*) FROM image_answers').fetchone()[0]
+            if self._count > self.max_items:
+                # Вытесняем с запасом в 10%, чтобы не чистить кэш на каждой вставке
+                excess = self._count - int(self.max_items * 0.9)
+                self._db.execute('DELETE FROM image_answers WHERE rowid IN '
+                                 '(SELECT rowid FROM image_answers ORDER BY last_used LIMIT ?)', (excess,))
+                self._count -= excess
+            self._db.commit()
@@ -0,0 +1,190 @@
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Callable, Iterable, Optional
+
+from elasticsearch import Elasticsearch
+from elasticsearch.helpers import bulk
+from langchain_core.documents import Document
+
+from src.configs import settings
+from src.modules.elastic import ensure_owner_index, routing_for_owner
+from src.modules.embedding import get_embedding
+from src.modules.pdf_pages import iter_pdf_pages, pdf_page_count, prefetch
+from src.modules.transformer import ChunkingEngine
+from src.modules.uploads import Source, source_sha256
+
+
+@dataclass
+class IngestReport:
+    """Итоги загрузки одного документа: количество страниц и фрагментов, время по этапам в секундах."""
+    pages: int = 0
+    chunks: int = 0
+    timings: dict = field(default_factory=dict)
+    content_hash: str = ''
+
+    def add_time(self, stage: str, seconds: float):
+        self.timings[stage] = self.timings.get(stage, 0.0) + seconds
+
+    def __str__(self):
+        stages = ', '.join(f'{stage}={seconds:.2f}s' for stage, seconds in self.timings.items())
+        return f'страниц: {self.pages}, фрагментов: {self.chunks}, {stages}'
+
+
+class DocumentIngestor:
+    """
+    Загружает документ в Elasticsearch пакетами: фрагменты всех страниц собираются в окна
+    ограниченного размера, для каждого окна эмбеддинги считаются одним вызовом модели,
+    а запись выполняется через bulk API. На время загрузки обновление индекса отключается, если все загрузки
+    идут в одном процессе (см. settings.ingest_suspend_refresh).
+    """
+    text_field = 'text'
+    vector_field = 'vector'
+
+    _active_loads = {}
+    _loads_lock = threading.Lock()
+
+    def __init__(self, es: Elasticsearch, index_name: str, chunker: ChunkingEngine = None, embedding=None):
+        """
+        :param es: Клиент Elasticsearch.
+        :param index_name: Общий индекс, в который записываются фрагменты (см. index_for_owner).
+        :param chunker: Объект для очистки и разбиения текста на фрагменты по токенам.
+        :param embedding: Модель эмбеддингов. По умолчанию - get_embedding().
+        """
+        self.es = es
+        self.index_name = index_name
+        self.chunker = chunker or ChunkingEngine()
+        self.embedding = embedding or get_embedding()
+
+    def _set_refresh_interval(self, index: str, value):
+        self.es.indices.put_settings(index=index, settings={"index": {"refresh_interval": value}})
+
+    @contextmanager
+    def _refresh_suspended(self, index: str, report: IngestReport):
+        """
+        Отключает обновление индекса на время загрузки. При параллельных загрузках в один индекс
+        обновление возвращается, когда завершается последняя из них. Счетчик ведется по реальному индексу:
+        алиасы владельцев в режиме alias указывают на общий индекс, и настройки меняются у него.
+        Счетчик общий только для потоков одного процесса, поэтому при загрузке в нескольких процессах
+        (settings.ingest_suspend_refresh выключен) обновление не отключается, а индекс только обновляется в конце.
+        """
+        concrete = ','.join(sorted(self.es.indices.get_settings(index=index, name='index.refresh_interval').body))
+        suspend = settings.ingest_suspend_refresh
+        if suspend:
+            with self._loads_lock:
+                DocumentIngestor._active_loads[concrete] = DocumentIngestor._active_loads.get(concrete, 0) + 1
+                if DocumentIngestor._active_loads[concrete] == 1:
+                    self._set_refresh_interval(concrete, -1)
+        try:
+            yield
+        finally:
+            if suspend:
+                with self._loads_lock:
+                    DocumentIngestor._active_loads[concrete] -= 1
+                    if DocumentIngestor._active_loads[concrete] == 0:
+                        del DocumentIngestor._active_loads[concrete]
+                        self._set_refresh_interval(concrete, settings.elk_refresh_interval)
+            start = time.perf_counter()
+            self.es.indices.refresh(index=concrete)
+            report.add_time('refresh', time.perf_counter() - start)
+
+    @contextmanager
+    def _target(self, owner, report: IngestReport):
+        """
+        Готовит хранилище к загрузке документа владельца: создает его индекс, если нужно,
+        и отключает обновление на время загрузки.
+
+        :return: Пара (индекс, routing) для записи фрагментов.
+        """
+        index = ensure_owner_index(self.es, owner, self.index_name)
+        with self._refresh_suspended(index, report):
+            yield index, routing_for_owner(owner)
+
+    def _write(self, target, ids: list, chunks: list, vectors: list):
+        """Записывает окно фрагментов одним bulk-запросом."""
+        index, routing = target
+        actions = (
+            {
+                "_index": index,
+                "_id": chunk_id,
+                "_source": {self.text_field: chunk.page_content, self.vector_field: vector,
+                            "metadata": chunk.metadata},
+            }
+            for chunk_id, chunk, vector in zip(ids, chunks, vectors)
+        )
+        # Параметры транспорта в elasticsearch-py 8 задаются через options(), а не аргументами API
+        bulk(self.es.options(request_timeout=settings.ingest_request_timeout), actions,
+             chunk_size=settings.ingest_bulk_size, routing=routing)
+
+    def _flush(self, chunks: list, doc_id: str, first_seq: int, report: IngestReport, target):
+        """Считает эмбеддинги для окна фрагментов и записывает их в хранилище."""
+        start = time.perf_counter()
+        vectors = self.embedding.embed_documents([chunk.page_content for chunk in chunks])
+        report.add_time('embed', time.perf_counter() - start)
+
+        start = time.perf_counter()
+        self._write(target, [f'{doc_id}:{first_seq + i}' for i in range(len(chunks))], chunks, vectors)
+        report.add_time('index', time.perf_counter() - start)
+        report.chunks += len(chunks)
+
+    def ingest_pages(self, pages: Iterable[Document], metadata: dict, total_pages: Optional[int] = None,
+                     on_progress: Optional[Callable[[int, Optional[int]], None]] = None) -> IngestReport:
+        """
+        Разбивает страницы на фрагменты пакетами по chunk_batch_pages страниц и записывает их в индекс
+        окнами по ingest_window_chunks фрагментов.
+
+        :param pages: Страницы документа (может быть ленивым итератором).
+        :param metadata: Общие метаданные документа: doc_owner, doc_id, file_name.
+        :param total_pages: Количество страниц документа, если известно.
+        :param on_progress: Вызывается после каждой страницы с количеством обработанных страниц и total_pages.
+        :return: Отчет о загрузке.
+        """
+        report = IngestReport()
+        window, batch = [], []
+        pages = iter(pages)
+        self.chunker.reset()
+        with self._target(metadata['doc_owner'], report) as target:
+            while True:
+                start = time.perf_counter()
+                page = next(pages, None)
+                report.add_time('parse', time.perf_counter() - start)
+                if page is not None:
+                    report.pages += 1
+                    batch.append((page.page_content, {**metadata, 'page_number': page.metadata['page']}))
+                if page is None or len(batch) >= settings.chunk_batch_pages:
+                    start = time.perf_counter()
+                    window.extend(self.chunker.split_pages(batch, final=page is None))
+                    report.add_time('split', time.perf_counter() - start)
+                    batch = []
+                if page is None:
+                    break
+
+                if len(window) >= settings.ingest_window_chunks:
+                    self._flush(window, metadata['doc_id'], report.chunks, report, target)
+                    window = []
+                if on_progress is not None:
+                    on_progress(report.pages, total_pages)
+            if window:
+                self._flush(window, metadata['doc_id'], report.chunks, report, target)
+        logging.info(f"Документ {metadata['doc_id']} загружен: {report}")
+        return report
+
+    def ingest_pdf(self, source: Source, metadata: dict,
+                   on_progress: Optional[Callable[[int, Optional[int]], None]] = None,
+                   content_hash: Optional[str] = None) -> IngestReport:
+        """
+        Загружает PDF-файл постранично: страницы извлекаются в фоне (для больших файлов - в нескольких процессах)
+        и передаются на разбиение и индексацию через очередь ограниченного размера.
+
+        :param source: Содержимое PDF-файла (bytes) или путь к нему.
+        :param metadata: Общие метаданные документа: doc_owner, doc_id, file_name.
+        :param on_progress: Вызывается после каждой страницы с количеством обработанных и всех страниц.
+        :param content_hash: sha256 содержимого, если уже посчитан при загрузке.
+        :return: Отчет о загрузке.
+        """
+        pages = prefetch(iter_pdf_pages(source, metadata.get('file_name', '')))
+        report = self.ingest_pages(pages, metadata, pdf_page_count(source), on_progress)
+        report.content_hash = content_hash or source_sha256(source)
+        return report
@@ -0,0 +1,462 @@
+import asyncio
+import json
+import logging
+import math
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from functools import lru_cache
+from typing import Awaitable, Callable, Optional
+
+import numpy as np
+from langchain_core.documents import Document
+from nltk.stem.snowball import SnowballStemmer
+
+from src.configs import settings
+from src.modules.elastic import reciprocal_rank_fusion
+from src.modules.embedding import get_embedding
+from src.modules.ingestion import DocumentIngestor, IngestReport
+from src.modules.transformer import ChunkingEngine
+
+TOKEN_PATTERN = re.compile(r'\w+')
+BM25_K1 = 1.2
+BM25_B = 0.75
+# Поля записи реестра документов и соответствующие столбцы таблицы documents
+DOCUMENT_FIELDS = ('doc_owner', 'doc_id', 'file_name', 'pages', 'chunks', 'content_hash', 'ingested_at')
+DOCUMENT_COLUMNS = ('owner', 'doc_id', 'file_name', 'pages', 'chunks', 'content_hash', 'ingested_at')
+
+_stemmer = SnowballStemmer('russian')
+
+
+@lru_cache(maxsize=200000)
+def _stem(word: str) -> str:
+    return _stemmer.stem(word)
+
+
+def analyze(text: str) -> list:
+    """Разбивает текст на термы BM25: слова в нижнем регистре со стеммингом, как русский анализатор Elasticsearch."""
+    return [_stem(word) for word in TOKEN_PATTERN.findall(text.lower())]
+
+
+class LocalVectorStore:
+    """
+    Встроенное хранилище фрагментов для небольших и автономных установок, без Elasticsearch.
+    Векторы хранятся в отображаемой в память матрице float16 (файл vectors.f16), тексты, метаданные и реестр
+    документов - в SQLite (store.sqlite3) в том же каталоге. Инвертированный индекс BM25 и списки фрагментов
+    по владельцам держатся в памяти и строятся из SQLite при открытии.
+    Поиск по векторам - точный косинусный top-k пакетами по search_batch строк: для тысяч и десятков тысяч
+    фрагментов это быстрее сетевого запроса к Elasticsearch.
+    """
+
+    def __init__(self, path: str = settings.local_store_path, dims: int = settings.elk_vector_dims,
+                 search_batch: int = settings.local_search_batch):
+        """
+        :param path: Каталог хранилища.
+        :param dims: Размерность векторов.
+        :param search_batch: Количество строк матрицы, обрабатываемых за один шаг поиска.
+        """
+        self.path = path
+        self.dims = dims
+        self.search_batch = search_batch
+        self._lock = threading.RLock()
+        os.makedirs(path, exist_ok=True)
+        self._vectors_path = os.path.join(path, 'vectors.f16')
+        self._db = sqlite3.connect(os.path.join(path, 'store.sqlite3'), timeout=30, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS chunks (row INTEGER PRIMARY KEY, id TEXT NOT NULL, '
+                         'owner TEXT NOT NULL, doc_id TEXT NOT NULL, text TEXT NOT NULL, metadata TEXT NOT NULL, '
+                         'deleted INTEGER NOT NULL DEFAULT 0, UNIQUE (owner, id))')
+        self._db.execute('CREATE INDEX IF NOT EXISTS chunks_document ON chunks (owner, doc_id)')
+        self._db.execute('CREATE TABLE IF NOT EXISTS documents (owner TEXT NOT NULL, doc_id TEXT NOT NULL, '
+                         'file_name TEXT NOT NULL, pages INTEGER NOT NULL, chunks INTEGER NOT NULL, '
+                         'content_hash TEXT NOT NULL, ingested_at INTEGER NOT NULL, PRIMARY KEY (owner, doc_id))')
+        self._db.commit()
+        self._load()
+
+    def _open_matrix(self, capacity: int):
+        """Открывает файл векторов на capacity строк, при необходимости увеличивая его."""
+        size = capacity * self.dims * 2
+        with open(self._vectors_path, 'ab') as file:
+            if file.tell() < size:
+                file.truncate(size)
+        self._matrix = np.memmap(self._vectors_path, dtype=np.float16, mode='r+', shape=(capacity, self.dims))
+
+    def _load(self):
+        """Строит индексы в памяти по данным из SQLite."""
+        self._size = (self._db.execute('SELECT MAX(row) FROM chunks').fetchone()[0] or -1) + 1
+        capacity = max(1024, os.path.getsize(self._vectors_path) // (self.dims * 2)
+                       if os.path.exists(self._vectors_path) else 0, self._size)
+        self._open_matrix(capacity)
+        self._alive = np.zeros(capacity, dtype=bool)
+        self._lengths = np.zeros(capacity, dtype=np.float32)
+        self._postings = {}
+        self._row_terms = {}
+        self._owner_rows = {}
+        self._owner_arrays = {}
+        for row, owner, text in self._db.execute('SELECT row, owner, text FROM chunks WHERE deleted = 0'):
+            self._index_row(row, owner, text)
+        logging.info(f'Локальное хранилище {self.path} открыто: фрагментов {self.count()}')
+
+    def _grow(self, rows: int):
+        capacity = len(self._alive)
+        if rows <= capacity:
+            return
+        new_capacity = max(rows, capacity * 2)
+        self._matrix.flush()
+        del self._matrix
+        self._open_matrix(new_capacity)
+        self._alive = np.concatenate([self._alive, np.zeros(new_capacity - capacity, dtype=bool)])
+        self._lengths = np.concatenate([self._lengths, np.zeros(new_capacity - capacity, dtype=np.float32)])
+
+    def _index_row(self, row: int, owner: str, text: str):
+        terms = Counter(analyze(text))
+        for term, tf in terms.items():
+            self._postings.setdefault(term, {})[row] = tf
+        self._row_terms[row] = (owner, tuple(terms))
+        self._lengths[row] = sum(terms.values())
+        self._alive[row] = True
+        self._owner_rows.setdefault(owner, set()).add(row)
+        self._owner_arrays.pop(owner, None)
+
+    def _unindex_row(self, row: int):
+        owner, terms = self._row_terms.pop(row)
+        for term in terms:
+            postings = self._postings[term]
+            del postings[row]
+            if not postings:
+                del self._postings[term]
+        self._alive[row] = False
+        self._lengths[row] = 0
+        self._owner_rows[owner].discard(row)
+        self._owner_arrays.pop(owner, None)
+
+    def count(self) -> int:
+        """Количество неудаленных фрагментов."""
+        return int(self._alive.sum())
+
+    def _candidate_rows(self, owner) -> np.ndarray:
+        """Строки, по которым идет поиск: фрагменты владельца или все неудаленные фрагменты."""
+        if owner is None:
+            return np.flatnonzero(self._alive[:self._size])
+        owner = str(owner)
+        rows = self._owner_arrays.get(owner)
+        if rows is None:
+            rows = self._owner_arrays[owner] = np.array(sorted(self._owner_rows.get(owner, ())), dtype=np.int64)
+        return rows
+
+    def upsert(self, ids: list, chunks: list, vectors: list, owner):
+        """
+        Записывает фрагменты; фрагмент с уже существующим идентификатором перезаписывается на том же месте.
+
+        :param ids: Идентификаторы фрагментов.
+        :param chunks: Объекты Document с текстом и метаданными.
+        :param vectors: Векторы фрагментов.
+        :param owner: Владелец документа.
+        """
+        owner = str(owner)
+        vectors = np.asarray(vectors, dtype=np.float32)
+        vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+        with self._lock:
+            placeholders = ','.join('?' * len(ids))
+            existing = dict(self._db.execute(f'SELECT id, row FROM chunks WHERE owner = ? AND id IN ({placeholders})',
+                                             [owner, *ids]))
+            rows = []
+            for chunk_id in ids:
+                row = existing.get(chunk_id)
+                if row is None:
+                    row = self._size
+                    self._size += 1
+                elif row in self._row_terms:
+                    self._unindex_row(row)
+                rows.append(row)
+            self._grow(self._size)
+            self._matrix[rows] = vectors.astype(np.float16)
+            self._db.executemany('INSERT OR REPLACE INTO chunks (row, id, owner, doc_id, text, metadata, deleted) '
+                                 'VALUES (?, ?, ?, ?, ?, ?, 0)',
+                                 [(row, chunk_id, owner, chunk.metadata.get('doc_id', ''), chunk.page_content,
+                                   json.dumps(chunk.metadata, ensure_ascii=False))
+                                  for row, chunk_id, chunk in zip(rows, ids, chunks)])
+            for row, chunk in zip(rows, chunks):
+                self._index_row(row, owner, chunk.page_content)
+
+    def commit(self):
+        """Сбрасывает векторы и записи на диск."""
+        with self._lock:
+            self._matrix.flush()
+            self._db.commit()
+
+    def delete_document(self, owner, doc_id: str) -> int:
+        """
+        Удаляет фрагменты документа и его запись в реестре. Место в файле векторов не освобождается.
+
+        :return: Количество удаленных фрагментов.
+        """
+        with self._lock:
+            rows = [row for row, in self._db.execute('SELECT row FROM chunks WHERE owner = ? AND doc_id = ? '
+                                                     'AND deleted = 0', (str(owner), doc_id))]
+            for row in rows:
+                self._unindex_row(row)
+            self._db.execute('UPDATE chunks SET deleted = 1 WHERE owner = ? AND doc_id = ?', (str(owner), doc_id))
+            self._db.execute('DELETE FROM documents WHERE owner = ? AND doc_id = ?', (str(owner), doc_id))
+            self._db.commit()
+            return len(rows)
+
+    def add_document(self, record: dict):
+        """Записывает документ в реестр (поля как у DocumentRegistry)."""
+        with self._lock:
+            self._db.execute(f'INSERT OR REPLACE INTO documents ({", ".join(DOCUMENT_COLUMNS)}) '
+                             f'VALUES ({", ".join("?" * len(DOCUMENT_COLUMNS))})',
+                             [record[field] for field in DOCUMENT_FIELDS])
+            self._db.commit()
+
+    def find_documents(self, owner, content_hash: Optional[str] = None, limit: int = settings.registry_max_docs,
+                       doc_id: Optional[str] = None):
+        """
+        Возвращает записи реестра владельца, начиная с последних загруженных.
+
+        :param owner: Идентификатор пользователя.
+        :param content_hash: Если задан, только документы с этим хэшем содержимого.
+        :param doc_id: Если задан, только документ с этим идентификатором.
+        :param limit: Максимальное количество записей.
+        :return: Список записей с полями как у DocumentRegistry.
+        """
+        where, params = 'owner = ?', [str(owner)]
+        if content_hash is not None:
+            where, params = f'{where} AND content_hash = ?', params + [content_hash]
+        if doc_id is not None:
+            where, params = f'{where} AND doc_id = ?', params + [doc_id]
+        with self._lock:
+            rows = self._db.execute(f'SELECT {", ".join(DOCUMENT_COLUMNS)} FROM documents WHERE {where} '
+                                    f'ORDER BY ingested_at DESC LIMIT ?', (*params, limit)).fetchall()
+        return [dict(zip(DOCUMENT_FIELDS, row)) for row in rows]
+
+    def clear_documents(self):
+        """Очищает реестр документов, не трогая фрагменты."""
+        with self._lock:
+            self._db.execute('DELETE FROM documents')
+            self._db.commit()
+
+    def clear(self):
+        """Удаляет все фрагменты и реестр документов."""
+        with self._lock:
+            self._db.execute('DELETE FROM chunks')
+            self._db.execute('DELETE FROM documents')
+            self._db.commit()
+            self._matrix.flush()
+            del self._matrix
+            os.remove(self._vectors_path)
+            self._load()
+
+    def search_bm25(self, query: str, k: int, owner=None) -> list:
+        """
+        Полнотекстовый поиск BM25.
+
+        :return: Список пар (строка, балл) по убыванию балла, только с ненулевым баллом.
+        """
+        with self._lock:
+            alive = self.count()
+            if not alive:
+                return []
+            avg_length = float(self._lengths.sum()) / alive
+            scores = np.zeros(self._size, dtype=np.float32)
+            for term in set(analyze(query)):
+                postings = self._postings.get(term)
+                if not postings:
+                    continue
+                rows = np.fromiter(postings.keys(), dtype=np.int64, count=len(postings))
+                tfs = np.fromiter(postings.values(), dtype=np.float32, count=len(postings))
+                idf = math.log(1 + (alive - len(postings) + 0.5) / (len(postings) + 0.5))
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * self._lengths[rows] / avg_length)
+                scores[rows] += idf * tfs * (BM25_K1 + 1) / (tfs + norm)
+            candidates = self._candidate_rows(owner)
+        return self._top_k(candidates, scores[candidates], k, positive=True)
+
+    def search_vectors(self, vector: list, k: int, owner=None) -> list:
+        """
+        Точный поиск ближайших по косинусу векторов пакетами строк.
+
+        :return: Список пар (строка, косинусная близость) по убыванию близости.
+        """
+        query = np.asarray(vector, dtype=np.float32)
+        query /= max(float(np.linalg.norm(query)), 1e-12)
+        with self._lock:
+            candidates = self._candidate_rows(owner)
+            best_rows, best_scores = np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+            for start in range(0, len(candidates), self.search_batch):
+                rows = candidates[start:start + self.search_batch]
+                scores = self._matrix[rows].astype(np.float32) @ query
+                best_rows = np.concatenate([best_rows, rows])
+                best_scores = np.concatenate([best_scores, scores])
+                if len(best_rows) > k:
+                    keep = np.argpartition(-best_scores, k)[:k]
+                    best_rows, best_scores = best_rows[keep], best_scores[keep]
+        return self._top_k(best_rows, best_scores, k)
+
+    @staticmethod
+    def _top_k(rows: np.ndarray, scores: np.ndarray, k: int, positive: bool = False) -> list:
+        if positive:
+            mask = scores > 0
+            rows, scores = rows[mask], scores[mask]
+        if len(rows) > k:
+            keep = np.argpartition(-scores, k)[:k]
+            rows, scores = rows[keep], scores[keep]
+        order = np.argsort(-scores, kind='stable')
+        return [(int(rows[i]), float(scores[i])) for i in order]
+
+    def documents(self, ranked: list) -> list:
+        """
+        Загружает фрагменты найденных строк.
+
+        :param ranked: Список пар (строка, балл).
+        :return: Список пар (Document, балл) в том же порядке.
+        """
+        if not ranked:
+            return []
+        with self._lock:
+            placeholders = ','.join('?' * len(ranked))
+            found = {row: (chunk_id, text, metadata) for row, chunk_id, text, metadata in self._db.execute(
+                f'SELECT row, id, text, metadata FROM chunks WHERE row IN ({placeholders})', [row for row, _ in ranked])}
+        return [(Document(id=found[row][0], page_content=found[row][1], metadata=json.loads(found[row][2])), score)
+                for row, score in ranked if row in found]
+
+
+@lru_cache(maxsize=None)
+def get_local_store(path: str = settings.local_store_path) -> LocalVectorStore:
+    """Возвращает хранилище каталога path (одно на процесс, общее для поиска и загрузки документов)."""
+    return LocalVectorStore(path)
+
+
+class LocalBM25Handler:
+    """
+    Полнотекстовый поиск BM25 по встроенному хранилищу; тот же интерфейс, что у BM25Handler.
+    Поиск выполняется в потоке: он занимает процессор и ждет блокировку хранилища, пока идет запись документа.
+    """
+
+    def __init__(self, store: LocalVectorStore):
+        self.store = store
+
+    def _search(self, query: str, k: int, owner) -> list:
+        return self.store.documents(self.store.search_bm25(query, k, owner))
+
+    async def asimilarity_search_with_relevance_scores(self, query: str, k: int = settings.retrieval_top_k,
+                                                       owner=None) -> list:
+        """
+        Ищет фрагменты, релевантные запросу.
+
+        :param query: Текст запроса.
+        :param k: Количество фрагментов.
+        :param owner: Если задан, поиск идет только по документам этого пользователя.
+        :return: Список пар (Document, балл BM25), отсортированный по убыванию балла.
+        """
+        return await asyncio.to_thread(self._search, query, k, owner)
+
+
+class LocalHybridHandler(LocalBM25Handler):
+    """Гибридный поиск по встроенному хранилищу: BM25 и косинусный kNN, объединенные через RRF."""
+
+    @property
+    def embedding(self):
+        return get_embedding()
+
+    def _fuse(self, query: str, vector: list, k: int, owner) -> list:
+        size = max(settings.hybrid_candidates, k)
+        bm25 = self.store.search_bm25(query, size, owner)
+        knn = self.store.search_vectors(vector, size, owner)
+        fused = reciprocal_rank_fusion([[row for row, _ in bm25], [row for row, _ in knn]],
+                                       [settings.hybrid_bm25_weight, settings.hybrid_knn_weight])
+        return self.store.documents(fused[:k])
+
+    async def asimilarity_search_with_relevance_scores(self, query: str, k: int = settings.retrieval_top_k,
+                                                       owner=None) -> list:
+        """
+        Ищет фрагменты, релевантные запросу, сразу двумя способами и объединяет выдачу.
+
+        :param query: Текст запроса.
+        :param k: Количество фрагментов в итоговой выдаче.
+        :param owner: Если задан, поиск идет только по документам этого пользователя.
+        :return: Список пар (Document, балл RRF), отсортированный по убыванию балла.
+        """
+        vector = await asyncio.to_thread(self.embedding.embed_query, query)
+        return await asyncio.to_thread(self._fuse, query, vector, k, owner)
+
+
+class LocalDocumentIngestor(DocumentIngestor):
+    """Загрузка документов во встроенное хранилище: разбиение и эмбеддинги те же, запись - в LocalVectorStore."""
+
+    def __init__(self, store: LocalVectorStore, chunker: ChunkingEngine = None, embedding=None):
+        """
+        :param store: Встроенное хранилище.
+        :param chunker: Объект для очистки и разбиения текста на фрагменты по токенам.
+        :param embedding: Модель эмбеддингов. По умолчанию - get_embedding().
+        """
+        self.store = store
+        self.chunker = chunker or ChunkingEngine()
+        self.embedding = embedding or get_embedding()
+
+    @contextmanager
+    def _target(self, owner, report: IngestReport):
+        try:
+            yield owner
+        finally:
+            start = time.perf_counter()
+            self.store.commit()
+            report.add_time('refresh', time.perf_counter() - start)
+
+    def _write(self, target, ids: list, chunks: list, vectors: list):
+        self.store.upsert(ids, chunks, vectors, target)
+
+
+class LocalDocumentRegistry:
+    """
+    Реестр загруженных документов во встроенном хранилище; тот же интерфейс, что у DocumentRegistry.
+    Запросы к SQLite выполняются в потоке, чтобы не блокировать цикл событий.
+    """
+
+    def __init__(self, store: LocalVectorStore):
+        self.store = store
+
+    async def ensure_index(self):
+        pass
+
+    async def recreate_index(self):
+        await asyncio.to_thread(self.store.clear_documents)
+
+    async def add(self, owner, doc_id: str, file_name: str, pages: int, chunks: int, content_hash: str):
+        """Записывает документ в реестр после успешной загрузки."""
+        await asyncio.to_thread(self.store.add_document, {"doc_owner": str(owner), "doc_id": doc_id, "file_name": file_name, "pages": pages,
+                                 "chunks": chunks, "content_hash": content_hash, "ingested_at": int(time.time())})
+
+    async def list(self, owner) -> list:
+        """
+        Возвращает документы пользователя, начиная с последних загруженных.
+
+        :param owner: Идентификатор пользователя.
+        :return: Список записей реестра.
+        """
+        return await asyncio.to_thread(self.store.find_documents, owner, limit=settings.registry_max_docs)
+
+    async def get(self, owner, doc_id: str) -> Optional[dict]:
+        """Возвращает запись реестра о документе пользователя или None."""
+        found = await asyncio.to_thread(self.store.find_documents, owner, limit=1, doc_id=doc_id)
+        return found[0] if found else None
+
+    async def find_by_hash(self, owner, content_hash: str) -> Optional[dict]:
+        """Ищет у пользователя документ с тем же содержимым."""
+        found = await asyncio.to_thread(self.store.find_documents, owner, content_hash, limit=1)
+        return found[0] if found else None
+
+    async def delete(self, owner, doc_id: str,
+                     on_progress: Optional[Callable[[int, int], Awaitable]] = None) -> int:
+        """
+        Удаляет фрагменты документа и запись из реестра.
+
+        :param owner: Идентификатор пользователя.
+        :param doc_id: Идентификатор документа.
+        :param on_progress: Не используется: удаление выполняется сразу.
+        :return: Количество удаленных фрагментов.
+        """
+        return await asyncio.to_thread(self.store.delete_document, owner, doc_id)
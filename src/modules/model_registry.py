@@ -0,0 +1,172 @@
+import gc
+import logging
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Optional
+
+from src.configs import settings
+
+
+class ModelRegistry:
+    """
+    Реестр тяжелых моделей с ленивой потокобезопасной загрузкой при первом обращении
+    и выгрузкой моделей, которые не использовались дольше idle_ttl секунд.
+    Одна и та же модель может иметь несколько экземпляров (например, по одному на воркер) - они
+    различаются ключом instance. Модель, занятая задачей (use), не выгружается, сколько бы задача ни длилась.
+    """
+
+    def __init__(self, idle_ttl: int = settings.model_idle_ttl,
+                 check_interval: int = settings.model_idle_check_interval):
+        """
+        :param idle_ttl: Через сколько секунд простоя модель выгружается; 0 - не выгружать.
+        :param check_interval: Период проверки простоя в секундах.
+        """
+        self.idle_ttl = idle_ttl
+        self.check_interval = check_interval
+        self._factories = {}
+        self._models = {}
+        self._last_used = {}
+        self._in_use = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+        self._unloader = None
+
+    def register(self, name: str, factory: Callable):
+        """
+        Регистрирует модель без загрузки.
+
+        :param name: Имя модели.
+        :param factory: Функция, создающая экземпляр модели.
+        """
+        self._factories[name] = factory
+
+    def is_loaded(self, name: str, instance: Optional[str] = None) -> bool:
+        return (name, instance) in self._models
+
+    def get(self, name: str, instance: Optional[str] = None):
+        """
+        Возвращает модель, загружая ее при первом обращении. Параллельные обращения
+        к еще не загруженной модели дожидаются одной загрузки.
+
+        :param name: Имя модели.
+        :param instance: Ключ экземпляра, если нужны отдельные экземпляры (например, имя воркера).
+        :return: Экземпляр модели.
+        """
+        key = (name, instance)
+        model = self._models.get(key)
+        if model is None:
+            with self._lock:
+                key_lock = self._locks.setdefault(key, threading.Lock())
+            with key_lock:
+                model = self._models.get(key)
+                if model is None:
+                    start = time.perf_counter()
+                    model = self._factories[name]()
+                    self._models[key] = model
+                    logging.info(f'Модель {name} ({instance or "общая"}) загружена за '
+                                 f'{time.perf_counter() - start:.1f} c')
+                    self._start_unloader()
+        self._last_used[key] = time.monotonic()
+        return model
+
+    @contextmanager
+    def use(self, name: str, instance: Optional[str] = None):
+        """
+        Выдает модель на время задачи: пока блок не завершен, модель не выгружается,
+        а время последнего использования отсчитывается от конца задачи.
+
+        :param name: Имя модели.
+        :param instance: Ключ экземпляра.
+        :return: Экземпляр модели.
+        """
+        key = (name, instance)
+        # Счетчик увеличивается до get: выгрузка проверяет его под той же блокировкой
+        with self._lock:
+            self._in_use[key] = self._in_use.get(key, 0) + 1
+        try:
+            yield self.get(name, instance)
+        finally:
+            with self._lock:
+                self._in_use[key] -= 1
+                if not self._in_use[key]:
+                    del self._in_use[key]
+                self._last_used[key] = time.monotonic()
+
+    def unload(self, name: str, instance: Optional[str] = None, idle_before: Optional[float] = None) -> bool:
+        """
+        Выгружает модель; следующий get загрузит ее заново.
+
+        :param name: Имя модели.
+        :param instance: Ключ экземпляра.
+        :param idle_before: Если задан, модель выгружается, только если не занята задачей
+            и последний раз использовалась раньше этого момента (time.monotonic()).
+        :return: True, если модель выгружена.
+        """
+        key = (name, instance)
+        with self._lock:
+            key_lock = self._locks.setdefault(key, threading.Lock())
+        with key_lock, self._lock:
+            if idle_before is not None and (self._in_use.get(key) or self._last_used.get(key, 0) >= idle_before):
+                return False
+            if self._models.pop(key, None) is None:
+                return False
+            self._last_used.pop(key, None)
+        gc.collect()
+        torch = sys.modules.get('torch')
+        if torch is not None and torch.cuda.is_available():
+            torch.cuda.empty_cache()
+        logging.info(f'Модель {name} ({instance or "общая"}) выгружена после простоя')
+        return True
+
+    def unload_idle(self) -> list:
+        """
+        Выгружает модели, простаивающие дольше idle_ttl.
+
+        :return: Список выгруженных ключей (имя, экземпляр).
+        """
+        if not self.idle_ttl:
+            return []
+        deadline = time.monotonic() - self.idle_ttl
+        with self._lock:
+            idle = [key for key, last_used in self._last_used.items()
+                    if last_used < deadline and not self._in_use.get(key)]
+        return [(name, instance) for name, instance in idle if self.unload(name, instance, idle_before=deadline)]
+
+    def _start_unloader(self):
+        """Запускает в текущем процессе фоновый поток, выгружающий простаивающие модели."""
+        if not self.idle_ttl or self._unloader is not None:
+            return
+
+        def loop():
+            while True:
+                time.sleep(self.check_interval)
+                try:
+                    self.unload_idle()
+                except Exception as ex:
+                    logging.error(f'Ошибка при выгрузке моделей: {ex}')
+
+        self._unloader = threading.Thread(target=loop, name='model-unloader', daemon=True)
+        self._unloader.start()
+
+
+def _create_embedding():
+    from src.modules.embedding import create_embedding
+    return create_embedding()
+
+
+def _create_whisper():
+    from src.modules.whisper_handler import WhisperHandler
+    return WhisperHandler()
+
+
+def _create_reranker():
+    from src.modules.reranker import CrossEncoderReranker
+    return CrossEncoderReranker()
+
+
+models = ModelRegistry()
+models.register('embedding', _create_embedding)
+models.register('whisper', _create_whisper)
+models.register('reranker', _create_reranker)
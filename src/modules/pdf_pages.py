@@ -0,0 +1,126 @@
+import multiprocessing
+import queue
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+from typing import Iterable, Iterator
+
+from langchain_core.documents import Document
+from pypdf import PdfReader
+
+from src.configs import settings
+from src.modules.uploads import Source, open_source
+
+_END = object()
+
+
+def pdf_page_count(source: Source) -> int:
+    """Возвращает количество страниц PDF-файла без извлечения текста."""
+    return len(PdfReader(open_source(source)).pages)
+
+
+def extract_page_range(source: Source, start: int, stop: int) -> list:
+    """
+    Задача процесса: извлекает текст страниц с start по stop (не включая).
+
+    :param source: Содержимое PDF-файла (bytes) или путь к нему.
+    :param start: Номер первой страницы (с нуля).
+    :param stop: Номер страницы, следующей за последней.
+    :return: Список текстов страниц.
+    """
+    reader = PdfReader(open_source(source))
+    return [reader.pages[number].extract_text() for number in range(start, stop)]
+
+
+def _page_document(name: str, number: int, text: str) -> Document:
+    """Страница в том же виде, что возвращает PyPDFLoader."""
+    return Document(page_content=text, metadata={'source': name, 'page': number})
+
+
+def iter_pdf_pages(source: Source, name: str = '', processes: int = settings.pdf_extract_processes,
+                   range_pages: int = settings.pdf_range_pages) -> Iterator[Document]:
+    """
+    Лениво возвращает страницы PDF-файла по порядку.
+    Небольшие файлы читаются постранично в текущем процессе. Для файлов от pdf_parallel_min_pages страниц
+    текст извлекается параллельно в нескольких процессах диапазонами по range_pages страниц;
+    одновременно обрабатывается не больше двух диапазонов на процесс, поэтому память не зависит от размера файла.
+
+    :param source: Содержимое PDF-файла (bytes) или путь к нему. Большие файлы лучше передавать путем:
+        содержимое в памяти копируется в каждую задачу процесса.
+    :param name: Имя файла для метаданных страниц.
+    :param processes: Количество процессов для извлечения текста; 1 - без параллельности.
+    :param range_pages: Количество страниц в одном диапазоне.
+    :return: Итератор страниц.
+    """
+    reader = PdfReader(open_source(source))
+    total = len(reader.pages)
+    if processes <= 1 or total < settings.pdf_parallel_min_pages:
+        for number, page in enumerate(reader.pages):
+            yield _page_document(name, number, page.extract_text())
+        return
+    del reader
+
+    ranges = ((start, min(start + range_pages, total)) for start in range(0, total, range_pages))
+    executor = ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context('spawn'))
+    try:
+        in_flight = deque((start, executor.submit(extract_page_range, source, start, stop))
+                          for start, stop in islice(ranges, processes * 2))
+        while in_flight:
+            start, future = in_flight.popleft()
+            texts = future.result()
+            next_range = next(ranges, None)
+            if next_range is not None:
+                in_flight.append((next_range[0], executor.submit(extract_page_range, source, *next_range)))
+            for offset, text in enumerate(texts):
+                yield _page_document(name, start + offset, text)
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def prefetch(items: Iterable, maxsize: int = settings.ingest_page_queue) -> Iterator:
+    """
+    Читает элементы в отдельном потоке через очередь ограниченного размера, чтобы извлечение
+    следующих страниц шло одновременно с разбиением и индексацией предыдущих. Если очередь заполнена,
+    чтение приостанавливается. Ошибка чтения пробрасывается потребителю.
+
+    :param items: Исходный итератор.
+    :param maxsize: Максимальное количество прочитанных, но еще не обработанных элементов.
+    :return: Итератор тех же элементов в том же порядке.
+    """
+    buffer = queue.Queue(maxsize=maxsize)
+    stopped = threading.Event()
+
+    def put(entry) -> bool:
+        while not stopped.is_set():
+            try:
+                buffer.put(entry, timeout=0.5)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in items:
+                if not put((item, None)):
+                    return
+            put((_END, None))
+        except Exception as ex:
+            put((_END, ex))
+        finally:
+            close = getattr(items, 'close', None)
+            if close is not None:
+                close()
+
+    threading.Thread(target=produce, name='pdf-prefetch', daemon=True).start()
+    try:
+        while True:
+            item, error = buffer.get()
+            if item is _END:
+                if error is not None:
+                    raise error
+                return
+            yield item
+    finally:
+        stopped.set()
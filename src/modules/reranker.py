@@ -0,0 +1,62 @@
+import logging
+import threading
+
+import torch
+from sentence_transformers import CrossEncoder
+
+from src.configs import settings
+
+
+class CrossEncoderReranker:
+    """
+    Переранжирование найденных фрагментов небольшой многоязычной моделью cross-encoder на CPU.
+    Модель оценивает пару (вопрос, фрагмент) целиком, поэтому точнее BM25 и kNN; фрагменты с оценкой
+    ниже порога отбрасываются, в GPT уходят только лучшие.
+    """
+
+    def __init__(self, model_name: str = settings.rerank_model, batch_size: int = settings.rerank_batch_size,
+                 max_length: int = settings.rerank_max_length, quantize: bool = settings.rerank_quantize):
+        """
+        :param model_name: Имя модели cross-encoder на HuggingFace.
+        :param batch_size: Количество пар в одном проходе модели.
+        :param max_length: Максимальная длина пары в токенах.
+        :param quantize: Динамически квантовать линейные слои в int8 (быстрее на CPU, точность почти не меняется).
+        """
+        self.batch_size = batch_size
+        self.model = CrossEncoder(model_name, max_length=max_length, device='cpu')
+        if quantize:
+            self.model.model = torch.quantization.quantize_dynamic(self.model.model, {torch.nn.Linear},
+                                                                   dtype=torch.qint8)
+        # Параллельные вызовы на CPU только мешают друг другу, поэтому пакеты считаются по очереди
+        self._lock = threading.Lock()
+        logging.info(f'Модель переранжирования {model_name} загружена (int8: {quantize})')
+
+    def score(self, query: str, texts: list) -> list:
+        """
+        Оценивает релевантность фрагментов вопросу.
+
+        :param query: Вопрос пользователя.
+        :param texts: Тексты фрагментов.
+        :return: Оценки от 0 до 1 в порядке фрагментов.
+        """
+        with self._lock, torch.inference_mode():
+            scores = self.model.predict([(query, text) for text in texts], batch_size=self.batch_size,
+                                        show_progress_bar=False, convert_to_numpy=True)
+        return scores.tolist()
+
+    def rerank(self, query: str, documents: list, top_n: int = settings.rerank_top_n,
+               min_score: float = settings.rerank_min_score) -> list:
+        """
+        Переранжирует результаты поиска.
+
+        :param query: Вопрос пользователя.
+        :param documents: Список пар (Document, score) из поиска.
+        :param top_n: Сколько лучших фрагментов оставить.
+        :param min_score: Фрагменты с оценкой ниже порога отбрасываются.
+        :return: Список пар (Document, оценка cross-encoder) по убыванию оценки.
+        """
+        if not documents:
+            return []
+        scores = self.score(query, [doc.page_content for doc, _ in documents])
+        ranked = sorted(zip((doc for doc, _ in documents), scores), key=lambda pair: pair[1], reverse=True)
+        return [(doc, score) for doc, score in ranked if score >= min_score][:top_n]
@@ -0,0 +1,220 @@
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Optional
+
+from aiogram import BaseMiddleware
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StorageKey
+
+from src.configs import settings
+
+
+class MemoryStateStore:
+    """Хранилище состояния в памяти процесса: подходит только для одного процесса (polling)."""
+
+    def __init__(self):
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _alive(self, key: str, now: float):
+        entry = self._values.get(key)
+        if entry is not None and entry[1] is not None and entry[1] <= now:
+            del self._values[key]
+            return None
+        return entry
+
+    async def get(self, key: str) -> Any:
+        with self._lock:
+            entry = self._alive(key, time.time())
+            return None if entry is None else entry[0]
+
+    async def set(self, key: str, value: Any, ttl: Optional[float] = None):
+        with self._lock:
+            self._values[key] = (value, time.time() + ttl if ttl else None)
+
+    async def delete(self, key: str):
+        with self._lock:
+            self._values.pop(key, None)
+
+    async def acquire(self, key: str, limit: int, ttl: float) -> bool:
+        with self._lock:
+            now = time.time()
+            entry = self._alive(key, now)
+            count = 0 if entry is None else entry[0]
+            if count >= limit:
+                return False
+            self._values[key] = (count + 1, now + ttl)
+            return True
+
+    async def release(self, key: str):
+        with self._lock:
+            entry = self._alive(key, time.time())
+            if entry is not None:
+                self._values[key] = (max(entry[0] - 1, 0), entry[1])
+
+    async def close(self):
+        pass
+
+
+class SQLiteStateStore:
+    """
+    Хранилище состояния в файле SQLite, общее для всех процессов на одной машине (webhook с несколькими
+    воркерами) и не требующее внешних сервисов. Значения хранятся в JSON, у каждой записи свой срок жизни.
+    Просроченные записи не возвращаются и периодически удаляются.
+    """
+
+    def __init__(self, path: str = settings.state_store_path):
+        """
+        :param path: Путь к файлу SQLite.
+        """
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._db = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS state '
+                         '(key TEXT PRIMARY KEY, value TEXT NOT NULL, expires REAL)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS state_expires ON state (expires)')
+        self._lock = threading.Lock()
+        self._last_purge = 0.0
+
+    def _execute(self, sql: str, params: tuple = ()):
+        with self._lock:
+            now = time.time()
+            if now - self._last_purge > settings.state_purge_interval:
+                self._db.execute('DELETE FROM state WHERE expires <= ?', (now,))
+                self._last_purge = now
+            return self._db.execute(sql, params)
+
+    def _get(self, key: str) -> Any:
+        row = self._execute('SELECT value FROM state WHERE key = ? AND (expires IS NULL OR expires > ?)',
+                            (key, time.time())).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def _set(self, key: str, value: Any, ttl: Optional[float]):
+        self._execute('INSERT OR REPLACE INTO state (key, value, expires) VALUES (?, ?, ?)',
+                      (key, json.dumps(value, ensure_ascii=False), time.time() + ttl if ttl else None))
+
+    def _acquire(self, key: str, limit: int, ttl: float) -> bool:
+        now = time.time()
+        # Один атомарный запрос: счетчик увеличивается, только если он меньше limit (просроченный считается нулем)
+        cursor = self._execute(
+            'INSERT INTO state (key, value, expires) VALUES (?, 1, ?) ON CONFLICT (key) DO UPDATE SET '
+            'value = CASE WHEN expires <= ? THEN 1 ELSE CAST(value AS INTEGER) + 1 END, expires = excluded.expires '
+            'WHERE expires <= ? OR CAST(value AS INTEGER) < ?',
+            (key, now + ttl, now, now, limit))
+        return cursor.rowcount > 0
+
+    async def get(self, key: str) -> Any:
+        """Возвращает значение или None, если записи нет или она просрочена."""
+        return await asyncio.to_thread(self._get, key)
+
+    async def set(self, key: str, value: Any, ttl: Optional[float] = None):
+        """
+        Записывает значение.
+
+        :param key: Ключ.
+        :param value: Значение, сериализуемое в JSON.
+        :param ttl: Время жизни в секундах; None - бессрочно.
+        """
+        await asyncio.to_thread(self._set, key, value, ttl)
+
+    async def delete(self, key: str):
+        await asyncio.to_thread(self._execute, 'DELETE FROM state WHERE key = ?', (key,))
+
+    async def acquire(self, key: str, limit: int, ttl: float) -> bool:
+        """
+        Занимает один из limit слотов счетчика key. Слоты освобождаются release или по истечении ttl,
+        если процесс завершился, не освободив их.
+
+        :return: True, если слот занят; False, если все слоты заняты.
+        """
+        return await asyncio.to_thread(self._acquire, key, limit, ttl)
+
+    async def release(self, key: str):
+        await asyncio.to_thread(self._execute, 'UPDATE state SET value = MAX(CAST(value AS INTEGER) - 1, 0) '
+                                               'WHERE key = ?', (key,))
+
+    async def close(self):
+        with self._lock:
+            self._db.close()
+
+
+def create_state_store():
+    """Создает хранилище состояния, выбранное STATE_BACKEND: memory или sqlite."""
+    if settings.state_backend == 'sqlite':
+        return SQLiteStateStore()
+    return MemoryStateStore()
+
+
+class SharedFSMStorage(BaseStorage):
+    """Хранилище FSM aiogram поверх общего хранилища состояния; записи живут fsm_ttl секунд с последнего изменения."""
+
+    def __init__(self, store, ttl: float = settings.fsm_ttl):
+        """
+        :param store: Хранилище состояния (MemoryStateStore или SQLiteStateStore).
+        :param ttl: Время жизни состояния и данных в секундах.
+        """
+        self.store = store
+        self.ttl = ttl
+
+    @staticmethod
+    def _key(key: StorageKey, part: str) -> str:
+        return (f'fsm:{key.bot_id}:{key.business_connection_id or ""}:{key.chat_id}:{key.thread_id or ""}:'
+                f'{key.user_id}:{key.destiny}:{part}')
+
+    async def set_state(self, key: StorageKey, state: Optional[str | State] = None) -> None:
+        state = state.state if isinstance(state, State) else state
+        if state is None:
+            await self.store.delete(self._key(key, 'state'))
+        else:
+            await self.store.set(self._key(key, 'state'), state, self.ttl)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        return await self.store.get(self._key(key, 'state'))
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        if data:
+            await self.store.set(self._key(key, 'data'), data, self.ttl)
+        else:
+            await self.store.delete(self._key(key, 'data'))
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        return await self.store.get(self._key(key, 'data')) or {}
+
+    async def close(self) -> None:
+        await self.store.close()
+
+
+class UserConcurrencyMiddleware(BaseMiddleware):
+    """
+    Ограничивает количество одновременно обрабатываемых запросов одного пользователя во всех процессах бота.
+    Запрос сверх лимита не обрабатывается, пользователь получает короткий ответ.
+    """
+
+    def __init__(self, store, limit: int = settings.user_concurrency, ttl: float = settings.user_slot_ttl):
+        """
+        :param store: Хранилище состояния.
+        :param limit: Максимум одновременных запросов пользователя.
+        :param ttl: Через сколько секунд слот освобождается, если его не освободили (сбой процесса).
+        """
+        self.store = store
+        self.limit = limit
+        self.ttl = ttl
+
+    async def __call__(self, handler, event, data):
+        user = data.get('event_from_user')
+        if user is None or not self.limit:
+            return await handler(event, data)
+        key = f'busy:{user.id}'
+        if not await self.store.acquire(key, self.limit, self.ttl):
+            answer = getattr(event, 'answer', None)
+            if answer is not None:
+                await answer("Дождитесь ответа на предыдущие запросы")
+            return None
+        try:
+            return await handler(event, data)
+        finally:
+            await self.store.release(key)
@@ -0,0 +1,99 @@
+import asyncio
+import logging
+
+from src.configs import settings
+
+
+class ElasticStorage:
+    """Хранилище фрагментов в Elasticsearch: общий асинхронный клиент, поиск и реестр документов."""
+
+    def __init__(self):
+        from src.modules.document_registry import DocumentRegistry
+        from src.modules.elastic import BM25Handler, Elastic, HybridHandler
+
+        self.elastic = Elastic()
+        self.registry = DocumentRegistry(self.elastic.es)
+        handler = HybridHandler if settings.retrieval_mode == 'hybrid' else BM25Handler
+        self.retriever = handler(self.elastic.es, settings.elk_index)
+
+    async def reset(self) -> bool:
+        """
+        Пересоздает индекс фрагментов и реестр документов; индексы владельцев (TENANT_MODE=index) удаляются.
+
+        :return: True, если существовавший индекс был очищен.
+        """
+        await self._delete_owner_indices()
+        existed = await self.elastic.delete_index(settings.elk_index)
+        await self.elastic.create_index(settings.elk_index)
+        await self.registry.recreate_index()
+        return existed
+
+    async def _delete_owner_indices(self):
+        """
+        Удаляет индексы вида <ELK_INDEX>-owner-<id>. Имена перечисляются явно: удаление по шаблону
+        запрещено настройкой action.destructive_requires_name. Алиасы режима alias с тем же шаблоном
+        указывают на общий индекс и отбрасываются по имени.
+        """
+        prefix = f'{settings.elk_index}-owner-'
+        response = await self.elastic.es.options(ignore_status=404).indices.get(
+            index=f'{prefix}*', expand_wildcards='open,closed', ignore_unavailable=True, allow_no_indices=True)
+        names = sorted(name for name in response.body if name.startswith(prefix))
+        for start in range(0, len(names), 100):
+            await self.elastic.es.options(ignore_status=404).indices.delete(index=','.join(names[start:start + 100]))
+        if names:
+            logging.info(f'Удалено индексов владельцев: {len(names)}')
+
+    async def close(self):
+        await self.elastic.close()
+
+
+class LocalStorage:
+    """Встроенное хранилище фрагментов в каталоге LOCAL_STORE_PATH (см. LocalVectorStore)."""
+
+    def __init__(self):
+        from src.modules.local_store import LocalBM25Handler, LocalDocumentRegistry, LocalHybridHandler, get_local_store
+
+        self.store = get_local_store()
+        self.registry = LocalDocumentRegistry(self.store)
+        handler = LocalHybridHandler if settings.retrieval_mode == 'hybrid' else LocalBM25Handler
+        self.retriever = handler(self.store)
+
+    async def reset(self) -> bool:
+        """
+        Удаляет все фрагменты и реестр документов.
+
+        :return: True, если в хранилище были фрагменты.
+        """
+        existed = self.store.count() > 0
+        await asyncio.to_thread(self.store.clear)
+        return existed
+
+    async def close(self):
+        self.store.commit()
+
+
+def create_storage():
+    """
+    Создает хранилище, выбранное STORAGE_BACKEND. У хранилищ общий интерфейс: retriever
+    (asimilarity_search_with_relevance_scores), registry (интерфейс DocumentRegistry), reset() и close().
+    """
+    if settings.storage_backend == 'local':
+        logging.info(f'Используется встроенное хранилище {settings.local_store_path}')
+        return LocalStorage()
+    return ElasticStorage()
+
+
+def create_ingestor(embedding=None):
+    """
+    Создает загрузчик документов для STORAGE_BACKEND. Для Elasticsearch - со своим синхронным клиентом,
+    поэтому подходит и для пула процессов; встроенное хранилище общее на процесс, поэтому загрузка в него
+    должна идти в пуле потоков.
+
+    :param embedding: Модель эмбеддингов.
+    """
+    if settings.storage_backend == 'local':
+        from src.modules.local_store import LocalDocumentIngestor, get_local_store
+        return LocalDocumentIngestor(get_local_store(), embedding=embedding)
+    from src.modules.elastic import create_sync_client
+    from src.modules.ingestion import DocumentIngestor
+    return DocumentIngestor(create_sync_client(), settings.elk_index, embedding=embedding)
@@ -0,0 +1,122 @@
+import asyncio
+import logging
+import re
+import time
+from typing import AsyncGenerator
+
+from aiogram import types
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+
+from src.configs import settings
+
+TELEGRAM_MESSAGE_LIMIT = 4096
+PLACEHOLDER_TEXT = '⏳'
+_CODE_BLOCK = re.compile(r'```.*?```', re.DOTALL)
+_INLINE_CODE = re.compile(r'`[^`\n]*`')
+
+
+def split_message(text: str, limit: int = TELEGRAM_MESSAGE_LIMIT) -> list:
+    """
+    Делит длинный текст на части, которые помещаются в одно сообщение Telegram, по возможности по строкам.
+
+    :param text: Исходный текст.
+    :param limit: Максимальная длина одного сообщения.
+    :return: Список частей текста.
+    """
+    parts = []
+    while len(text) > limit:
+        cut = text.rfind('\n', 0, limit)
+        if cut <= 0:
+            cut = text.rfind(' ', 0, limit)
+        if cut <= 0:
+            cut = limit
+        parts.append(text[:cut])
+        text = text[cut:].lstrip()
+    if text:
+        parts.append(text)
+    return parts
+
+
+def close_markdown(text: str) -> str:
+    """
+    Закрывает незавершенную разметку Markdown в частично сгенерированном тексте, чтобы Telegram
+    принял промежуточную правку: блоки и строки кода, жирный и курсив, недописанные ссылки.
+
+    :param text: Частичный текст ответа.
+    :return: Текст с закрытой разметкой.
+    """
+    if text.count('```') % 2:
+        return text + '\n```'
+    plain = _INLINE_CODE.sub('', _CODE_BLOCK.sub('', text))
+    if plain.count('`') % 2:
+        return text + '`'
+    link_start = text.rfind('[')
+    if link_start != -1 and not re.match(r'\[[^\]]*\]\([^)]*\)', text[link_start:]):
+        text, plain = text[:link_start], _INLINE_CODE.sub('', _CODE_BLOCK.sub('', text[:link_start]))
+    for marker in ('*', '_'):
+        if plain.count(marker) % 2:
+            text += marker
+    return text
+
+
+async def _edit(message: types.Message, text: str, parse_mode=None) -> float:
+    """
+    Редактирует сообщение; при ошибке разметки повторяет правку без разметки.
+    Ограничение частоты обрабатывается одинаково для обеих правок.
+
+    :return: 0, если правка выполнена, иначе пауза в секундах, которую запросил Telegram.
+    """
+    try:
+        try:
+            await message.edit_text(text, parse_mode=parse_mode)
+        except TelegramBadRequest as ex:
+            if parse_mode is None or 'message is not modified' in str(ex):
+                raise
+            await message.edit_text(text, parse_mode=None)
+    except TelegramRetryAfter as ex:
+        logging.warning(f'Telegram ограничил частоту правок, пауза {ex.retry_after} c')
+        return float(ex.retry_after)
+    except TelegramBadRequest as ex:
+        if 'message is not modified' in str(ex):
+            return 0.0
+        raise
+    return 0.0
+
+
+async def stream_reply(message: types.Message, parts: AsyncGenerator[str, None], parse_mode: str = 'Markdown') -> str:
+    """
+    Отвечает на сообщение сообщением-заглушкой и постепенно дописывает в него потоковый ответ.
+    Правки выполняются не чаще stream_edit_interval секунд, промежуточный текст отправляется
+    с закрытой разметкой. Если ответ длиннее лимита Telegram, остаток отправляется отдельными сообщениями.
+
+    :param message: Сообщение пользователя.
+    :param parts: Асинхронный генератор частей ответа; закрывается после чтения.
+    :param parse_mode: Разметка итогового ответа.
+    :return: Полный текст ответа.
+    """
+    placeholder = await message.reply(PLACEHOLDER_TEXT)
+    text, shown, next_edit = '', '', time.monotonic() + settings.stream_edit_interval
+    try:
+        async for part in parts:
+            text += part
+            now = time.monotonic()
+            if now < next_edit or len(text) - len(shown) < settings.stream_min_chars:
+                continue
+            preview = text if len(text) <= TELEGRAM_MESSAGE_LIMIT - 10 else split_message(text)[0]
+            retry_after = await _edit(placeholder, close_markdown(preview) + ' …', parse_mode)
+            if not retry_after:
+                shown = text
+            next_edit = now + max(settings.stream_edit_interval, retry_after)
+    finally:
+        await parts.aclose()  # при ошибке правки поток GPT закрывается сразу, а не при сборке мусора
+
+    text = text.strip() or PLACEHOLDER_TEXT
+    chunks = split_message(text)
+    while retry_after := await _edit(placeholder, chunks[0], parse_mode):
+        await asyncio.sleep(retry_after)
+    for chunk in chunks[1:]:
+        try:
+            await message.answer(chunk, parse_mode=parse_mode)
+        except TelegramBadRequest:
+            await message.answer(chunk)
+    return text
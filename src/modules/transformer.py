@@ -1,8 +1,16 @@
+import re
+from bisect import bisect_right
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain.docstore.document import Document
 
 import string
 
+from src.configs import settings
+
+SENTENCE_ENDS = '.!?…'
+# Символы, которые при нормализации удаляются (None) или заменяются пробелом
+DEFAULT_TRANSLATE = {'"': None, '\n': ' ', '\r': ' ', '\t': ' ', '-': ' ', '>': ' '}
+
 
 class TextRefactor:
     """
@@ -59,3 +67,148 @@ class TextRefactor:
         for text in splitted_text:
             documents.append(Document(page_content=text, metadata=page_context))
         return documents
+
+
+class RegexTokenizer:
+    """
+    Легкий токенизатор без модели: слова и знаки препинания. Длина в нем близка к длине в токенах E5,
+    но не совпадает с ней; подходит для окружений без загруженной модели и для бенчмарков.
+    """
+    pattern = re.compile(r'\w+|[^\w\s]')
+
+    def __call__(self, texts: list, **kwargs) -> dict:
+        return {'offset_mapping': [[match.span() for match in self.pattern.finditer(text)] for text in texts]}
+
+
+def create_tokenizer(name: str = settings.chunk_tokenizer):
+    """
+    Создает токенизатор для измерения длины фрагментов.
+
+    :param name: model - быстрый токенизатор модели эмбеддингов (EMB_MODEL_NAME), regex - RegexTokenizer.
+    :return: Объект, который для списка текстов возвращает offset_mapping токенов.
+    """
+    if name == 'regex':
+        return RegexTokenizer()
+    from transformers import AutoTokenizer
+    return AutoTokenizer.from_pretrained(settings.emb_model_name, use_fast=True)
+
+
+class ChunkingEngine:
+    """
+    Нормализует и разбивает текст страниц пакетами. Нормализация выполняется одной таблицей замены символов
+    и одним скомпилированным регулярным выражением, длина фрагментов измеряется в токенах модели эмбеддингов,
+    чтобы фрагмент целиком помещался в ее окно (512 токенов у E5). Фрагменты заканчиваются по концу
+    предложения, если он есть во второй половине фрагмента, иначе по границе слова.
+    При cross_pages фрагменты могут продолжаться на следующей странице, в том числе из следующего пакета:
+    незавершенный хвост пакета переносится в следующий вызов split_pages.
+    """
+
+    def __init__(self, tokenizer=None, chunk_tokens: int = None, overlap_tokens: int = None,
+                 cross_pages: bool = None, remove_phrases: list = None, translate: dict = None):
+        """
+        :param tokenizer: Токенизатор (см. create_tokenizer). По умолчанию - create_tokenizer().
+        :param chunk_tokens: Максимальный размер фрагмента в токенах.
+        :param overlap_tokens: Перекрытие соседних фрагментов в токенах.
+        :param cross_pages: Разрешить фрагментам переходить через границу страниц.
+        :param remove_phrases: Фразы, которые удаляются из текста.
+        :param translate: Таблица замены символов для str.maketrans.
+        """
+        self.tokenizer = tokenizer or create_tokenizer()
+        self.chunk_tokens = chunk_tokens or settings.chunk_tokens
+        self.overlap_tokens = settings.chunk_overlap_tokens if overlap_tokens is None else overlap_tokens
+        self.cross_pages = settings.chunk_cross_pages if cross_pages is None else cross_pages
+        phrases = settings.text_remove_phrases if remove_phrases is None else remove_phrases
+        self.table = str.maketrans(DEFAULT_TRANSLATE if translate is None else translate)
+        removals = '|'.join(re.escape(phrase) for phrase in sorted(phrases, key=len, reverse=True))
+        self.pattern = re.compile(rf' *(?:{removals}) *| {{2,}}' if removals else ' {2,}')
+        self._carry = None
+
+    def reset(self):
+        """Сбрасывает хвост, перенесенный из предыдущего пакета; вызывается перед новым документом."""
+        self._carry = None
+
+    def normalize(self, text: str) -> str:
+        """
+        Очищает текст так же, как TextRefactor._text2doc, но за один проход по замене символов и один - по
+        регулярному выражению (удаление фраз и схлопывание пробелов). Знаки препинания и пробелы по краям
+        снимаются вместе, поэтому страница только из знаков препинания становится пустой.
+
+        :param text: Исходный текст.
+        :return: Очищенный текст.
+        """
+        return self.pattern.sub(' ', text.translate(self.table)).strip(string.punctuation + ' ').lower()
+
+    def _cut(self, text: str, offsets: list, start: int) -> int:
+        """Возвращает индекс токена, следующего за последним токеном фрагмента, начинающегося с токена start."""
+        limit = start + self.chunk_tokens
+        if limit >= len(offsets):
+            return len(offsets)
+        word_end = None
+        for end in range(limit, start + self.chunk_tokens // 2, -1):
+            if text[offsets[end - 1][1] - 1] in SENTENCE_ENDS:
+                return end
+            if word_end is None and offsets[end][0] > offsets[end - 1][1]:
+                word_end = end
+        return word_end or limit
+
+    def _chunks(self, text: str, offsets: list, final: bool):
+        """
+        Разбивает текст на фрагменты по токенам.
+
+        :return: Список пар (начало, конец) фрагментов в символах и символ начала незавершенного хвоста
+            (None, если хвоста нет).
+        """
+        spans = []
+        start = 0
+        while start < len(offsets):
+            end = self._cut(text, offsets, start)
+            if end == len(offsets) and not final:
+                return spans, offsets[start][0]
+            spans.append((offsets[start][0], offsets[end - 1][1]))
+            if end == len(offsets):
+                break
+            next_start = max(end - self.overlap_tokens, start + 1)
+            while next_start < end and offsets[next_start][0] == offsets[next_start - 1][1]:
+                next_start += 1  # перекрытие начинается с начала слова
+            start = next_start
+        return spans, None
+
+    def split_pages(self, pages: list, final: bool = True) -> list:
+        """
+        Нормализует и разбивает пакет страниц, токенизируя все страницы пакета одним вызовом.
+
+        :param pages: Список пар (текст страницы, метаданные).
+        :param final: Последний ли это пакет документа; при cross_pages хвост непоследнего пакета
+            переносится в следующий вызов.
+        :return: Список объектов Document; метаданные фрагмента берутся со страницы, на которой он начинается.
+        """
+        pages = [(self.normalize(text), metadata) for text, metadata in pages]
+        if self.cross_pages:
+            if self._carry is not None:
+                pages.insert(0, self._carry)
+                self._carry = None
+            pages = [(text, metadata) for text, metadata in pages if text]
+            page_starts, position = [], 0
+            for text, _ in pages:
+                page_starts.append(position)
+                position += len(text) + 1
+            metadatas = [metadata for _, metadata in pages]
+            groups = [(' '.join(text for text, _ in pages),
+                       lambda begin: metadatas[bisect_right(page_starts, begin) - 1])]
+        else:
+            groups = [(text, lambda begin, metadata=metadata: metadata) for text, metadata in pages]
+        groups = [(text, metadata_at) for text, metadata_at in groups if text]
+        if not groups:
+            return []
+        encodings = self.tokenizer([text for text, _ in groups], add_special_tokens=False,
+                                   return_offsets_mapping=True)['offset_mapping']
+
+        documents = []
+        for (text, metadata_at), offsets in zip(groups, encodings):
+            offsets = [(begin, end) for begin, end in offsets if end > begin]
+            spans, tail = self._chunks(text, offsets, final or not self.cross_pages)
+            for begin, end in spans:
+                documents.append(Document(page_content=text[begin:end], metadata=metadata_at(begin)))
+            if tail is not None:
+                self._carry = (text[tail:], metadata_at(tail))
+        return documents
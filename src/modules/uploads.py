@@ -0,0 +1,124 @@
+import hashlib
+import io
+import os
+import tempfile
+from typing import TYPE_CHECKING, BinaryIO, Optional, Union
+
+from src.configs import settings
+
+if TYPE_CHECKING:
+    from aiogram import Bot
+
+# Содержимое файла для обработчиков: bytes, если файл в памяти, или путь к временному файлу
+Source = Union[bytes, str]
+
+
+def open_source(source: Source) -> Union[BinaryIO, str]:
+    """Возвращает то, что принимают парсеры (librosa, pypdf, Pillow): буфер в памяти или путь к файлу."""
+    return io.BytesIO(source) if isinstance(source, bytes) else source
+
+
+def source_sha256(source: Source) -> str:
+    """Считает sha256 содержимого, переданного как bytes или путь к файлу."""
+    if isinstance(source, bytes):
+        return hashlib.sha256(source).hexdigest()
+    digest = hashlib.sha256()
+    with open(source, 'rb') as file:
+        for block in iter(lambda: file.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class Upload:
+    """
+    Файл, загружаемый из Telegram. Пока размер не превышает memory_limit, содержимое хранится в памяти,
+    иначе переносится во временный файл, который удаляется в close. sha256 считается по ходу загрузки,
+    поэтому повторный документ можно распознать до разбора. Объект передается в Bot.download_file как destination.
+    """
+
+    def __init__(self, file_name: str, memory_limit: int = settings.upload_memory_limit,
+                 tmp_dir: Optional[str] = settings.upload_tmp_dir, force_file: bool = False):
+        """
+        :param file_name: Имя файла для логов и метаданных.
+        :param memory_limit: Максимальный размер файла в байтах, который хранится в памяти.
+        :param tmp_dir: Каталог для временных файлов; по умолчанию - системный.
+        :param force_file: Всегда сохранять во временный файл: librosa декодирует через ffmpeg (m4a, AAC)
+            только файлы, переданные путем.
+        """
+        self.file_name = file_name
+        self.memory_limit = memory_limit
+        self.tmp_dir = tmp_dir
+        self.force_file = force_file
+        self.size = 0
+        self.path = None
+        self._digest = hashlib.sha256()
+        self._buffer = io.BytesIO()
+        self._file = None
+
+    def _spool(self):
+        """Переносит содержимое из памяти во временный файл."""
+        if self.tmp_dir:
+            os.makedirs(self.tmp_dir, exist_ok=True)
+        suffix = os.path.splitext(self.file_name)[1]
+        self._file = tempfile.NamedTemporaryFile(prefix='upload-', suffix=suffix, dir=self.tmp_dir, delete=False)
+        self.path = self._file.name
+        self._file.write(self._buffer.getbuffer())
+        self._buffer = None
+
+    def write(self, chunk: bytes) -> int:
+        self._digest.update(chunk)
+        self.size += len(chunk)
+        if self._file is None and (self.force_file or self.size > self.memory_limit):
+            self._spool()
+        return (self._file or self._buffer).write(chunk)
+
+    def flush(self):
+        if self._file is not None:
+            self._file.flush()
+
+    @property
+    def sha256(self) -> str:
+        return self._digest.hexdigest()
+
+    @property
+    def source(self) -> Source:
+        """Содержимое для обработчиков и задач пулов (в том числе пула процессов)."""
+        if self._file is None and self.force_file:
+            self._spool()
+        if self._file is not None:
+            self._file.close()
+            return self.path
+        return self._buffer.getvalue()
+
+    def close(self):
+        """Освобождает память и удаляет временный файл."""
+        if self._file is not None:
+            self._file.close()
+            os.unlink(self.path)
+            self._file = None
+        self._buffer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+async def download_upload(bot: 'Bot', file_path: str, file_name: str, force_file: bool = False) -> Upload:
+    """
+    Загружает файл из Telegram в память или во временный файл.
+
+    :param bot: Бот.
+    :param file_path: Путь к файлу на сервере Telegram (из Bot.get_file).
+    :param file_name: Имя файла.
+    :param force_file: Всегда сохранять во временный файл.
+    :return: Загруженный файл; после обработки его нужно закрыть (with upload: ...).
+    """
+    upload = Upload(file_name, force_file=force_file)
+    try:
+        await bot.download_file(file_path, destination=upload, timeout=settings.upload_timeout, seek=False)
+    except Exception:
+        upload.close()
+        raise
+    return upload
@@ -1,8 +1,56 @@
 import logging
+import re
+from dataclasses import dataclass
+from typing import Callable, Iterator, List, Optional
+
+import numpy as np
 import torch
 import librosa
 from transformers import WhisperProcessor, WhisperForConditionalGeneration
 
+from src.configs import settings
+from src.modules.uploads import Source, open_source
+
+SAMPLE_RATE = 16000
+# Whisper обрабатывает не более 30 секунд аудио за один проход
+MAX_WINDOW_SECONDS = 30.0
+
+
+@dataclass
+class Segment:
+    """Распознанный фрагмент аудио с границами в секундах."""
+    start: float
+    end: float
+    text: str
+
+
+def format_timestamp(seconds: float) -> str:
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f'{hours}:{minutes:02d}:{seconds:02d}' if hours else f'{minutes:02d}:{seconds:02d}'
+
+
+def _normalize_word(word: str) -> str:
+    return re.sub(r'[^\w]', '', word.lower())
+
+
+def merge_overlapping_text(previous: str, current: str, max_words: int = 30) -> str:
+    """
+    Убирает из начала current слова, которые повторяют конец previous (результат перекрытия окон).
+
+    :param previous: Текст предыдущего окна.
+    :param current: Текст текущего окна.
+    :param max_words: Максимальная длина искомого повтора в словах.
+    :return: Текст текущего окна без повтора.
+    """
+    prev_words = [_normalize_word(word) for word in previous.split()]
+    cur_words = current.split()
+    cur_normalized = [_normalize_word(word) for word in cur_words]
+    for size in range(min(max_words, len(prev_words), len(cur_words)), 0, -1):
+        if prev_words[-size:] == cur_normalized[:size]:
+            return ' '.join(cur_words[size:])
+    return current
+
 
 class WhisperHandler:
     """
@@ -10,39 +58,110 @@ class WhisperHandler:
     для преобразования аудио в текст.
     """
 
-    def __init__(self):
+    def __init__(self, model_name: str = settings.whisper_model):
+        """
+        Инициализирует модель Whisper из Hugging Face и процессор для обработки аудиоданных.
+
+        :param model_name: Имя модели, например openai/whisper-large-v3 или distil-whisper/distil-large-v3.
         """
-        Инициализирует модель Whisper Large v3 из Hugging Face и процессор для обработки аудиоданных.
+        self.device = "cuda" if torch.cuda.is_available() else "cpu"
+        self.dtype = torch.float16 if self.device == "cuda" and settings.whisper_fp16 else torch.float32
+        self.processor = WhisperProcessor.from_pretrained(model_name)
+        self.model = WhisperForConditionalGeneration.from_pretrained(model_name, torch_dtype=self.dtype).to(
+            self.device)
+        if self.device == "cpu" and settings.whisper_int8:
+            self.model = torch.quantization.quantize_dynamic(self.model, {torch.nn.Linear}, dtype=torch.qint8)
+        self.model.eval()
+
+    def _overlap_windows(self, audio: np.ndarray) -> List[tuple]:
+        """Нарезает аудио на окна фиксированной длины с перекрытием."""
+        window = int(min(settings.whisper_chunk_seconds, MAX_WINDOW_SECONDS) * SAMPLE_RATE)
+        step = max(window - int(settings.whisper_overlap_seconds * SAMPLE_RATE), 1)
+        windows = []
+        for start in range(0, len(audio), step):
+            windows.append((start, min(start + window, len(audio))))
+            if start + window >= len(audio):
+                break
+        return windows
+
+    def _silence_windows(self, audio: np.ndarray) -> List[tuple]:
+        """Нарезает аудио по паузам: участки речи объединяются в окна не длиннее допустимого."""
+        window = int(min(settings.whisper_chunk_seconds, MAX_WINDOW_SECONDS) * SAMPLE_RATE)
+        windows = []
+        current_start, current_end = None, None
+        for start, end in librosa.effects.split(audio, top_db=settings.whisper_vad_top_db):
+            # Слишком длинные участки речи без пауз режутся жестко
+            for part_start in range(start, end, window):
+                part_end = min(part_start + window, end)
+                if current_start is not None and part_end - current_start <= window:
+                    current_end = part_end
+                    continue
+                if current_start is not None:
+                    windows.append((current_start, current_end))
+                current_start, current_end = part_start, part_end
+        if current_start is not None:
+            windows.append((current_start, current_end))
+        return windows
+
+    def _decode_batch(self, chunks: List[np.ndarray]) -> List[str]:
+        """Распознает пакет окон одним вызовом generate."""
+        input_features = self.processor(chunks, sampling_rate=SAMPLE_RATE, return_tensors="pt").input_features
+        input_features = input_features.to(self.device, dtype=self.dtype)
+        with torch.inference_mode():
+            generated_ids = self.model.generate(input_features)
+        return [text.strip() for text in self.processor.batch_decode(generated_ids, skip_special_tokens=True)]
+
+    def iter_segments(self, source: Source) -> Iterator[List[Segment]]:
         """
-        self.processor = WhisperProcessor.from_pretrained("openai/whisper-large-v3")
-        self.model = WhisperForConditionalGeneration.from_pretrained("openai/whisper-large-v3").to(
-            "cuda" if torch.cuda.is_available() else "cpu")
+        Распознает аудио любой длины по окнам, пакетами по whisper_batch_size окон.
 
-    def transcribe_audio(self, audio_path: str) -> str:
+        :param source: Содержимое аудиофайла (bytes) или путь к нему. Форматы, которые не читает libsndfile
+            (m4a, AAC), декодируются через audioread/ffmpeg только при передаче пути.
+        :return: Итератор по спискам сегментов, по одному списку на пакет.
+        """
+        audio, _ = librosa.load(open_source(source), sr=SAMPLE_RATE)
+        overlap = settings.whisper_chunk_mode != 'silence'
+        windows = self._overlap_windows(audio) if overlap else self._silence_windows(audio)
+
+        previous_text = ''
+        for i in range(0, len(windows), settings.whisper_batch_size):
+            batch = windows[i:i + settings.whisper_batch_size]
+            texts = self._decode_batch([audio[start:end] for start, end in batch])
+            segments = []
+            for (start, end), text in zip(batch, texts):
+                if overlap and previous_text:
+                    text = merge_overlapping_text(previous_text, text)
+                previous_text = text or previous_text
+                if text:
+                    segments.append(Segment(start / SAMPLE_RATE, end / SAMPLE_RATE, text))
+            yield segments
+
+    @staticmethod
+    def join_segments(segments: List[Segment]) -> str:
+        """Склеивает сегменты в текст, при включенной настройке - с отметками времени."""
+        if settings.whisper_timestamps and len(segments) > 1:
+            return '\n'.join(f'[{format_timestamp(segment.start)}] {segment.text}' for segment in segments)
+        return ' '.join(segment.text for segment in segments)
+
+    def transcribe_audio(self, source: Source, on_partial: Optional[Callable[[str], None]] = None) -> str:
         """
         Преобразует аудиофайл в текст с использованием модели Whisper.
+        Длинные записи распознаются по окнам, поэтому не обрезаются на 30 секундах.
 
         Args:
-            audio_path (str): Путь к аудиофайлу для транскрипции.
+            source (bytes | str): Содержимое аудиофайла или путь к нему.
+            on_partial (Callable): Вызывается с уже распознанным текстом после каждого пакета окон.
 
         Returns:
             str: Распознанный текст из аудиофайла.
         """
         try:
-            # Загрузка аудиофайла
-            audio, sr = librosa.load(audio_path, sr=16000)
-
-            # Подготовка аудиоданных для Whisper
-            input_features = self.processor(audio, sampling_rate=16000, return_tensors="pt").input_features
-
-            # Передача данных в модель
-            input_features = input_features.to("cuda" if torch.cuda.is_available() else "cpu")
-            generated_ids = self.model.generate(input_features)
-
-            # Декодирование выходных данных в текст
-            transcription = self.processor.batch_decode(generated_ids, skip_special_tokens=True)[0]
-
-            return transcription
+            segments = []
+            for batch_segments in self.iter_segments(source):
+                segments.extend(batch_segments)
+                if on_partial is not None:
+                    on_partial(self.join_segments(segments))
+            return self.join_segments(segments)
         except Exception as e:
             logging.error(f"Ошибка при транскрипции аудиофайла: {e}")
             return "Не удалось транскрибировать аудиофайл."
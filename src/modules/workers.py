@@ -0,0 +1,150 @@
+import asyncio
+import contextvars
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import TYPE_CHECKING, Awaitable, Callable, Optional
+
+from src.configs import settings
+from src.log.tracing import trace_id_var
+from src.modules.model_registry import models
+
+if TYPE_CHECKING:
+    from src.modules.ingestion import IngestReport
+    from src.modules.uploads import Source
+
+
+class QueueFullError(Exception):
+    """Очередь пула переполнена, задача не принята."""
+
+
+def worker_model(name: str):
+    """
+    Выдает на время задачи экземпляр модели, принадлежащий текущему воркеру, загружая его при первом обращении.
+    Для пула потоков экземпляр свой у каждого потока, для пула процессов - у каждого процесса.
+    Простаивающие экземпляры выгружаются реестром моделей, но не во время задачи.
+
+    :param name: Имя модели в реестре.
+    :return: Контекстный менеджер, возвращающий экземпляр модели.
+    """
+    return models.use(name, threading.current_thread().name)
+
+
+# Выставляется инициализатором процессов пула; в пуле потоков воркеры живут в процессе бота
+_process_worker = False
+
+
+def _init_process_worker():
+    global _process_worker
+    _process_worker = True
+
+
+class _SharedEmbedding:
+    """
+    Общая на процесс модель эмбеддингов из реестра для загрузчиков в пуле потоков: отдельная копия E5
+    на каждый поток рядом с моделью, которая уже загружена для поиска, только занимала бы память.
+    На время расчета окна модель отмечается занятой и не выгружается.
+    """
+
+    def embed_documents(self, texts: list) -> list:
+        with models.use('embedding') as embedding:
+            return embedding.embed_documents(texts)
+
+
+def _build_ingestor():
+    from src.modules.embedding import create_embedding
+    from src.modules.storage import create_ingestor
+    return create_ingestor(embedding=create_embedding() if _process_worker else _SharedEmbedding())
+
+
+models.register('ingestor', _build_ingestor)
+
+
+def warm_up_job(name: str):
+    """Задача пула: заранее загрузить модель в воркер."""
+    with worker_model(name):
+        pass
+
+
+def transcribe_job(source: 'Source', on_partial: Optional[Callable[[str], None]] = None) -> str:
+    """Задача пула: распознавание аудиофайла. on_partial поддерживается только пулом потоков."""
+    with worker_model('whisper') as whisper:
+        return whisper.transcribe_audio(source, on_partial)
+
+
+def ingest_pdf_job(source: 'Source', metadata: dict,
+                   on_progress: Optional[Callable[[int, Optional[int]], None]] = None,
+                   content_hash: Optional[str] = None) -> 'IngestReport':
+    """
+    Задача пула: разбор PDF, расчет эмбеддингов и запись в индекс.
+    on_progress поддерживается только пулом потоков.
+    """
+    with worker_model('ingestor') as ingestor:
+        return ingestor.ingest_pdf(source, metadata, on_progress, content_hash)
+
+
+def _run_traced(trace_id: str, func: Callable, *args):
+    """Выполняет задачу в процессе пула с идентификатором трассировки обновления, которое ее поставило."""
+    trace_id_var.set(trace_id)
+    return func(*args)
+
+
+class WorkerPool:
+    """
+    Пул для тяжелых задач, которые нельзя выполнять в цикле событий бота.
+    Количество принятых задач ограничено: workers выполняются, еще max_queue ждут в очереди,
+    остальные отклоняются с QueueFullError.
+    """
+
+    def __init__(self, name: str, workers: int, max_queue: int, kind: str = settings.worker_pool_kind):
+        """
+        :param name: Имя пула для логов и имен потоков.
+        :param workers: Количество воркеров.
+        :param max_queue: Максимальное количество задач, ожидающих свободного воркера.
+        :param kind: thread - пул потоков, process - пул процессов.
+        """
+        self.name = name
+        self.kind = kind
+        self.workers = workers
+        self.max_queue = max_queue
+        self._pending = 0
+        if kind == 'process':
+            self._executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                                                 initializer=_init_process_worker)
+        elif kind == 'thread':
+            self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=name)
+        else:
+            raise ValueError(f'Неизвестный тип пула: {kind}')
+
+    @property
+    def pending(self) -> int:
+        """Количество выполняющихся и ожидающих задач."""
+        return self._pending
+
+    async def run(self, func: Callable, *args, on_queued: Optional[Callable[[int], Awaitable]] = None):
+        """
+        Выполняет задачу в пуле.
+
+        :param func: Функция задачи (для пула процессов - функция уровня модуля).
+        :param args: Аргументы функции.
+        :param on_queued: Вызывается с номером позиции в очереди, если свободного воркера нет.
+        :return: Результат функции.
+        :raises QueueFullError: Если очередь переполнена.
+        """
+        if self._pending >= self.workers + self.max_queue:
+            raise QueueFullError(f'Очередь пула {self.name} переполнена')
+        position = self._pending - self.workers + 1
+        self._pending += 1
+        try:
+            if position > 0 and on_queued is not None:
+                await on_queued(position)
+            loop = asyncio.get_running_loop()
+            # run_in_executor не переносит contextvars: без этого этапы и логи воркеров теряют trace_id
+            if self.kind == 'process':
+                return await loop.run_in_executor(self._executor, _run_traced, trace_id_var.get(), func, *args)
+            return await loop.run_in_executor(self._executor, contextvars.copy_context().run, func, *args)
+        finally:
+            self._pending -= 1
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,70 @@
+from langchain_core.documents import Document
+
+from src.modules import answer_cache
+from src.modules.answer_cache import AnswerCache, chunk_ids, normalize_query
+
+IDS = frozenset({'a-0', 'a-1'})
+
+
+def test_normalize_query():
+    assert normalize_query('  Когда построен   дом?! ') == 'когда построен дом'
+
+
+def test_chunk_ids_uses_id_or_content_hash():
+    found = [(Document(id='a-0', page_content='текст'), 1.0),
+             (Document(page_content='текст', metadata={'doc_id': 'b', 'page_number': 3}), 0.5)]
+    ids = chunk_ids(found)
+    assert 'a-0' in ids
+    assert len(ids) == 2 and any(item.startswith('b:3:') for item in ids)
+
+
+def test_exact_hit_after_normalization():
+    cache = AnswerCache(ttl=60, max_items=10, similarity=0.9)
+    cache.put(1, 'Когда построен дом?', IDS, 'в 1930')
+    assert cache.get('1', 'когда  построен дом', IDS) == 'в 1930'
+
+
+def test_miss_on_other_owner_or_chunks():
+    cache = AnswerCache(ttl=60, max_items=10, similarity=0.9)
+    cache.put(1, 'вопрос', IDS, 'ответ')
+    assert cache.get(2, 'вопрос', IDS) is None
+    assert cache.get(1, 'вопрос', frozenset({'a-0'})) is None
+
+
+def test_similar_question_by_vector():
+    cache = AnswerCache(ttl=60, max_items=10, similarity=0.9)
+    cache.put(1, 'когда построен дом', IDS, 'в 1930', vector=[1.0, 0.0])
+    assert cache.get(1, 'в каком году построили дом', IDS, vector=[0.99, 0.05]) == 'в 1930'
+    assert cache.get(1, 'кто архитектор', IDS, vector=[0.0, 1.0]) is None
+    assert cache.get(2, 'в каком году построили дом', IDS, vector=[0.99, 0.05]) is None
+
+
+def test_ttl(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(answer_cache.time, 'monotonic', lambda: now[0])
+    cache = AnswerCache(ttl=60, max_items=10, similarity=0.9)
+    cache.put(1, 'вопрос', IDS, 'ответ', vector=[1.0, 0.0])
+    now[0] += 61
+    assert cache.get(1, 'вопрос', IDS) is None
+    assert cache.get(1, 'другой вопрос', IDS, vector=[1.0, 0.0]) is None
+
+
+def test_evicts_least_recently_used():
+    cache = AnswerCache(ttl=60, max_items=2, similarity=0.9)
+    cache.put(1, 'первый', IDS, '1')
+    cache.put(1, 'второй', IDS, '2')
+    assert cache.get(1, 'первый', IDS) == '1'
+    cache.put(1, 'третий', IDS, '3')
+    assert cache.get(1, 'второй', IDS) is None
+    assert cache.get(1, 'первый', IDS) == '1'
+    assert cache.get(1, 'третий', IDS) == '3'
+
+
+def test_invalidate_owner():
+    cache = AnswerCache(ttl=60, max_items=10, similarity=0.9)
+    cache.put(1, 'первый', IDS, '1')
+    cache.put(1, 'второй', IDS, '2')
+    cache.put(2, 'первый', IDS, '3')
+    assert cache.invalidate_owner('1') == 2
+    assert cache.get(1, 'первый', IDS) is None
+    assert cache.get(2, 'первый', IDS) == '3'
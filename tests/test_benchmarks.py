@@ -0,0 +1,39 @@
+import pytest
+
+from benchmarks.run_benchmarks import compare, percentile
+
+
+def test_percentile_nearest_rank():
+    values = [5, 1, 4, 2, 3]
+    assert percentile(values, 50) == 3
+    assert percentile(values, 95) == 5
+    assert percentile(values, 0) == 1
+    assert percentile(values, 100) == 5
+    assert percentile([], 95) == 0.0
+
+
+@pytest.mark.parametrize('q, expected', [(10, 1), (11, 2), (90, 9), (91, 10)])
+def test_percentile_rank_boundaries(q, expected):
+    assert percentile(list(range(1, 11)), q) == expected
+
+
+def report(**results) -> dict:
+    return {'results': results}
+
+
+def test_compare_latency_regression():
+    baseline = report(retrieval={'p95_ms': 100.0, 'count': 10})
+    assert compare(report(retrieval={'p95_ms': 109.0, 'count': 20}), baseline, tolerance=0.1) == []
+    regressions = compare(report(retrieval={'p95_ms': 120.0, 'count': 10}), baseline, tolerance=0.1)
+    assert len(regressions) == 1 and regressions[0].startswith('retrieval.p95_ms')
+
+
+def test_compare_throughput_is_higher_is_better():
+    baseline = report(ingest={'pages_per_s': 50.0})
+    assert compare(report(ingest={'pages_per_s': 80.0}), baseline, tolerance=0.1) == []
+    assert len(compare(report(ingest={'pages_per_s': 40.0}), baseline, tolerance=0.1)) == 1
+
+
+def test_compare_skips_missing_and_zero_metrics():
+    baseline = report(answer={'p50_ms': 0.0, 'mean_ms': 10.0}, transcribe={'rtf': 0.5})
+    assert compare(report(answer={'p50_ms': 5.0}), baseline, tolerance=0.1) == []
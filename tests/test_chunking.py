@@ -0,0 +1,95 @@
+import pytest
+
+from src.modules.transformer import ChunkingEngine, RegexTokenizer
+
+PAGES = [
+    ('Первая страница. В ней говорится о дворе дома и о его жильцах, которые давно там живут.', {'page': 1}),
+    ('Вторая страница - о реконструкции: крыша, фасад и окна были заменены в прошлом году.', {'page': 2}),
+    ('Третья страница короткая.', {'page': 3}),
+    ('Четвертая страница завершает документ и подводит итог всей истории дома.', {'page': 4}),
+]
+
+
+def engine(**kwargs) -> ChunkingEngine:
+    options = dict(tokenizer=RegexTokenizer(), chunk_tokens=8, overlap_tokens=2, cross_pages=True,
+                   remove_phrases=[])
+    options.update(kwargs)
+    return ChunkingEngine(**options)
+
+
+def tokens(text: str) -> list:
+    return RegexTokenizer.pattern.findall(text)
+
+
+def dump(documents: list) -> list:
+    return [(doc.page_content, doc.metadata['page']) for doc in documents]
+
+
+@pytest.mark.parametrize('cross_pages', [True, False])
+def test_chunks_fit_token_limit(cross_pages):
+    documents = engine(cross_pages=cross_pages).split_pages(PAGES)
+    assert documents
+    assert all(0 < len(tokens(doc.page_content)) <= 8 for doc in documents)
+
+
+def test_adjacent_chunks_overlap():
+    documents = engine(cross_pages=False).split_pages(PAGES[:1])
+    assert len(documents) > 1
+    for previous, current in zip(documents, documents[1:]):
+        assert tokens(current.page_content)[0] in tokens(previous.page_content)
+
+
+def test_chunk_ends_at_sentence_end():
+    documents = engine(chunk_tokens=5, overlap_tokens=0, cross_pages=False).split_pages(PAGES[:1])
+    assert documents[0].page_content == 'первая страница.'
+
+
+def test_without_cross_pages_chunks_stay_on_page():
+    for doc in engine(cross_pages=False).split_pages(PAGES):
+        page_text = engine().normalize(PAGES[doc.metadata['page'] - 1][0])
+        assert doc.page_content in page_text
+
+
+def test_cross_pages_metadata_comes_from_start_page():
+    pages = [(' '.join(f'с{page}слово{word}' for word in range(words)), {'page': page})
+             for page, words in ((1, 5), (2, 3), (3, 9))]
+    documents = engine().split_pages(pages)
+    assert any(len({word[1] for word in doc.page_content.split()}) > 1 for doc in documents)
+    for doc in documents:
+        assert doc.metadata['page'] == int(doc.page_content[1])
+
+
+@pytest.mark.parametrize('split', [1, 2, 3])
+def test_carry_across_batches_matches_single_batch(split):
+    expected = dump(engine().split_pages(PAGES))
+    chunker = engine()
+    documents = chunker.split_pages(PAGES[:split], final=False)
+    documents += chunker.split_pages(PAGES[split:], final=True)
+    assert dump(documents) == expected
+
+
+def test_final_empty_batch_flushes_carry():
+    chunker = engine()
+    documents = chunker.split_pages(PAGES[2:3], final=False)
+    assert documents == []
+    assert dump(chunker.split_pages([], final=True)) == [('третья страница короткая', 3)]
+
+
+def test_reset_drops_carry():
+    chunker = engine()
+    chunker.split_pages(PAGES[2:3], final=False)
+    chunker.reset()
+    assert chunker.split_pages([], final=True) == []
+
+
+@pytest.mark.parametrize('cross_pages', [True, False])
+def test_empty_and_punctuation_pages(cross_pages):
+    chunker = engine(cross_pages=cross_pages)
+    assert chunker.split_pages([]) == []
+    assert chunker.split_pages([('', {'page': 1}), ('  ...!?  ', {'page': 2}), ('"-"', {'page': 3})]) == []
+    assert dump(chunker.split_pages([('...', {'page': 1}), ('Текст.', {'page': 2})])) == [('текст', 2)]
+
+
+def test_normalize_removes_phrases_and_spaces():
+    chunker = engine(remove_phrases=['подробнее на портале'])
+    assert chunker.normalize('"Дом"  -  памятник,\nподробнее на портале   и только.') == 'дом памятник, и только'
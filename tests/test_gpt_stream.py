@@ -0,0 +1,72 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from src.modules import gpt_handler
+
+
+class FakeStream:
+    def __init__(self, parts: list, stall: bool = False):
+        self.parts = list(parts)
+        self.stall = stall
+        self.closed = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if not self.parts:
+            if self.stall:
+                await asyncio.sleep(10)
+            raise StopAsyncIteration
+        delta = SimpleNamespace(content=self.parts.pop(0))
+        return SimpleNamespace(usage=None, choices=[SimpleNamespace(delta=delta)])
+
+    async def close(self):
+        self.closed = True
+
+
+@pytest.fixture
+def fake_stream(monkeypatch):
+    streams = []
+
+    async def create(**kwargs):
+        return streams[0]
+
+    client = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create)))
+    monkeypatch.setattr(gpt_handler, 'async_client', client)
+    monkeypatch.setattr(gpt_handler, 'gpt_timeout', 0.05)
+    monkeypatch.setattr(gpt_handler, '_image_messages', lambda image, query: [])
+    return streams
+
+
+def collect(parts, streams: list) -> tuple:
+    """Читает ответ и проверяет, закрыт ли поток, до завершения цикла событий (он закрыл бы его сам)."""
+    async def read():
+        return [part async for part in parts], streams[0].closed
+    return asyncio.run(read())
+
+
+def test_stream_closed_after_full_read(fake_stream):
+    fake_stream.append(FakeStream(['один ', 'два']))
+    assert collect(gpt_handler._astream([], 10), fake_stream) == (['один ', 'два'], True)
+
+
+def test_stream_closed_on_timeout(fake_stream):
+    fake_stream.append(FakeStream(['один '], stall=True))
+    parts, closed = collect(gpt_handler.astream_image_answer(None, 'вопрос'), fake_stream)
+    assert parts == ['один ', f'\n\n{gpt_handler.IMAGE_ERROR_ANSWER}']
+    assert closed
+
+
+def test_stream_closed_when_consumer_stops(fake_stream):
+    fake_stream.append(FakeStream(['один ', 'два ', 'три']))
+
+    async def read_first():
+        parts = gpt_handler.astream_image_answer(None, 'вопрос')
+        first = await parts.__anext__()
+        await parts.aclose()
+        return first, fake_stream[0].closed
+
+    assert asyncio.run(read_first()) == ('один ', True)
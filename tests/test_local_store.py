@@ -0,0 +1,118 @@
+import asyncio
+
+import numpy as np
+import pytest
+from langchain_core.documents import Document
+
+from src.modules.local_store import LocalBM25Handler, LocalDocumentRegistry, LocalVectorStore
+
+DIMS = 4
+
+
+def chunk(text: str, doc_id: str) -> Document:
+    return Document(page_content=text, metadata={'doc_id': doc_id})
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = LocalVectorStore(str(tmp_path), dims=DIMS, search_batch=2)
+    store.upsert(['a-0', 'a-1'], [chunk('олимпиада в москве', 'a'), chunk('бойкот олимпийских игр', 'a')],
+                 [[1, 0, 0, 0], [0, 1, 0, 0]], owner=1)
+    store.upsert(['b-0'], [chunk('дом наркомфина и олимпиада', 'b')], [[0, 0, 1, 0]], owner=2)
+    store.commit()
+    return store
+
+
+def texts(store: LocalVectorStore, ranked: list) -> list:
+    return [doc.page_content for doc, _ in store.documents(ranked)]
+
+
+def test_search_bm25_uses_stemming(store):
+    assert texts(store, store.search_bm25('олимпиады', 10)) == ['олимпиада в москве', 'дом наркомфина и олимпиада']
+
+
+def test_search_vectors_returns_nearest_first(store):
+    ranked = store.search_vectors([0.1, 1, 0, 0], 2)
+    assert texts(store, ranked) == ['бойкот олимпийских игр', 'олимпиада в москве']
+    assert ranked[0][1] == pytest.approx(1 / np.linalg.norm([0.1, 1]), abs=1e-3)
+
+
+def test_owner_filter(store):
+    assert texts(store, store.search_bm25('олимпиада', 10, owner=2)) == ['дом наркомфина и олимпиада']
+    assert {text for text in texts(store, store.search_vectors([0, 0, 1, 0], 10, owner=1))} == {
+        'олимпиада в москве', 'бойкот олимпийских игр'}
+    assert store.search_bm25('олимпиада', 10, owner=3) == []
+
+
+def test_upsert_same_id_overwrites_row(store):
+    store.upsert(['a-0'], [chunk('новый текст', 'a')], [[0, 0, 0, 1]], owner=1)
+    assert store.count() == 3
+    assert store.search_bm25('москве', 10) == []
+    assert texts(store, store.search_vectors([0, 0, 0, 1], 1)) == ['новый текст']
+
+
+def test_same_chunk_id_for_different_owners(store):
+    store.upsert(['a-0'], [chunk('чужой документ', 'a')], [[1, 1, 0, 0]], owner=2)
+    assert store.count() == 4
+    assert texts(store, store.search_bm25('москве', 10, owner=1)) == ['олимпиада в москве']
+
+
+def test_delete_document(store):
+    assert store.delete_document(1, 'a') == 2
+    assert store.count() == 1
+    assert store.search_bm25('бойкот', 10) == []
+    assert texts(store, store.search_vectors([1, 0, 0, 0], 10)) == ['дом наркомфина и олимпиада']
+
+
+def test_reopen_restores_indexes(store, tmp_path):
+    store.delete_document(2, 'b')
+    store.commit()
+    reopened = LocalVectorStore(str(tmp_path), dims=DIMS)
+    assert reopened.count() == 2
+    assert texts(reopened, reopened.search_bm25('бойкот', 10, owner=1)) == ['бойкот олимпийских игр']
+    assert texts(reopened, reopened.search_vectors([1, 0, 0, 0], 1)) == ['олимпиада в москве']
+
+
+def test_clear(store):
+    store.add_document({'doc_owner': '1', 'doc_id': 'a', 'file_name': 'a.pdf', 'pages': 1, 'chunks': 2,
+                        'content_hash': 'h', 'ingested_at': 1})
+    store.clear()
+    assert store.count() == 0
+    assert store.search_bm25('олимпиада', 10) == []
+    assert store.find_documents(1) == []
+    store.upsert(['c-0'], [chunk('после очистки', 'c')], [[1, 0, 0, 0]], owner=1)
+    assert texts(store, store.search_bm25('очистки', 10)) == ['после очистки']
+
+
+def test_registry_is_per_owner(store):
+    registry = LocalDocumentRegistry(store)
+
+    async def scenario():
+        await registry.add(1, 'a', 'a.pdf', 1, 2, 'hash-a')
+        await registry.add(2, 'b', 'b.pdf', 1, 1, 'hash-b')
+        return (await registry.list(1), await registry.find_by_hash(1, 'hash-b'),
+                await registry.find_by_hash(2, 'hash-b'), await registry.delete(1, 'a'), await registry.list(1))
+
+    listed, foreign, own, deleted, after = asyncio.run(scenario())
+    assert [doc['doc_id'] for doc in listed] == ['a']
+    assert foreign is None
+    assert own['file_name'] == 'b.pdf'
+    assert deleted == 2
+    assert after == []
+
+
+def test_registry_get(store):
+    registry = LocalDocumentRegistry(store)
+
+    async def scenario():
+        await registry.add(1, 'a', 'a.pdf', 1, 2, 'hash-a')
+        return await registry.get(1, 'a'), await registry.get(2, 'a'), await registry.get(1, 'b')
+
+    found, foreign, missing = asyncio.run(scenario())
+    assert found['file_name'] == 'a.pdf'
+    assert foreign is None and missing is None
+
+
+def test_bm25_handler_filters_owner(store):
+    found = asyncio.run(LocalBM25Handler(store).asimilarity_search_with_relevance_scores('олимпиада', owner=1))
+    assert [doc.metadata['doc_id'] for doc, _ in found] == ['a']
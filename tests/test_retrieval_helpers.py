@@ -0,0 +1,58 @@
+import pytest
+
+from src.modules import gpt_handler
+from src.modules.elastic import reciprocal_rank_fusion
+from src.modules.gpt_handler import dedupe_fragments, pack_fragments
+
+
+def test_rrf_sums_weighted_reciprocal_ranks():
+    fused = reciprocal_rank_fusion([['a', 'b', 'c'], ['c', 'a']], [1.0, 0.5], rrf_k=60)
+    scores = dict(fused)
+    assert scores['a'] == pytest.approx(1 / 61 + 0.5 / 62)
+    assert scores['b'] == pytest.approx(1 / 62)
+    assert scores['c'] == pytest.approx(1 / 63 + 0.5 / 61)
+    assert [doc_id for doc_id, _ in fused] == ['a', 'c', 'b']
+
+
+def test_rrf_weights_change_order():
+    assert reciprocal_rank_fusion([['a'], ['b']], [1.0, 2.0], rrf_k=60)[0][0] == 'b'
+    assert reciprocal_rank_fusion([], [], rrf_k=60) == []
+
+
+def test_dedupe_drops_nested_fragments():
+    assert dedupe_fragments(['дом наркомфина построен в 1930 году', 'построен в 1930']) == \
+        ['дом наркомфина построен в 1930 году']
+    assert dedupe_fragments(['построен в 1930', 'дом наркомфина построен в 1930 году']) == \
+        ['дом наркомфина построен в 1930 году']
+
+
+def test_dedupe_merges_overlapping_edges():
+    first = 'архитекторы гинзбург и милинис спроектировали'
+    second = 'гинзбург и милинис спроектировали дом на новинском бульваре'
+    merged = 'архитекторы гинзбург и милинис спроектировали дом на новинском бульваре'
+    assert dedupe_fragments([first, second], min_overlap=10) == [merged]
+    assert dedupe_fragments([second, first], min_overlap=10) == [merged]
+
+
+def test_dedupe_keeps_order_and_ignores_short_overlaps():
+    fragments = ['первый по релевантности', 'второй фрагмент', 'тий фрагмент']
+    assert dedupe_fragments(fragments, min_overlap=10) == fragments
+    assert dedupe_fragments(fragments + fragments, min_overlap=10) == fragments
+
+
+@pytest.fixture
+def word_tokens(monkeypatch):
+    """Считает токены по словам, чтобы не загружать словарь tiktoken."""
+    monkeypatch.setattr(gpt_handler, 'count_tokens', lambda text: len(text.split()))
+
+
+def test_pack_fits_budget(word_tokens):
+    base = sum(len(message['content'].split()) for message in gpt_handler._stuff_messages([], 'вопрос'))
+    fragments = ['один два три', 'четыре пять']
+    assert pack_fragments(fragments, 'вопрос', budget=base + 3 + 8 + 2 + 8) == (fragments, True)
+    assert pack_fragments(fragments, 'вопрос', budget=base + 3 + 8 + 2 + 7) == (fragments, False)
+
+
+def test_pack_dedupes_before_counting(word_tokens):
+    base = sum(len(message['content'].split()) for message in gpt_handler._stuff_messages([], 'вопрос'))
+    assert pack_fragments(['один два три', 'два'], 'вопрос', budget=base + 3 + 8) == (['один два три'], True)
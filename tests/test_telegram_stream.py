@@ -0,0 +1,41 @@
+from src.modules.telegram_stream import close_markdown, split_message
+
+
+def test_split_message_short_text():
+    assert split_message('коротко', limit=20) == ['коротко']
+    assert split_message('', limit=20) == []
+
+
+def test_split_message_prefers_lines_then_words():
+    assert split_message('первая строка\nвторая строка', limit=20) == ['первая строка', 'вторая строка']
+    assert split_message('один два три четыре', limit=9) == ['один два', 'три', 'четыре']
+
+
+def test_split_message_cuts_long_words():
+    assert split_message('а' * 25, limit=10) == ['а' * 10, 'а' * 10, 'а' * 5]
+
+
+def test_split_message_parts_fit_limit():
+    text = '\n'.join(f'строка номер {number} ' + 'слово ' * (number % 7) for number in range(200))
+    parts = split_message(text, limit=100)
+    assert all(len(part) <= 100 for part in parts)
+    assert ' '.join(' '.join(parts).split()) == ' '.join(text.split())
+
+
+def test_close_markdown_code():
+    assert close_markdown('```python\nprint(1)') == '```python\nprint(1)\n```'
+    assert close_markdown('вызовите `split') == 'вызовите `split`'
+    assert close_markdown('```\ncode\n``` и `x` готово') == '```\ncode\n``` и `x` готово'
+
+
+def test_close_markdown_emphasis():
+    assert close_markdown('это *важно') == 'это *важно*'
+    assert close_markdown('это _курсив') == 'это _курсив_'
+    assert close_markdown('*жирный* и _курсив_') == '*жирный* и _курсив_'
+    assert close_markdown('`a*b` и *жирный') == '`a*b` и *жирный*'
+
+
+def test_close_markdown_drops_unfinished_link():
+    assert close_markdown('см. [портал](https://exa') == 'см. '
+    assert close_markdown('см. [портал](https://example.com)') == 'см. [портал](https://example.com)'
+    assert close_markdown('*см. [порт') == '*см. *'
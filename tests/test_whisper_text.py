@@ -0,0 +1,24 @@
+import pytest
+
+pytest.importorskip('torch')
+pytest.importorskip('transformers')
+
+from src.modules.whisper_handler import merge_overlapping_text  # noqa: E402
+
+
+def test_removes_repeated_words():
+    assert merge_overlapping_text('мы пошли в парк вечером', 'в парк вечером было тихо') == 'было тихо'
+
+
+def test_ignores_case_and_punctuation():
+    assert merge_overlapping_text('Мы пошли в Парк.', 'парк, и там гуляли') == 'и там гуляли'
+
+
+def test_keeps_text_without_overlap():
+    assert merge_overlapping_text('мы пошли в парк', 'там было тихо') == 'там было тихо'
+    assert merge_overlapping_text('', 'там было тихо') == 'там было тихо'
+
+
+def test_prefers_longest_overlap_within_limit():
+    assert merge_overlapping_text('да да да', 'да да да нет') == 'нет'
+    assert merge_overlapping_text('а б в г', 'б в г д', max_words=2) == 'б в г д'
@@ -0,0 +1,39 @@
+import asyncio
+
+import pytest
+
+from src.log.tracing import trace_id_var
+from src.modules import workers
+from src.modules.workers import WorkerPool
+
+
+def current_trace_id() -> str:
+    return trace_id_var.get()
+
+
+def in_process_worker() -> bool:
+    return workers._process_worker
+
+
+async def run_with_trace(pool: WorkerPool, trace_id: str) -> str:
+    trace_id_var.set(trace_id)
+    return await pool.run(current_trace_id)
+
+
+@pytest.mark.parametrize('kind', ['thread', 'process'])
+def test_pool_keeps_trace_id(kind):
+    pool = WorkerPool('test', 1, 1, kind=kind)
+    try:
+        assert asyncio.run(run_with_trace(pool, 'abc123')) == 'abc123'
+    finally:
+        pool.shutdown()
+
+
+
+@pytest.mark.parametrize('kind, expected', [('thread', False), ('process', True)])
+def test_only_process_workers_build_private_models(kind, expected):
+    pool = WorkerPool('test', 1, 1, kind=kind)
+    try:
+        assert asyncio.run(pool.run(in_process_worker)) is expected
+    finally:
+        pool.shutdown()